@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import ConfigParser
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cli_tools
+
+import freshen
+
+
+def git(*args, **kwargs):
+    """
+    Run a git command, raising an exception if it fails.
+
+    :param args: The arguments to pass to git.
+    :param cwd: The directory to run the command in.
+    :param input: Optional; data to feed to the command's standard
+                  input.
+
+    :returns: The standard output of the command.
+    """
+
+    cwd = kwargs.get('cwd')
+    data = kwargs.get('input')
+
+    proc = subprocess.Popen(['git'] + list(args), cwd=cwd,
+                            stdin=subprocess.PIPE if data else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode:
+        raise Exception("git %s failed: %s" % (' '.join(args), err.strip()))
+
+    return out
+
+
+def content(seq, size):
+    """
+    Generate deterministic, incompressible file content.
+
+    :param seq: The sequence number of the content.  The same sequence
+                number always produces the same content.
+    :param size: The size of the content, in bytes.
+
+    :returns: A string of the requested size.
+    """
+
+    chunks = []
+    total = 0
+    counter = 0
+    while total < size:
+        chunk = hashlib.sha256('%d:%d' % (seq, counter)).digest()
+        chunks.append(chunk)
+        total += len(chunk)
+        counter += 1
+
+    return ''.join(chunks)[:size]
+
+
+def history(commits, size, files, refs, span):
+    """
+    Generate a "git fast-import" stream describing a linear history
+    on the "master" branch.  The stream is deterministic, so two
+    streams differing only in the number of commits share the commits
+    they have in common.
+
+    :param commits: The number of commits.
+    :param size: The size, in bytes, of the file changed by each
+                 commit.
+    :param files: The number of distinct files; each commit changes
+                  one of them.
+    :param refs: The number of tags to create.
+    :param span: The number of commits, from the start of the history,
+                 across which the tags are spread evenly.
+
+    :returns: The fast-import stream, as a string.
+    """
+
+    stream = []
+    for seq in range(1, commits + 1):
+        msg = 'Commit %d\n' % seq
+        data = content(seq, size)
+        stream.append('commit refs/heads/master\n'
+                      'mark :%d\n'
+                      'committer Bench <bench@example.com> %d +0000\n'
+                      'data %d\n%s' % (seq, 1000000000 + seq, len(msg), msg))
+        if seq > 1:
+            stream.append('from :%d\n' % (seq - 1))
+        stream.append('M 100644 inline file-%d\ndata %d\n%s\n\n' %
+                      (seq % files, len(data), data))
+
+    for idx in range(refs):
+        stream.append('reset refs/tags/bench-%d\nfrom :%d\n\n' %
+                      (idx, idx * span // refs + 1))
+
+    return ''.join(stream)
+
+
+def make_template(path, commits, size, files, refs, span):
+    """
+    Create a bare template repository.
+
+    :param path: The path of the repository to create.
+    :param commits: The number of commits.
+    :param size: The size, in bytes, of the file changed by each
+                 commit.
+    :param files: The number of distinct files.
+    :param refs: The number of tags to create.
+    :param span: The number of commits across which the tags are
+                 spread.
+    """
+
+    git('init', '-q', '--bare', path)
+    git('symbolic-ref', 'HEAD', 'refs/heads/master', cwd=path)
+    git('fast-import', '--quiet', cwd=path,
+        input=history(commits, size, files, refs, span))
+
+
+def make_templates(workdir, depth, lag, size, files, refs):
+    """
+    Create the template repositories the fleet is cloned from: a
+    "full" repository with the complete upstream history, and a
+    "base" repository which is "lag" commits behind it.  Both have the
+    same tags.
+
+    :param workdir: The directory in which to create the templates.
+    :param depth: The number of commits in the upstream history.
+    :param lag: The number of commits the base is behind.
+    :param size: The size, in bytes, of the file changed by each
+                 commit.
+    :param files: The number of distinct files.
+    :param refs: The number of tags to create.
+
+    :returns: A tuple of the paths of the full and base templates.
+    """
+
+    templates = os.path.join(workdir, 'templates')
+    if os.path.exists(templates):
+        shutil.rmtree(templates)
+
+    full = os.path.join(templates, 'full.git')
+    base = os.path.join(templates, 'base.git')
+    make_template(full, depth, size, files, refs, depth - lag)
+    make_template(base, depth - lag, size, files, refs, depth - lag)
+
+    return full, base
+
+
+def make_fleet(workdir, templates, count):
+    """
+    Build a synthetic fleet of repositories.  Each repository has a
+    bare "upstream" repository cloned from the full template, and a
+    clone of the base template which pulls from its upstream over a
+    "file://" URL, and so is behind it.
+
+    :param workdir: The directory in which to build the fleet.
+    :param templates: A tuple of the paths of the full and base
+                      templates, as returned by ``make_templates()``.
+    :param count: The number of repositories.
+
+    :returns: The name of the repositories configuration file
+              describing the fleet.
+    """
+
+    full, base = templates
+
+    upstreams = os.path.join(workdir, 'upstream')
+    srcdir = os.path.join(workdir, 'src')
+    for path in (upstreams, srcdir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    # Each fleet has a state database of its own, since the
+    # repositories of different fleets share their directories
+    state_db = os.path.join(workdir, 'freshen-%d.db' % count)
+    if os.path.exists(state_db):
+        os.unlink(state_db)
+
+    names = []
+    for idx in range(count):
+        name = 'repo%04d' % idx
+        upstream = os.path.join(upstreams, '%s.git' % name)
+        src = os.path.join(srcdir, name)
+
+        git('clone', '-q', '--bare', full, upstream)
+        git('clone', '-q', base, src)
+        git('remote', 'set-url', 'origin', 'file://%s' % upstream, cwd=src)
+        names.append(name)
+
+    cfg = ConfigParser.SafeConfigParser()
+    cfg.set('DEFAULT', 'basedir', srcdir)
+    cfg.add_section('repos')
+    cfg.set('repos', 'list', ', '.join(names))
+    cfg.set('repos', 'logfile', os.path.join(workdir, 'freshen.log'))
+    cfg.set('repos', 'state_db', state_db)
+    cfg.set('repos', 'journal', workdir)
+
+    repo_conf = os.path.join(workdir, 'repos.ini')
+    with open(repo_conf, 'w') as f:
+        cfg.write(f)
+
+    return repo_conf
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Discard standard output for the duration of a "with" statement.
+    """
+
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def timed(workdir, name, func, repo_conf, **kwargs):
+    """
+    Time a single run of a command.
+
+    :param workdir: The directory containing the fleet.
+    :param name: The name of the run, used to name its report.
+    :param func: The command function, e.g., ``freshen.freshen``.
+    :param repo_conf: The repositories configuration file.
+    :param kwargs: Additional arguments for the command.
+
+    :returns: A dictionary describing the run, including its wall
+              clock duration and the per-stage summaries from its run
+              report, which are empty if no report was written.
+    """
+
+    # The report of a run on another fleet must not be mistaken for
+    # this run's
+    report = os.path.join(workdir, '%s.json' % name)
+    if os.path.exists(report):
+        os.unlink(report)
+
+    start = time.time()
+    with quiet():
+        try:
+            error = func(repo_conf, report=report, **kwargs)
+        except Exception as exc:
+            error = str(exc)
+    duration = time.time() - start
+
+    # A command which fails before it starts may not write a report
+    summary = {'outcomes': {}, 'stages': {}}
+    if os.path.exists(report):
+        with open(report) as f:
+            summary = json.load(f)
+
+    return {
+        'duration': duration,
+        'error': error,
+        'outcomes': summary['outcomes'],
+        'stages': summary['stages'],
+    }
+
+
+@cli_tools.argument('--count', '-n',
+                    type=int,
+                    action='append',
+                    help="Number of repositories in the fleet.  May be "
+                    "given more than once.  Defaults to 10, 100, and 1000.")
+@cli_tools.argument('--depth', '-d',
+                    type=int,
+                    default=50,
+                    help="Number of commits in each upstream repository.")
+@cli_tools.argument('--lag',
+                    type=int,
+                    default=5,
+                    help="Number of commits each clone is behind.")
+@cli_tools.argument('--size', '-s',
+                    type=int,
+                    default=4096,
+                    help="Size, in bytes, of the file changed by each "
+                    "commit.")
+@cli_tools.argument('--files',
+                    type=int,
+                    default=10,
+                    help="Number of distinct files in each repository.")
+@cli_tools.argument('--refs',
+                    type=int,
+                    default=10,
+                    help="Number of tags in each repository.")
+@cli_tools.argument('--jobs', '-j',
+                    type=int,
+                    default=1,
+                    help="Number of repositories to freshen or compact at "
+                    "once.")
+@cli_tools.argument('--workdir', '-w',
+                    default=None,
+                    help="Directory to build the fleet in.  Defaults to a "
+                    "temporary directory, which is removed afterwards.")
+@cli_tools.argument('--output', '-o',
+                    default=None,
+                    help="File to write the JSON results to.  Defaults to "
+                    "standard output.")
+def bench(count=None, depth=50, lag=5, size=4096, files=10, refs=10,
+          jobs=1, workdir=None, output=None):
+    """
+    Benchmark freshen and compact against a synthetic fleet of local
+    repositories.
+
+    :param count: A list of fleet sizes to benchmark.  If not
+                  provided, fleets of 10, 100, and 1000 repositories
+                  are benchmarked.
+    :param depth: The number of commits in each upstream repository.
+    :param lag: The number of commits each clone is behind its
+                upstream, and thus the number of commits the first
+                freshen must fetch.
+    :param size: The size, in bytes, of the file changed by each
+                 commit.
+    :param files: The number of distinct files in each repository.
+    :param refs: The number of tags in each repository.
+    :param jobs: The number of repositories to freshen or compact at
+                 once.
+    :param workdir: The directory to build the fleet in.  If not
+                    provided, a temporary directory is used and
+                    removed afterwards.
+    :param output: The file to write the JSON results to.  If not
+                   provided, the results are written to standard
+                   output.
+    """
+
+    if lag >= depth:
+        return "The lag must be less than the depth"
+
+    results = {
+        'parameters': {
+            'depth': depth,
+            'lag': lag,
+            'size': size,
+            'files': files,
+            'refs': refs,
+            'jobs': jobs,
+        },
+        'python': platform.python_version(),
+        'git': git('--version').strip(),
+        'results': [],
+    }
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='freshen-bench-')
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    try:
+        templates = make_templates(workdir, depth, lag, size, files, refs)
+        for fleet in count or [10, 100, 1000]:
+            start = time.time()
+            repo_conf = make_fleet(workdir, templates, fleet)
+            setup = time.time() - start
+
+            # The first run fetches, the second finds nothing to do
+            runs = {}
+            runs['freshen'] = timed(workdir, 'freshen', freshen.freshen,
+                                    repo_conf, jobs=jobs)
+            runs['freshen_noop'] = timed(workdir, 'freshen_noop',
+                                         freshen.freshen, repo_conf,
+                                         jobs=jobs)
+            runs['freshen_incremental'] = timed(
+                workdir, 'freshen_incremental', freshen.freshen, repo_conf,
+                jobs=jobs, incremental=True)
+            runs['compact'] = timed(workdir, 'compact', freshen.compact,
+                                    repo_conf, jobs=jobs)
+
+            results['results'].append({
+                'count': fleet,
+                'setup': setup,
+                'runs': runs,
+            })
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir)
+
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == '__main__':
+    sys.exit(bench.console())
@@ -15,17 +15,124 @@
 
 import ConfigParser
 import contextlib
+import cProfile
 import datetime
+import errno
+import functools
+import glob
+import hashlib
+import json
+import math
+import multiprocessing
 import os
+import pipes
+import pstats
+import Queue
+import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 import git
 import cli_tools
 
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    # The asyncio backend is unavailable
+    asyncio = None
+
+
+def to_bool(value):
+    """
+    Interpret a value, such as a string from the repository
+    configuration file, as a boolean.
+
+    :param value: The value to interpret.  Strings are interpreted in
+                  the same fashion as ConfigParser.getboolean().
+
+    :returns: A boolean.
+    """
+
+    if isinstance(value, basestring):
+        try:
+            return _boolean_states[value.lower()]
+        except KeyError:
+            raise ValueError("Not a boolean: %s" % value)
+
+    return bool(value)
+
+
+_boolean_states = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+
+def stage(func):
+    """
+    A decorator for Repo methods which implement a stage of a freshen
+    or compact.  The time taken by the stage, in seconds, is recorded
+    in the "timings" dictionary of the Repo object, keyed by the name
+    of the method.
+
+    :param func: The method to decorate.
+
+    :returns: The decorated method.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.timings[func.__name__] = time.time() - start
+
+    return wrapper
+
+
+def stream_process(output, proc, maxlen=8192):
+    """
+    Send the standard output and standard error of a process to an
+    Output object line by line, as the lines are produced, then wait
+    for the process to exit.  Each line is labeled with the stream it
+    came from.  Lines longer than "maxlen" are split, so the memory
+    used does not depend on the amount of output.
+
+    :param output: An Output object to which the process outputs will
+                   be sent.
+    :param proc: A subprocess.Popen object, with both "stdout" and
+                 "stderr" connected to pipes.
+    :param maxlen: The maximum length of a line.
+
+    :returns: The exit status of the process.
+    """
+
+    def reader(pipe, label):
+        for line in iter(lambda: pipe.readline(maxlen), ''):
+            output.send("%s %s" % (label, line))
+
+    threads = []
+    for pipe, label in ((proc.stdout, 'Stdout:'), (proc.stderr, 'Stderr:')):
+        thread = threading.Thread(target=reader, args=(pipe, label))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return proc.wait()
+
 
 @contextlib.contextmanager
-def with_branch(output, repo, branch):
+def with_branch(output, repo, branch, restore=True):
     """
     A contextmanager function which ensures that operations on a given
     repository are done with a specific branch checked out.
@@ -34,6 +141,12 @@ def with_branch(output, repo, branch):
                    be sent.
     :param repo: The repository being acted upon.
     :param branch: The desired branch.
+    :param restore: If False, the desired branch is left checked out,
+                    unless an exception is raised; the caller is then
+                    responsible for returning to the original branch.
+
+    :returns: The original branch, as the value of the "with"
+              statement.
     """
 
     save_branch = repo.get_current_branch()
@@ -43,21 +156,629 @@ def with_branch(output, repo, branch):
         repo.git_checkout(output, branch)
 
     try:
-        yield
+        yield save_branch
+    except BaseException:
+        restore = True
+        raise
     finally:
-        if save_branch != branch:
+        if restore and save_branch != branch:
             output.send("Returning to original branch %s" % save_branch)
             repo.git_checkout(output, save_branch)
 
 
+def url_host(url):
+    """
+    Determine the host a git remote URL refers to.
+
+    :param url: The URL, either in URL form, e.g.,
+                "ssh://git@example.com/repo.git", or in the scp-like
+                form, e.g., "git@example.com:repo.git".
+
+    :returns: The host name, in lower case, or None if the URL refers
+              to the local filesystem.
+    """
+
+    scheme, sep, rest = url.partition('://')
+    if sep:
+        if scheme == 'file':
+            return None
+        netloc = rest.split('/', 1)[0].rpartition('@')[2]
+        if netloc.startswith('['):
+            # An IPv6 address
+            host = netloc[1:].partition(']')[0]
+        else:
+            host = netloc.partition(':')[0]
+    else:
+        # The scp-like form has no slash before the first colon
+        head, sep, _path = url.partition(':')
+        if not sep or '/' in head:
+            return None
+        host = head.rpartition('@')[2].strip('[]')
+
+    return host.lower() or None
+
+
+class AsyncioBackend(object):
+    """
+    Run git commands as child processes driven by a single asyncio
+    event loop, as an alternative to GitPython.  While the backend is
+    in use, the event loop runs in a background thread, which reads
+    the output of every running command, passes the lines written to
+    standard error on as they are produced, and kills commands which
+    exceed their timeout, along with any children they started.
+    Commands may be run from any thread, which waits for the command
+    to exit; the number of commands running at once is thus still
+    that of the threads running them.  Commands are detached from the
+    terminal and have no standard input, so that they cannot stop to
+    prompt for anything.  Requires trollius.
+    """
+
+    # The number of bytes to read from a pipe at once
+    chunk_size = 8192
+
+    # The longest interval, in seconds, at which a command whose
+    # output has ended is checked for having exited
+    reap_interval = 0.05
+
+    def __init__(self, enabled=True):
+        """
+        Initialize an AsyncioBackend object.
+
+        :param enabled: If False, the AsyncioBackend does nothing, and
+                        git commands are run through GitPython.
+        """
+
+        self.enabled = enabled
+        self.loop = None
+        self.thread = None
+
+    def __enter__(self):
+        """
+        Start the event loop upon entry to a "with" statement.
+
+        :returns: The AsyncioBackend object.
+        """
+
+        if self.enabled:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever,
+                                           name='freshen-git')
+            self.thread.daemon = True
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Stop the event loop upon exit from a "with" statement.  Any
+        commands still running, such as when the run was interrupted,
+        are killed.
+
+        :param exc_type: The type of the exception, if one was raised.
+        :param exc_value: The exception, if one was raised.
+        :param exc_tb: The traceback, if an exception was raised.
+        """
+
+        if self.loop is None:
+            return
+
+        loop, self.loop = self.loop, None
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join()
+        self.thread = None
+
+        # Cancelling a command may let another, queued meanwhile, start
+        pending = [task for task in asyncio.Task.all_tasks(loop)
+                   if not task.done()]
+        while pending:
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.wait(pending, loop=loop))
+            pending = [task for task in asyncio.Task.all_tasks(loop)
+                       if not task.done()]
+        loop.close()
+
+    def run(self, command, cwd=None, env=None, timeout=None, stream=None):
+        """
+        Run a command on the event loop, waiting for it to exit.
+
+        :param command: The command to run, as a list.
+        :param cwd: The directory in which to run the command.
+        :param env: The environment for the command.  If None, the
+                    environment is inherited.
+        :param timeout: The maximum time, in seconds, the command may
+                        run before it is killed, along with any
+                        children it started.  If None, the command may
+                        run indefinitely.
+        :param stream: A callable which will be passed each line the
+                       command writes to standard error, without the
+                       trailing newline, as it is produced.  It is
+                       called from the thread running the event loop.
+
+        :returns: A tuple of the exit status of the command, its
+                  standard output, its standard error, and a boolean
+                  which is True if the command timed out.
+        """
+
+        loop = self.loop
+        if loop is None:
+            raise RuntimeError("The asyncio backend is not running")
+
+        # The command is started in a session of its own, so that it
+        # may be killed along with any children it started, such as
+        # ssh, and so that, without a terminal, a prompt for a
+        # passphrase fails at once rather than waiting for an answer
+        with open(os.devnull) as devnull:
+            proc = subprocess.Popen(command, cwd=cwd, env=env, close_fds=True,
+                                    stdin=devnull, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    preexec_fn=os.setsid)
+
+        done = Queue.Queue()
+
+        def start():
+            task = asyncio.ensure_future(
+                self._communicate(loop, proc, timeout, stream), loop=loop)
+            task.add_done_callback(done.put)
+
+        loop.call_soon_threadsafe(start)
+
+        # Use a timeout so that a KeyboardInterrupt can get through
+        while True:
+            try:
+                task = done.get(True, 0.5)
+            except Queue.Empty:
+                continue
+
+            return task.result()
+
+    def _communicate(self, loop, proc, timeout, stream):
+        """
+        A coroutine which reads the output of a command and waits for
+        it to exit.
+
+        :param loop: The event loop.
+        :param proc: The subprocess.Popen object for the command,
+                     with both "stdout" and "stderr" connected to
+                     pipes.
+        :param timeout: The maximum time, in seconds, the command may
+                        run, or None.
+        :param stream: A callable to pass the lines written to
+                       standard error to, or None.
+
+        :returns: A tuple of the exit status of the command, its
+                  standard output, its standard error, and a boolean
+                  which is True if the command timed out.
+        """
+
+        stdout = []
+        stderr = []
+        timed_out = False
+        transports = []
+        try:
+            readers = []
+            for pipe, chunks, callback in ((proc.stdout, stdout, None),
+                                           (proc.stderr, stderr, stream)):
+                reader = asyncio.StreamReader(loop=loop)
+                transport, _protocol = yield From(loop.connect_read_pipe(
+                    functools.partial(asyncio.StreamReaderProtocol, reader,
+                                      loop=loop), pipe))
+                transports.append(transport)
+                readers.append(asyncio.ensure_future(
+                    self._read(reader, chunks, callback), loop=loop))
+
+            _done, running = yield From(asyncio.wait(
+                readers, timeout=timeout, loop=loop))
+            if running:
+                # Killing the command closes its end of the pipes
+                timed_out = True
+                self._kill(proc)
+                yield From(asyncio.wait(running, loop=loop))
+            for reader in readers:
+                reader.result()
+
+            # The output ends just before the command exits
+            interval = self.reap_interval / 16
+            while proc.poll() is None:
+                yield From(asyncio.sleep(interval, loop=loop))
+                interval = min(interval * 2, self.reap_interval)
+        finally:
+            for transport in transports:
+                transport.close()
+
+            if proc.returncode is None:
+                # The command was cancelled
+                self._kill(proc)
+                proc.wait()
+
+        raise Return((proc.returncode, ''.join(stdout), ''.join(stderr),
+                      timed_out))
+
+    def _read(self, reader, chunks, stream=None):
+        """
+        A coroutine which reads from a pipe until it is closed.
+
+        :param reader: An asyncio StreamReader for the pipe.
+        :param chunks: A list to which the data read will be appended.
+        :param stream: A callable to pass each line read to, without
+                       the trailing newline, or None.
+        """
+
+        partial = ''
+        while True:
+            data = yield From(reader.read(self.chunk_size))
+            if not data:
+                break
+
+            chunks.append(data)
+            if stream is not None:
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    stream(line)
+
+        if partial and stream is not None:
+            stream(partial)
+
+    @staticmethod
+    def _kill(proc):
+        """
+        Kill a command, along with any children it started.
+
+        :param proc: The subprocess.Popen object for the command.
+        """
+
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError as exc:
+            # The command and its children have all exited
+            if exc.errno != errno.ESRCH:
+                raise
+
+
+class AsyncGit(object):
+    """
+    A stand-in for the GitPython "git.Git" handle which runs git
+    commands through an AsyncioBackend.  As with "git.Git", git
+    commands are available as methods, with underscores in the method
+    name replaced by dashes, which return the standard output of the
+    command, less any final newline, and a failed command raises
+    "git.exc.GitCommandError".  The "with_exceptions" and
+    "kill_after_timeout" keyword arguments are accepted, with the
+    same meanings.  In addition, the lines git writes to standard
+    error, such as the messages of a fetch, may be passed on as they
+    are produced.
+    """
+
+    def __init__(self, working_dir, backend, stream=None):
+        """
+        Initialize an AsyncGit object.
+
+        :param working_dir: The directory in which to run the git
+                            commands.
+        :param backend: The AsyncioBackend to run the commands with.
+        :param stream: A callable which will be passed each line git
+                       writes to standard error as it is produced.
+        """
+
+        self.working_dir = working_dir
+        self.backend = backend
+        self.stream = stream
+        self._environment = {}
+
+    def __getattr__(self, name):
+        """
+        Retrieve a method which runs a git command.
+
+        :param name: The name of the git command, with dashes replaced
+                     by underscores.
+
+        :returns: A function which runs the git command with the
+                  positional arguments given to it.
+        """
+
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return functools.partial(self._call_process, name.replace('_', '-'))
+
+    def _call_process(self, command, *args, **kwargs):
+        """
+        Run a git command.
+
+        :param command: The git command, e.g., "fetch".
+        :param args: The arguments for the command.
+        :param kwargs: The keyword arguments for "execute()".
+
+        :returns: The standard output of the command.
+        """
+
+        return self.execute([git.Git.GIT_PYTHON_GIT_EXECUTABLE, command] +
+                            list(args), **kwargs)
+
+    def update_environment(self, **kwargs):
+        """
+        Set environment variables for the git commands.
+
+        :param kwargs: The variables to set.  A value of None removes
+                       the variable.
+
+        :returns: A dictionary of the previous values of the
+                  variables.
+        """
+
+        old = {}
+        for key, value in kwargs.items():
+            old[key] = self._environment.get(key)
+            if value is None:
+                self._environment.pop(key, None)
+            else:
+                self._environment[key] = value
+
+        return old
+
+    def environment(self):
+        """
+        Retrieve the environment variables set for the git commands.
+
+        :returns: A dictionary of the variables.
+        """
+
+        return self._environment
+
+    def execute(self, command, with_exceptions=True, kill_after_timeout=None):
+        """
+        Run a command.
+
+        :param command: The command to run, as a list.
+        :param with_exceptions: If False, a failure of the command
+                                will not raise an exception.
+        :param kill_after_timeout: The maximum time, in seconds, the
+                                   command may run before it is
+                                   killed.  If None, the command may
+                                   run indefinitely.
+
+        :returns: The standard output of the command, less any final
+                  newline.
+        """
+
+        # Ensure the output of git is in a predictable language
+        env = os.environ.copy()
+        env['LANGUAGE'] = 'C'
+        env['LC_ALL'] = 'C'
+        env.update(self._environment)
+
+        try:
+            status, stdout, stderr, timed_out = self.backend.run(
+                command, self.working_dir, env, kill_after_timeout,
+                self.stream)
+        except OSError as exc:
+            raise git.exc.GitCommandNotFound(command, exc)
+
+        if stdout.endswith('\n'):
+            stdout = stdout[:-1]
+        if timed_out:
+            stderr += ("Timeout: the command \"%s\" did not complete in "
+                       "%s secs." % (' '.join(command), kill_after_timeout))
+
+        if with_exceptions and (status or timed_out):
+            raise git.exc.GitCommandError(command, status, stderr, stdout)
+
+        return stdout
+
+
+class RefReader(object):
+    """
+    Read refs directly from the git directory of a repository, without
+    running git.  Symbolic refs, such as HEAD, loose refs, and packed
+    refs are supported, as are linked worktrees, whose ".git" is a
+    file pointing at their own git directory.  Repositories using the
+    reftable format are not supported.
+    """
+
+    # Refs which are kept per-worktree rather than in the common
+    # directory
+    worktree_prefixes = ('refs/bisect/', 'refs/worktree/', 'refs/rewritten/')
+
+    def __init__(self, directory):
+        """
+        Initialize a RefReader object.
+
+        :param directory: The working directory of the repository, or
+                          the directory of a bare repository.
+        """
+
+        self.directory = directory
+
+        self._gitdir = None
+        self._commondir = None
+        self._packed = {}
+        self._packed_key = None
+
+    @staticmethod
+    def _read(path):
+        """
+        Read a small file, such as a loose ref.
+
+        :param path: The path of the file.
+
+        :returns: The contents of the file, stripped of surrounding
+                  whitespace, or None if the file does not exist.
+        """
+
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except IOError as exc:
+            if exc.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+                return None
+            raise
+
+    @property
+    def gitdir(self):
+        """
+        Retrieve the git directory of the repository.  For a linked
+        worktree, this is the worktree's own git directory.
+        """
+
+        if self._gitdir is None:
+            dotgit = os.path.join(self.directory, '.git')
+            if os.path.isdir(dotgit):
+                gitdir = dotgit
+            elif os.path.isfile(dotgit):
+                contents = self._read(dotgit)
+                if not contents.startswith('gitdir:'):
+                    raise ValueError("Unrecognized .git file in %s" %
+                                     self.directory)
+                gitdir = os.path.join(self.directory,
+                                      contents[7:].strip())
+            elif os.path.isfile(os.path.join(self.directory, 'HEAD')):
+                # A bare repository
+                gitdir = self.directory
+            else:
+                raise ValueError("No git directory found in %s" %
+                                 self.directory)
+
+            self._gitdir = os.path.normpath(gitdir)
+
+        return self._gitdir
+
+    @property
+    def commondir(self):
+        """
+        Retrieve the common directory of the repository, which holds
+        the refs shared by all of its worktrees.
+        """
+
+        if self._commondir is None:
+            commondir = self._read(os.path.join(self.gitdir, 'commondir'))
+            if commondir:
+                commondir = os.path.normpath(os.path.join(self.gitdir,
+                                                          commondir))
+            else:
+                commondir = self.gitdir
+
+            if os.path.isdir(os.path.join(commondir, 'reftable')):
+                raise ValueError("Repository %s uses reftable" %
+                                 self.directory)
+
+            self._commondir = commondir
+
+        return self._commondir
+
+    def packed_refs(self):
+        """
+        Retrieve the packed refs of the repository.  The file is only
+        parsed again if it has changed.
+
+        :returns: A dictionary mapping ref names to SHAs.
+        """
+
+        path = os.path.join(self.commondir, 'packed-refs')
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        if key != self._packed_key:
+            packed = {}
+            with open(path) as f:
+                for line in f:
+                    # Skip the header and the peeled values of tags
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    sha, sep, name = line.strip().partition(' ')
+                    if sep:
+                        packed[name] = sha
+
+            self._packed = packed
+            self._packed_key = key
+
+        return self._packed
+
+    def read_ref(self, name):
+        """
+        Read the value of a ref, without following symbolic refs.
+
+        :param name: The full name of the ref, e.g., "HEAD" or
+                     "refs/heads/master".
+
+        :returns: The SHA the ref refers to, a string of the form
+                  "ref: <name>" if the ref is symbolic, or None if the
+                  ref does not exist.
+        """
+
+        if '/' not in name or name.startswith(self.worktree_prefixes):
+            base = self.gitdir
+        else:
+            base = self.commondir
+
+        value = self._read(os.path.join(base, name))
+        if value is None and name.startswith('refs/'):
+            value = self.packed_refs().get(name)
+
+        return value
+
+    def resolve(self, name, max_depth=5):
+        """
+        Resolve a ref to a SHA, following symbolic refs.
+
+        :param name: The full name of the ref.
+        :param max_depth: The maximum number of symbolic refs to
+                          follow.
+
+        :returns: The SHA, or None if the ref, or a ref it refers to,
+                  does not exist.
+        """
+
+        for i in range(max_depth):
+            value = self.read_ref(name)
+            if value is None or not value.startswith('ref:'):
+                return value
+            name = value[4:].strip()
+
+        raise ValueError("Too many levels of symbolic refs in %s" %
+                         self.directory)
+
+    def head(self):
+        """
+        Determine what is checked out.
+
+        :returns: The name of the checked out branch, or the SHA of the
+                  checked out commit if HEAD is detached.
+        """
+
+        value = self.read_ref('HEAD')
+        if value is None:
+            raise ValueError("No HEAD found in %s" % self.directory)
+        elif value.startswith('ref:'):
+            value = value[4:].strip()
+            if value.startswith('refs/heads/'):
+                value = value[11:]
+
+        return value
+
+
 class Repo(object):
     """
     Describe a repository to be freshened.
     """
 
+    # Files which affect the result of installing a repository; may
+    # contain glob patterns
+    install_files = ['setup.py', 'setup.cfg', 'pyproject.toml',
+                     'MANIFEST.in', '.requires', '.test-requires',
+                     '*requirements*.txt', 'requirements/*.txt']
+
     def __init__(self, name, basedir='~/devel/src',
                  pull='origin', push=None,
-                 branch='master', install_mode=None):
+                 branch='master', install_mode=None, single_fetch=False,
+                 fetch_refspec=None, fetch_tags=None, fetch_prune=False,
+                 install_cache=True, gc_loose_threshold=6700,
+                 gc_pack_threshold=50, no_checkout=False,
+                 git_timeout=None, mirror=None, fetch_depth=None,
+                 fetch_filter=None):
         """
         Initialize a Repo object.
 
@@ -76,6 +797,67 @@ class Repo(object):
                              specified command passed to the setup.py.
                              Suggested values are "develop" and
                              "install".
+        :param single_fetch: If True, the desired branch will be
+                             fetched only once, from the remote
+                             configured by "pull", and then merged
+                             locally, rather than fetched from the
+                             default remote and pulled.  May be a
+                             string, as from the configuration file.
+        :param fetch_refspec: A whitespace-separated list of refspecs
+                              to fetch.  If empty, the refspecs
+                              configured for the remote will be
+                              fetched.  If None, only the desired
+                              branch will be fetched, into its
+                              remote-tracking branch.
+        :param fetch_tags: If True, all tags will be fetched; if
+                           False, no tags will be fetched.  If None,
+                           tags pointing at fetched commits will be
+                           fetched, as is the default for "git
+                           fetch".  May be a string.
+        :param fetch_prune: If True, remote-tracking refs which no
+                            longer exist on the remote will be
+                            removed when fetching.  May be a string.
+        :param install_cache: If True, and a StateStore is available,
+                              the repository will only be installed
+                              if the files affecting the install have
+                              changed since the last install.  May be
+                              a string.
+        :param gc_loose_threshold: The number of loose objects at or
+                                   above which a threshold-driven
+                                   compact will compact the
+                                   repository.  May be a string.
+        :param gc_pack_threshold: The number of packs at or above
+                                  which a threshold-driven compact
+                                  will compact the repository.  May be
+                                  a string.
+        :param no_checkout: If True, and a different branch is checked
+                            out, the desired branch will be updated
+                            without checking it out: it will be
+                            fast-forwarded if possible, and otherwise
+                            merged in a dedicated worktree, from which
+                            the repository will also be installed.
+                            May be a string.
+        :param git_timeout: The maximum time, in seconds, a git
+                            command accessing the network may run
+                            before it is killed.  May be a string.
+        :param mirror: The location of a bare mirror of the upstream
+                       repository, shared with other repositories.
+                       The mirror will be created if it does not
+                       exist, and the repository will borrow objects
+                       from it.  A relative location is relative to
+                       "basedir".  This parameter will be
+                       tilde-expanded.
+        :param fetch_depth: If specified, fetches will be shallow,
+                            limited to the given number of commits
+                            from the tip of each fetched branch, and
+                            the desired branch will be reset to the
+                            fetched tip rather than merged.  May be a
+                            string.
+        :param fetch_filter: If specified, fetches will be partial,
+                             omitting the objects excluded by the
+                             given filter specification, e.g.,
+                             "blob:none".  Omitted objects are
+                             fetched by git when they are needed.
         """
 
         self.name = name
@@ -84,10 +866,63 @@ class Repo(object):
         self.push = push
         self.branch = branch
         self.install_mode = install_mode
+        self.single_fetch = to_bool(single_fetch)
+        self.fetch_refspec = fetch_refspec
+        self.fetch_tags = None if fetch_tags is None else to_bool(fetch_tags)
+        self.fetch_prune = to_bool(fetch_prune)
+        self.install_cache = to_bool(install_cache)
+        self.gc_loose_threshold = int(gc_loose_threshold)
+        self.gc_pack_threshold = int(gc_pack_threshold)
+        self.no_checkout = to_bool(no_checkout)
+        self.git_timeout = None if git_timeout in (None, '') else float(
+            git_timeout)
+        self.fetch_depth = None if fetch_depth in (None, '') else int(
+            fetch_depth)
+        self.fetch_filter = fetch_filter or None
+        self.mirror = os.path.abspath(os.path.join(
+            self.basedir, os.path.expanduser(mirror))) if mirror else None
+
+        # An AsyncioBackend object, if git commands are run through it
+        # rather than through GitPython
+        self.git_backend = None
+
+        # An Output object to which the lines git writes to standard
+        # error are sent as they are produced, if the backend allows
+        self.progress = None
+
+        # The branch to return to after "install_branch()", if
+        # "update()" left the desired branch checked out for it
+        self.saved_branch = None
 
         self.directory = os.path.join(self.basedir, name)
 
+        # A StateStore object, if one is in use
+        self.state = None
+
+        # If True, the number of bytes fetched will be measured
+        self.measure_fetch = False
+
+        # A HostLimiter object, if concurrent network operations on
+        # each host are limited
+        self.host_limiter = None
+
+        # Options to add to the ssh command, to share connections
+        self.ssh_options = None
+
+        # Resource limits for expensive git commands: a command prefix,
+        # such as "nice", and git configuration overrides
+        self.command_prefix = []
+        self.git_config = {}
+
+        # Filled in as the repository is acted upon
+        self.timings = {}
+        self.start_sha = None
+        self.end_sha = None
+        self.fetched_bytes = None
+
         self._handle = None
+        self._refs = None
+        self._hosts = {}
 
     def freshen(self, output):
         """
@@ -99,149 +934,2280 @@ class Repo(object):
                        will be sent.
         """
 
-        with with_branch(output, self, self.branch):
-            self.git_fetch(output)
-            self.git_pull(output)
-            self.git_push(output)
-            self.install(output)
+        self.update(output, install=True)
 
-    def get_current_branch(self):
+    def update(self, output, install=False, keep_branch=False):
         """
-        Returns the current branch for this repository.
+        Updates the desired branch from the configured remote and
+        pushes it to the configured push remote; these are the stages
+        of a freshen which require network access.
 
-        :returns: The name of the current branch.
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        :param install: If True, the repository will also be
+                        installed, while the desired branch is still
+                        checked out.
+        :param keep_branch: If True, and the repository is to be
+                            installed, the desired branch is left
+                            checked out, so "install_branch()" need
+                            not check it out again.
         """
 
-        for branch in self.handle.branch().split('\n'):
-            if branch.startswith('*'):
-                return branch[2:]
+        ref = 'refs/heads/%s' % self.branch
+        self.start_sha = self.get_sha(ref)
 
-    def git_checkout(self, output, branch):
+        with self.streaming(output):
+            if self.mirror and os.path.isdir(self.mirror):
+                self.add_alternate(output)
+
+            if (self.no_checkout and
+                    self.get_current_branch() != self.branch):
+                # Update the branch in place, without a checkout
+                self.git_fetch(output)
+                self.git_fast_forward(output)
+                self.git_push(output)
+                if install:
+                    self.install_worktree(output)
+            else:
+                keep = keep_branch and bool(self.install_mode)
+                with with_branch(output, self, self.branch,
+                                 restore=not keep) as save_branch:
+                    self.git_fetch(output)
+                    if self.fetch_depth:
+                        self.git_reset(output)
+                    elif self.single_fetch:
+                        self.git_merge(output)
+                    else:
+                        self.git_pull(output)
+                    self.git_push(output)
+                    if install:
+                        self.install(output)
+                if keep:
+                    self.saved_branch = save_branch
+
+        self.end_sha = self.get_sha(ref)
+
+    @contextlib.contextmanager
+    def streaming(self, output):
+        """
+        A contextmanager method which, if the backend allows, sends
+        the lines git writes to standard error to an output as they
+        are produced.
+
+        :param output: An Output object to which the lines will be
+                       sent.
+        """
+
+        saved, self.progress = self.progress, output
+        try:
+            yield
+        finally:
+            self.progress = saved
+
+    def send_progress(self, line):
+        """
+        Send a line git wrote to standard error to the output given to
+        "streaming()", if any.
+
+        :param line: The line.
+        """
+
+        output = self.progress
+        if output is not None:
+            output.send(line)
+
+    def install_branch(self, output):
+        """
+        Installs the repository according to the setting of
+        "install_mode", with the desired branch checked out.  This
+        completes a freshen begun by "update()"; if that left the
+        desired branch checked out, the original branch is checked
+        out again afterwards.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.install_mode:
+            return
+
+        with self.streaming(output):
+            saved_branch, self.saved_branch = self.saved_branch, None
+            if saved_branch is not None:
+                # "update()" left the desired branch checked out
+                try:
+                    self.install(output)
+                finally:
+                    if saved_branch != self.branch:
+                        output.send("Returning to original branch %s" %
+                                    saved_branch)
+                        self.git_checkout(output, saved_branch)
+                return
+
+            if (self.no_checkout and
+                    self.get_current_branch() != self.branch):
+                self.install_worktree(output)
+                return
+
+            with with_branch(output, self, self.branch):
+                self.install(output)
+
+    def install_worktree(self, output):
+        """
+        Installs the repository according to the setting of
+        "install_mode" from the dedicated worktree, with the desired
+        branch checked out there.  This allows the repository to be
+        installed without disturbing the main working tree.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.install_mode:
+            return
+
+        worktree = self.git_worktree(output)
+        self.install(output, worktree, 'refs/heads/%s' % self.branch)
+
+    def get_current_branch(self):
+        """
+        Returns the current branch for this repository.  The git
+        directory is read directly if possible, and "git branch" is
+        only run if it cannot be.
+
+        :returns: The name of the current branch, or the SHA of the
+                  checked out commit if HEAD is detached.
+        """
+
+        try:
+            return self.refs.head()
+        except (ValueError, EnvironmentError):
+            pass
+
+        for branch in self.handle.branch().split('\n'):
+            if branch.startswith('*'):
+                return branch[2:]
+
+    def get_sha(self, ref):
+        """
+        Returns the commit SHA a local ref refers to.
+
+        :param ref: The name of the ref.
+
+        :returns: The SHA, or None if the ref does not exist.
+        """
+
+        # Branches always refer to commits, so these may be read
+        # directly from the git directory
+        if ref == 'HEAD' or ref.startswith(('refs/heads/', 'refs/remotes/')):
+            try:
+                return self.refs.resolve(ref)
+            except (ValueError, EnvironmentError):
+                pass
+
+        try:
+            return self.handle.rev_parse('--verify', '--quiet',
+                                         '%s^{commit}' % ref)
+        except git.exc.GitCommandError:
+            return None
+
+    def get_remote_sha(self, remote):
+        """
+        Returns the commit SHA the desired branch refers to on a
+        remote.  This requires one network round-trip, but transfers
+        no objects.
+
+        :param remote: The name of the remote.
+
+        :returns: The SHA, or None if the branch does not exist on the
+                  remote.
+        """
+
+        ref = 'refs/heads/%s' % self.branch
+        with self.connection(remote):
+            refs = self.handle.ls_remote(remote, ref, **self.timeout)
+        for line in refs.splitlines():
+            sha, _sep, name = line.partition('\t')
+            if name == ref:
+                return sha
+
+        return None
+
+    @stage
+    def is_changed(self):
+        """
+        Determines whether the configured remote has changes which
+        have not yet been merged into the desired branch.  If no
+        remote is configured, the repository is always considered to
+        have changed.
+
+        :returns: True if the repository needs to be freshened, False
+                  otherwise.
+        """
+
+        if not self.pull:
+            return True
+
+        remote_sha = self.get_remote_sha(self.pull)
+        local_sha = self.get_sha('refs/heads/%s' % self.branch)
+        if remote_sha is None or local_sha is None:
+            return True
+        elif remote_sha == local_sha:
+            return False
+
+        # The branch may have local commits on top of the remote's
+        return not self.is_ancestor(remote_sha, local_sha)
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Determines whether one commit is an ancestor of another.
+
+        :param ancestor: The possible ancestor commit.
+        :param descendant: The possible descendant commit.
+
+        :returns: True if "ancestor" is an ancestor of, or the same as,
+                  "descendant", False otherwise.
+        """
+
+        try:
+            self.handle.merge_base('--is-ancestor', ancestor, descendant)
+        except git.exc.GitCommandError:
+            return False
+
+        return True
+
+    def git_checkout(self, output, branch):
+        """
+        Checks out the desired branch.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        :param branch: The branch to check out.
+        """
+
+        output.send(self.handle.checkout(branch))
+
+    @stage
+    def git_fetch(self, output):
+        """
+        Perform a "git fetch" operation from the configured remote, or
+        from "origin" if no remote is configured.  Unless refspecs are
+        configured, only the desired branch is fetched, into its
+        remote-tracking branch.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        remote = self.pull or 'origin'
+
+        args = []
+        if self.fetch_prune:
+            args.append('--prune')
+        if self.fetch_tags is not None:
+            args.append('--tags' if self.fetch_tags else '--no-tags')
+        if self.fetch_depth:
+            args.append('--depth=%d' % self.fetch_depth)
+        if self.fetch_filter:
+            # Also configures the remote to fetch omitted objects later
+            args.append('--filter=%s' % self.fetch_filter)
+        args.append(remote)
+        if self.fetch_refspec is None:
+            args.append('+refs/heads/%s:%s' %
+                        (self.branch, self.tracking_ref(remote)))
+        else:
+            args.extend(self.fetch_refspec.split())
+
+        output.send("Fetching changes from %s" % remote)
+        before = self.get_object_bytes() if self.measure_fetch else None
+        with self.connection(remote):
+            output.send(self.handle.fetch(*args, **self.timeout))
+        if before is not None:
+            after = self.get_object_bytes()
+            if after is not None:
+                # An automatic gc may shrink the object store
+                self.fetched_bytes = max(after - before, 0)
+
+    @stage
+    def git_pull(self, output):
+        """
+        Perform a "git pull" operation from the configured remote.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.pull:
+            return
+
+        output.send("Pulling in changes from %s" % self.pull)
+        with self.connection(self.pull):
+            output.send(self.handle.pull(self.pull, self.branch,
+                                         **self.timeout))
+
+    @stage
+    def git_merge(self, output):
+        """
+        Perform a "git merge" operation from the ref updated with the
+        desired branch by "git_fetch()".  No network access is
+        performed.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.pull:
+            return
+
+        output.send("Merging in changes from %s" % self.pull)
+        output.send(self.handle.merge(self.fetched_ref(self.pull)))
+
+    @stage
+    def git_reset(self, output):
+        """
+        Reset the desired branch, which must be checked out, to the ref
+        updated with it by "git_fetch()".  This is used instead of a
+        merge for shallow repositories, since a shallow fetch cuts the
+        new commits off from the history already present.  Local
+        commits on the branch are discarded, but the reset fails
+        rather than discard uncommitted changes.  No network access is
+        performed.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.pull:
+            return
+
+        output.send("Resetting branch %s to %s" % (self.branch, self.pull))
+        output.send(self.handle.reset('--keep', self.fetched_ref(self.pull)))
+
+    @stage
+    def git_fast_forward(self, output):
+        """
+        Update the desired branch from the ref updated with it by
+        "git_fetch()", without checking the branch out.  If the branch
+        can be fast-forwarded, its ref is simply updated; otherwise,
+        the fetched ref is merged into it in the dedicated worktree.
+        For shallow repositories, the branch is instead always set to
+        the fetched ref, as by "git_reset()".  No network access is
+        performed.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.pull:
+            return
+
+        ref = 'refs/heads/%s' % self.branch
+        remote_ref = self.fetched_ref(self.pull)
+        old_sha = self.get_sha(ref)
+        new_sha = self.get_sha(remote_ref)
+
+        if self.fetch_depth and new_sha not in (None, old_sha):
+            output.send("Resetting branch %s to %s" % (self.branch, new_sha))
+            self.handle.update_ref('-m', 'freshen: reset', ref,
+                                   new_sha, old_sha or '')
+        elif new_sha is None or (old_sha is not None and
+                                 self.is_ancestor(new_sha, old_sha)):
+            output.send("Branch %s is up to date with %s" %
+                        (self.branch, self.pull))
+        elif old_sha is None or self.is_ancestor(old_sha, new_sha):
+            output.send("Fast-forwarding branch %s to %s" %
+                        (self.branch, new_sha))
+            # Giving the old value guards against concurrent updates
+            self.handle.update_ref('-m', 'freshen: fast-forward', ref,
+                                   new_sha, old_sha or '')
+        else:
+            worktree = self.git_worktree(output, self.branch)
+            handle = self.make_handle(worktree)
+            output.send("Merging in changes from %s in %s" %
+                        (self.pull, worktree))
+            try:
+                output.send(handle.merge('--no-edit', remote_ref))
+            except git.exc.GitCommandError:
+                # Leave the worktree clean for the next run
+                handle.merge('--abort', with_exceptions=False)
+                raise
+            finally:
+                # Release the branch, so it may be checked out again
+                handle.checkout('--detach')
+
+    def git_worktree(self, output, branch=None):
+        """
+        Prepare the dedicated worktree used to update and install the
+        desired branch without checking it out in the main working
+        tree.  The worktree is kept inside the git directory, and is
+        reused from run to run.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        :param branch: If given, the branch is checked out in the
+                       worktree, so that commits made there update
+                       it.  Otherwise, the desired branch is checked
+                       out with a detached HEAD.
+
+        :returns: The path of the worktree.
+        """
+
+        try:
+            gitdir = os.path.abspath(self.refs.gitdir)
+        except (ValueError, EnvironmentError):
+            gitdir = self.handle.rev_parse('--absolute-git-dir')
+        worktree = os.path.join(gitdir, 'freshen-worktree')
+        args = [branch] if branch else ['--detach',
+                                        'refs/heads/%s' % self.branch]
+
+        if os.path.isdir(worktree):
+            self.make_handle(worktree).checkout(*args)
+        else:
+            # Forget about the worktree if it has been removed
+            self.handle.worktree('prune')
+            output.send("Creating worktree %s" % worktree)
+            self.handle.worktree('add', worktree, *args)
+
+        return worktree
+
+    @stage
+    def git_push(self, output):
+        """
+        Perform a "git push" operation to the configured remote.  The
+        push will be done with the "--force" flag, and only updates
+        the desired branch.  If the branch on the remote already
+        refers to the same commit, no push is done.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        if not self.push:
+            return
+
+        ref = 'refs/heads/%s' % self.branch
+        sha = self.get_sha(ref)
+        if sha is not None and sha == self.get_pushed_sha():
+            output.send("Branch %s is up to date on %s; skipping push" %
+                        (self.branch, self.push))
+            return
+
+        output.send("Pushing out changes to %s" % self.push)
+        with self.connection(self.push):
+            output.send(self.handle.push('--force', self.push,
+                                         '%s:%s' % (ref, ref),
+                                         **self.timeout))
+
+    def get_pushed_sha(self):
+        """
+        Determine the commit SHA the desired branch refers to on the
+        push remote.  If that remote was just fetched from, its
+        remote-tracking branch is used; otherwise, the remote is
+        asked.
+
+        :returns: The SHA, or None if it could not be determined.
+        """
+
+        if self.push == (self.pull or 'origin') and self.fetch_refspec is None:
+            # "git_fetch()" just updated the remote-tracking branch
+            return self.get_sha(self.tracking_ref(self.push))
+
+        try:
+            return self.get_remote_sha(self.push)
+        except git.exc.GitCommandError:
+            # Let the push report any problem with the remote
+            return None
+
+    @stage
+    def update_mirror(self, output):
+        """
+        Create or update the mirror of the upstream repository.  All
+        refs are fetched, but none are pruned, even if the user's git
+        configuration sets "fetch.prune", since repositories borrowing
+        objects from the mirror may rely on them.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        remote = self.pull or 'origin'
+        with self.streaming(output):
+            if os.path.isdir(self.mirror):
+                output.send("Updating mirror %s" % self.mirror)
+                with self.connection(remote):
+                    output.send(self.make_handle(self.mirror).fetch(
+                        '--no-prune', 'origin', **self.timeout))
+                return
+
+            url = self.handle.ls_remote('--get-url', remote)
+            output.send("Creating mirror %s from %s" % (self.mirror, url))
+            with self.connection(remote):
+                output.send(self.make_handle(self.basedir).clone(
+                    '--mirror', url, self.mirror, **self.timeout))
+
+            # Objects borrowed from the mirror must never be pruned
+            self.make_handle(self.mirror).config('gc.pruneExpire', 'never')
+
+    def add_alternate(self, output):
+        """
+        Ensure the repository borrows objects from the mirror, by
+        listing the mirror's object directory in the repository's
+        alternates file.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        objects = os.path.join(self.mirror, 'objects')
+        try:
+            path = os.path.join(self.refs.commondir, 'objects', 'info',
+                                'alternates')
+        except (ValueError, EnvironmentError):
+            path = os.path.join(self.directory, self.handle.rev_parse(
+                '--git-path', 'objects/info/alternates'))
+
+        try:
+            with open(path) as f:
+                alternates = f.read().splitlines()
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            alternates = []
+
+        if objects in alternates:
+            return
+
+        output.send("Borrowing objects from mirror %s" % self.mirror)
+        with open(path, 'a') as f:
+            f.write('%s\n' % objects)
+
+    @contextlib.contextmanager
+    def connection(self, remote):
+        """
+        A contextmanager method which limits the number of network
+        operations performed at once on the host of a remote, if a
+        host limiter is in use.
+
+        :param remote: The name or URL of the remote.
+        """
+
+        if self.host_limiter is None:
+            yield
+            return
+
+        # Apply any "insteadOf" rewriting to find the actual host; this
+        # takes a git command, so it is only done once for each remote
+        if remote not in self._hosts:
+            self._hosts[remote] = url_host(
+                self.handle.ls_remote('--get-url', remote))
+        with self.host_limiter.acquire(self._hosts[remote]):
+            yield
+
+    @stage
+    def install(self, output, directory=None, ref='HEAD'):
+        """
+        Install the repository according to the configured install
+        mode.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        :param directory: The directory to install from.  Defaults to
+                          the repository directory.
+        :param ref: The ref checked out in that directory.
+        """
+
+        if not self.install_mode:
+            return
+
+        install_hash = None
+        if self.install_cache and self.state:
+            install_hash = self.get_install_hash(directory, ref)
+            if install_hash == self.state.get_value(self.directory,
+                                                    'install_hash'):
+                output.send("Repository %s unchanged since last install; "
+                            "skipping install" % self.name)
+                return
+
+        cmd = ['sudo', 'python', 'setup.py', self.install_mode]
+        output.send("Installing repository %s with command %r" %
+                    (self.name, ' '.join(cmd)))
+
+        install = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=directory or self.directory)
+        returncode = stream_process(output, install)
+
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, ' '.join(cmd))
+
+        if install_hash:
+            self.state.set_value(self.directory, 'install_hash',
+                                 install_hash)
+
+    def get_install_hash(self, directory=None, ref='HEAD'):
+        """
+        Computes a hash of everything which affects the result of
+        installing the repository: the install mode, the contents of
+        the files listed in "install_files", and either the directory
+        installed from, if the install mode is "develop", or else the
+        SHA of the checked out commit.
+
+        :param directory: The directory to be installed from.
+                          Defaults to the repository directory.
+        :param ref: The ref checked out in that directory.
+
+        :returns: The hash, as a hexadecimal string.
+        """
+
+        digest = hashlib.sha1()
+        digest.update('mode %s\0' % self.install_mode)
+        if self.install_mode == 'develop':
+            # The installed package refers to the directory itself
+            digest.update('directory %s\0' % (directory or self.directory))
+        else:
+            digest.update('head %s\0' % self.get_sha(ref))
+
+        filenames = set()
+        for pattern in self.install_files:
+            filenames.update(glob.glob(os.path.join(
+                directory or self.directory, pattern)))
+
+        for filename in sorted(filenames):
+            with open(filename, 'rb') as f:
+                contents = f.read()
+            digest.update('file %s %d\0' %
+                          (os.path.basename(filename), len(contents)))
+            digest.update(contents)
+
+        return digest.hexdigest()
+
+    @stage
+    def git_gc(self, output):
+        """
+        Perform a "git gc" operation.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        output.send(self.run_limited('gc'))
+
+    @stage
+    def git_maintenance(self, output):
+        """
+        Perform incremental maintenance, using "git maintenance run",
+        as a cheaper alternative to "git gc".  Loose objects are
+        consolidated into a pack and the commit-graph is updated; then,
+        if the repository has any packs, small packs are repacked
+        together and the multi-pack-index is written.
+
+        :param output: An Output object to which the command outputs
+                       will be sent.
+        """
+
+        output.send(self.run_limited('maintenance', 'run',
+                                     '--task=loose-objects',
+                                     '--task=commit-graph'))
+
+        # The incremental-repack task fails if there are no packs
+        if self.count_objects().get('packs', 0):
+            output.send(self.run_limited('maintenance', 'run',
+                                         '--task=incremental-repack'))
+
+    def run_limited(self, command, *args):
+        """
+        Run a git command subject to the configured resource limits.
+        The command is run under the command prefix, if any, and with
+        the configured git configuration overrides.
+
+        :param command: The git command to run, e.g., "gc".
+        :param args: The arguments for the command.
+
+        :returns: The output of the command.
+        """
+
+        if not self.command_prefix and not self.git_config:
+            return getattr(self.handle, command.replace('-', '_'))(*args)
+
+        cmd = list(self.command_prefix)
+        cmd.append(git.Git.GIT_PYTHON_GIT_EXECUTABLE)
+        for key, value in sorted(self.git_config.items()):
+            cmd.extend(['-c', '%s=%s' % (key, value)])
+        cmd.append(command)
+        cmd.extend(args)
+
+        return self.handle.execute(cmd)
+
+    def needs_gc(self):
+        """
+        Determine whether the repository needs to be compacted, based
+        on the number of loose objects and packs it contains.
+
+        :returns: A tuple of a boolean, which will be True if the
+                  repository has reached either the loose object or
+                  the pack threshold, and a string describing why.
+        """
+
+        stats = self.count_objects()
+        loose = stats.get('count', 0)
+        packs = stats.get('packs', 0)
+
+        if loose >= self.gc_loose_threshold:
+            return True, ("%d loose objects (threshold %d)" %
+                          (loose, self.gc_loose_threshold))
+        elif packs >= self.gc_pack_threshold:
+            return True, ("%d packs (threshold %d)" %
+                          (packs, self.gc_pack_threshold))
+
+        return False, ("%d loose objects (threshold %d), %d packs "
+                       "(threshold %d)" %
+                       (loose, self.gc_loose_threshold,
+                        packs, self.gc_pack_threshold))
+
+    def count_objects(self):
+        """
+        Retrieve statistics about the object store of the repository,
+        as reported by "git count-objects -v".  Sizes are in KiB.
+
+        :returns: A dictionary mapping the statistic names, such as
+                  "count" or "size-pack", to their integer values.
+        """
+
+        stats = {}
+        for line in self.handle.count_objects('-v').splitlines():
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            try:
+                stats[key.strip()] = int(value)
+            except ValueError:
+                continue
+
+        return stats
+
+    def get_object_bytes(self):
+        """
+        Determine the total size of the object store of the
+        repository, including both loose and packed objects.
+
+        :returns: The size in bytes, or None if it cannot be
+                  determined, e.g., if the repository does not exist.
+        """
+
+        try:
+            stats = self.count_objects()
+        except (git.exc.GitCommandError, git.exc.GitCommandNotFound,
+                EnvironmentError):
+            # Git cannot even be run without the repository directory
+            return None
+
+        return (stats.get('size', 0) + stats.get('size-pack', 0)) * 1024
+
+    def tracking_ref(self, remote):
+        """
+        Determine the remote-tracking ref for the desired branch.
+
+        :param remote: The name of the remote.
+
+        :returns: The full name of the remote-tracking ref.
+        """
+
+        return 'refs/remotes/%s/%s' % (remote, self.branch)
+
+    def fetched_ref(self, remote):
+        """
+        Determine the local ref "git_fetch()" stores the desired branch
+        in.  Unless refspecs are configured, this is the
+        remote-tracking ref; otherwise, it is the destination of the
+        first refspec matching the branch.
+
+        :param remote: The name of the remote.
+
+        :returns: The full name of the ref.
+        """
+
+        if self.fetch_refspec is None:
+            return self.tracking_ref(remote)
+
+        if self.fetch_refspec:
+            refspecs = self.fetch_refspec.split()
+        else:
+            try:
+                refspecs = self.handle.config(
+                    '--get-all', 'remote.%s.fetch' % remote).split()
+            except git.exc.GitCommandError:
+                refspecs = []
+
+        branch = 'refs/heads/%s' % self.branch
+        for refspec in refspecs:
+            src, _sep, dst = refspec.lstrip('+').partition(':')
+            if not dst or src.startswith('^'):
+                # Nothing is stored, or the refspec is negative
+                continue
+
+            if '*' not in src:
+                if src in (self.branch, 'heads/%s' % self.branch, branch):
+                    return dst
+                continue
+
+            prefix, _sep, suffix = src.partition('*')
+            if (branch.startswith(prefix) and branch.endswith(suffix) and
+                    len(branch) >= len(prefix) + len(suffix)):
+                match = branch[len(prefix):len(branch) - len(suffix)]
+                return dst.replace('*', match, 1)
+
+        raise ValueError("The fetch refspecs for %s do not store branch %s" %
+                         (remote, self.branch))
+
+    @property
+    def refs(self):
+        """
+        Retrieve a RefReader for the repository.
+        """
+
+        if self._refs is None:
+            self._refs = RefReader(self.directory)
+
+        return self._refs
+
+    def make_handle(self, directory):
+        """
+        Construct a handle for running git commands, using the
+        configured backend.
+
+        :param directory: The directory in which to run the commands.
+
+        :returns: A "git.Git" object, or an AsyncGit object if an
+                  AsyncioBackend is in use.
+        """
+
+        if self.git_backend is not None:
+            handle = AsyncGit(directory, self.git_backend,
+                              self.send_progress)
+        else:
+            handle = git.Git(directory)
+
+        if self.ssh_options:
+            handle.update_environment(
+                GIT_SSH_COMMAND=self.ssh_command(handle))
+
+        return handle
+
+    def ssh_command(self, handle):
+        """
+        Construct the ssh command git should use to share connections.
+        The options are added to the command the user has chosen,
+        which is taken, as git does, from the "GIT_SSH_COMMAND"
+        environment variable, the "core.sshCommand" configuration, or
+        the "GIT_SSH" environment variable, in that order.
+
+        :param handle: A handle for running git commands.
+
+        :returns: The ssh command, suitable for "GIT_SSH_COMMAND".
+        """
+
+        command = os.environ.get('GIT_SSH_COMMAND')
+        if not command:
+            command = handle.config('--get', 'core.sshCommand',
+                                    with_exceptions=False).strip()
+        if not command and os.environ.get('GIT_SSH'):
+            # Unlike the others, this is a program, not a command
+            command = pipes.quote(os.environ['GIT_SSH'])
+
+        return '%s %s' % (command or 'ssh', self.ssh_options)
+
+    @property
+    def timeout(self):
+        """
+        Retrieve the keyword arguments limiting the time a git command
+        accessing the network may run, for passing to the command.
+        """
+
+        if self.git_timeout is None:
+            return {}
+
+        return {'kill_after_timeout': self.git_timeout}
+
+    @property
+    def handle(self):
+        """
+        Retrieve a handle for running git commands in the repository.
+        """
+
+        if self._handle is None:
+            self._handle = self.make_handle(self.directory)
+        return self._handle
+
+
+class StateStore(object):
+    """
+    A persistent record of the state of repositories across runs,
+    kept in a SQLite database.  Each run of a command is recorded,
+    along with the outcome of the run for each repository, the SHA
+    of the desired branch before and after the run, and the time
+    taken by each stage.  Arbitrary values, such as the hash of the
+    last install, may also be stored for each repository.
+    Repositories are identified by their directory.  A StateStore
+    may be used from several threads at once.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            run_id INTEGER NOT NULL REFERENCES runs (id),
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            error TEXT,
+            start_sha TEXT,
+            end_sha TEXT,
+            finished REAL NOT NULL,
+            PRIMARY KEY (run_id, directory)
+        );
+        CREATE TABLE IF NOT EXISTS stages (
+            run_id INTEGER NOT NULL REFERENCES runs (id),
+            directory TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            duration REAL NOT NULL,
+            PRIMARY KEY (run_id, directory, stage)
+        );
+        CREATE INDEX IF NOT EXISTS results_directory
+            ON results (directory, finished);
+        CREATE TABLE IF NOT EXISTS repo_values (
+            directory TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (directory, key)
+        );
+    """
+
+    def __init__(self, filename, command):
+        """
+        Initialize a StateStore object.
+
+        :param filename: The database file name.  If None or empty,
+                         nothing will be recorded.
+        :param command: The name of the command being run, e.g.,
+                        "freshen".
+        """
+
+        self.filename = filename
+        self.command = command
+        self.db = None
+        self.run_id = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        """
+        Opens the database and records the start of a run upon entry
+        to a "with" statement.
+
+        :returns: The StateStore object.
+        """
+
+        if self.filename:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+            with self.db:
+                self.db.executescript(self.schema)
+                cursor = self.db.execute(
+                    "INSERT INTO runs (command, started) VALUES (?, ?)",
+                    (self.command, time.time()))
+                self.run_id = cursor.lastrowid
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Records the end of the run and closes the database upon exit
+        from a "with" statement.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        if self.db is None:
+            return
+
+        with self.lock:
+            with self.db:
+                self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                                (time.time(), self.run_id))
+            self.db.close()
+            self.db = None
+
+    def record(self, repo, outcome, error=None):
+        """
+        Record the outcome of the run for a repository.
+
+        :param repo: The Repo object acted upon.
+        :param outcome: A string describing the outcome, such as
+                        "succeeded", "failed", or "skipped".
+        :param error: The exception which caused the failure, if
+                      any.
+        """
+
+        if self.db is None:
+            return
+
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO results (run_id, directory, "
+                    "name, outcome, error, start_sha, end_sha, finished) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.run_id, repo.directory, repo.name, outcome,
+                     None if error is None else str(error),
+                     repo.start_sha, repo.end_sha, time.time()))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO stages (run_id, directory, "
+                    "stage, duration) VALUES (?, ?, ?, ?)",
+                    [(self.run_id, repo.directory, name, duration)
+                     for name, duration in sorted(repo.timings.items())])
+
+    def last_result(self, directory):
+        """
+        Retrieve the most recent recorded result of the command for a
+        repository.  This is used by incremental freshens to retry
+        repositories whose last freshen failed.
+
+        :param directory: The directory of the repository.
+
+        :returns: A dictionary describing the result, including the
+                  "outcome", "error", "start_sha", "end_sha", and
+                  "finished" time, or None if no result has been
+                  recorded.
+        """
+
+        if self.db is None:
+            return None
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT results.outcome, results.error, results.start_sha, "
+                "results.end_sha, results.finished FROM results "
+                "JOIN runs ON runs.id = results.run_id "
+                "WHERE results.directory = ? AND runs.command = ? "
+                "ORDER BY results.finished DESC LIMIT 1",
+                (directory, self.command)).fetchone()
+        if row is None:
+            return None
+
+        return dict(zip(('outcome', 'error', 'start_sha', 'end_sha',
+                         'finished'), row))
+
+    def get_value(self, directory, key):
+        """
+        Retrieve a value stored for a repository.
+
+        :param directory: The directory of the repository.
+        :param key: The name of the value.
+
+        :returns: The value, or None if it has not been stored.
+        """
+
+        if self.db is None:
+            return None
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM repo_values "
+                "WHERE directory = ? AND key = ?",
+                (directory, key)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_value(self, directory, key, value):
+        """
+        Store a value for a repository, replacing any previously
+        stored value.
+
+        :param directory: The directory of the repository.
+        :param key: The name of the value.
+        :param value: The value to store.
+        """
+
+        if self.db is None:
+            return
+
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO repo_values "
+                    "(directory, key, value) VALUES (?, ?, ?)",
+                    (directory, key, value))
+
+
+def percentile(values, pct):
+    """
+    Compute a percentile of a list of values, using the nearest-rank
+    method.
+
+    :param values: A list of numbers.
+    :param pct: The desired percentile, between 0 and 100.
+
+    :returns: The percentile, or None if the list is empty.
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class RunReport(object):
+    """
+    A machine-readable report of a run.  The outcome and the time
+    taken by each stage are collected for each repository, and
+    written as JSON, along with a summary of the time taken by each
+    stage across all repositories, upon exit from a "with"
+    statement.
+    """
+
+    def __init__(self, filename, command):
+        """
+        Initialize a RunReport object.
+
+        :param filename: The report file name.  If None or empty, no
+                         report will be written.
+        :param command: The name of the command being run, e.g.,
+                        "freshen".
+        """
+
+        self.filename = filename
+        self.command = command
+        self.started = None
+        self.repos = []
+
+    def __enter__(self):
+        """
+        Records the start of the run upon entry to a "with" statement.
+
+        :returns: The RunReport object.
+        """
+
+        self.started = time.time()
+        self.repos = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Writes the report upon exit from a "with" statement.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        if not self.filename:
+            return
+
+        with open(self.filename, 'w') as f:
+            json.dump(self.render(time.time()), f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+
+    def record(self, repo, outcome, error=None):
+        """
+        Record the outcome of the run for a repository.
+
+        :param repo: The Repo object acted upon.
+        :param outcome: A string describing the outcome, such as
+                        "succeeded", "failed", or "skipped".
+        :param error: The exception which caused the failure, if
+                      any.
+        """
+
+        if not self.filename:
+            return
+
+        self.repos.append({
+            'name': repo.name,
+            'directory': repo.directory,
+            'outcome': outcome,
+            'error': None if error is None else str(error),
+            'start_sha': repo.start_sha,
+            'end_sha': repo.end_sha,
+            'stages': dict(repo.timings),
+            'duration': sum(repo.timings.values()),
+        })
+
+    def render(self, finished):
+        """
+        Render the report.
+
+        :param finished: The time at which the run finished.
+
+        :returns: A dictionary containing the report.
+        """
+
+        outcomes = {}
+        timings = {}
+        for result in self.repos:
+            outcomes[result['outcome']] = (
+                outcomes.get(result['outcome'], 0) + 1)
+            for name, duration in result['stages'].items():
+                timings.setdefault(name, []).append(duration)
+
+        # The time taken by a repository as a whole is summarized too
+        durations = [result['duration'] for result in self.repos
+                     if result['stages']]
+        if durations:
+            timings['total'] = durations
+
+        summary = {}
+        for name, values in timings.items():
+            summary[name] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': max(values),
+            }
+
+        return {
+            'command': self.command,
+            'started': self.started,
+            'finished': finished,
+            'duration': finished - self.started,
+            'outcomes': outcomes,
+            'repos': self.repos,
+            'stages': summary,
+        }
+
+
+class Recorders(object):
+    """
+    Pass the outcome of a run for each repository on to several
+    recorders, such as a StateStore and a RunReport.  Upon entry to
+    and exit from a "with" statement, all of the recorders are
+    entered or exited as well.
+    """
+
+    def __init__(self, *recorders):
+        """
+        Initialize a Recorders object.
+
+        :param recorders: The recorders.  Each must support the
+                          context manager protocol and have a
+                          "record()" method.
+        """
+
+        self.recorders = recorders
+
+    def __enter__(self):
+        """
+        Enters each of the recorders upon entry to a "with"
+        statement.  Should one of them fail, those already entered
+        are exited before the exception is raised.
+
+        :returns: The Recorders object.
+        """
+
+        entered = []
+        try:
+            for recorder in self.recorders:
+                recorder.__enter__()
+                entered.append(recorder)
+        except Exception:
+            self._exit(entered, *sys.exc_info())
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Exits each of the recorders, in reverse order, upon exit from
+        a "with" statement.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        self._exit(self.recorders, exc_type, exc_value, exc_tb)
+
+    @staticmethod
+    def _exit(recorders, exc_type, exc_value, exc_tb):
+        """
+        Exit each of the given recorders, in reverse order.  Every
+        recorder is exited even if one of them fails; the exception
+        raised by the last to fail is passed on to those exited after
+        it, and is then raised.
+
+        :param recorders: The recorders to exit.
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        if not recorders:
+            return
+
+        try:
+            recorders[-1].__exit__(exc_type, exc_value, exc_tb)
+        except Exception:
+            Recorders._exit(recorders[:-1], *sys.exc_info())
+            raise
+
+        Recorders._exit(recorders[:-1], exc_type, exc_value, exc_tb)
+
+    def record(self, repo, outcome, error=None):
+        """
+        Record the outcome of the run for a repository with each of
+        the recorders.
+
+        :param repo: The Repo object acted upon.
+        :param outcome: A string describing the outcome, such as
+                        "succeeded", "failed", or "skipped".
+        :param error: The exception which caused the failure, if
+                      any.
+        """
+
+        for recorder in self.recorders:
+            recorder.record(repo, outcome, error)
+
+
+class MetricsExporter(object):
+    """
+    Export metrics describing a run in the Prometheus text format, for
+    collection by the textfile collector of the Prometheus node
+    exporter.  The metrics are written to a file named after the
+    command, e.g., "freshen.prom", in the configured directory upon
+    exit from a "with" statement.
+    """
+
+    # Upper bounds, in seconds, of the stage duration histogram buckets
+    buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+    # Outcomes which are always reported, even if no repository had
+    # that outcome
+    outcomes = ['succeeded', 'failed', 'skipped']
+
+    def __init__(self, directory, command):
+        """
+        Initialize a MetricsExporter object.
+
+        :param directory: The textfile collector directory.  If None
+                          or empty, no metrics will be written.
+        :param command: The name of the command being run, e.g.,
+                        "freshen".
+        """
+
+        self.directory = directory
+        self.command = command
+        self.started = None
+        self.results = []
+
+    @property
+    def filename(self):
+        """
+        Retrieve the name of the file the metrics will be written to.
+        """
+
+        if not self.directory:
+            return None
+
+        return os.path.join(self.directory, '%s.prom' % self.command)
+
+    def __enter__(self):
+        """
+        Records the start of the run upon entry to a "with" statement.
+
+        :returns: The MetricsExporter object.
+        """
+
+        self.started = time.time()
+        self.results = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Writes the metrics upon exit from a "with" statement.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        if not self.directory:
+            return
+
+        # Write to a temporary file and rename it into place, so the
+        # collector never sees a partially written file
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write(self.render(time.time()))
+        os.rename(tmpname, self.filename)
+
+    def record(self, repo, outcome, error=None):
+        """
+        Record the outcome of the run for a repository.
+
+        :param repo: The Repo object acted upon.
+        :param outcome: A string describing the outcome, such as
+                        "succeeded", "failed", or "skipped".
+        :param error: The exception which caused the failure, if
+                      any.
+        """
+
+        if not self.directory:
+            return
+
+        self.results.append((outcome, dict(repo.timings),
+                             repo.start_sha != repo.end_sha,
+                             repo.fetched_bytes or 0))
+
+    def render(self, finished):
+        """
+        Render the metrics.
+
+        :param finished: The time at which the run finished.
+
+        :returns: The metrics, as a string in the Prometheus text
+                  format.
+        """
+
+        label = 'command="%s"' % self.command
+        outcomes = dict((outcome, 0) for outcome in self.outcomes)
+        updated = 0
+        fetched = 0
+        timings = {}
+        for outcome, stages, changed, fetched_bytes in self.results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == 'succeeded' and changed:
+                updated += 1
+            fetched += fetched_bytes
+            for name, duration in stages.items():
+                timings.setdefault(name, []).append(duration)
+
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %r' %
+                             (name, suffix, labels, float(value)))
+
+        metric('freshen_run_duration_seconds', 'gauge',
+               'Time taken by the last run.',
+               [('', label, finished - self.started)])
+        metric('freshen_run_finished_timestamp_seconds', 'gauge',
+               'Time at which the last run finished.',
+               [('', label, finished)])
+        metric('freshen_repos', 'gauge',
+               'Number of repositories with each outcome in the last run.',
+               [('', '%s,outcome="%s"' % (label, outcome), outcomes[outcome])
+                for outcome in sorted(outcomes)])
+        metric('freshen_repos_updated', 'gauge',
+               'Number of repositories whose branch changed in the last '
+               'run.',
+               [('', label, updated)])
+        metric('freshen_fetched_bytes', 'gauge',
+               'Bytes added to the object stores by fetches in the last '
+               'run.',
+               [('', label, fetched)])
+
+        samples = []
+        for name in sorted(timings):
+            stage_label = '%s,stage="%s"' % (label, name)
+            values = timings[name]
+            for bound in self.buckets:
+                samples.append(('_bucket', '%s,le="%g"' % (stage_label, bound),
+                                len([v for v in values if v <= bound])))
+            samples.append(('_bucket', '%s,le="+Inf"' % stage_label,
+                            len(values)))
+            samples.append(('_sum', stage_label, sum(values)))
+            samples.append(('_count', stage_label, len(values)))
+        metric('freshen_stage_duration_seconds', 'histogram',
+               'Time taken by each stage for each repository in the last '
+               'run.', samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+class Journal(object):
+    """
+    An append-only journal of the repositories a run has finished
+    with, kept in a file named after the command and the repository
+    configuration file, e.g., "freshen-0123456789ab.journal", in the
+    configured directory, so that runs with different configurations
+    do not share a journal.  Each line of the
+    journal is a JSON object describing one repository, written as
+    soon as the repository is finished with.  If the run completes,
+    the journal is removed; if it is interrupted, the journal remains,
+    so that a later run may resume where it left off.
+    """
+
+    # Outcomes which need not be repeated when resuming
+    finished = ['succeeded', 'skipped']
+
+    def __init__(self, directory, command, repo_conf=None, resume=False):
+        """
+        Initialize a Journal object.
+
+        :param directory: The directory in which to keep the journal.
+                          If None or empty, no journal will be kept.
+        :param command: The name of the command being run, e.g.,
+                        "freshen".
+        :param repo_conf: The repository configuration file used by
+                          the run.  If None, the journal is named
+                          after the command alone.
+        :param resume: If True, an existing journal will be appended
+                       to rather than replaced.
+        """
+
+        self.directory = directory
+        self.command = command
+        self.repo_conf = repo_conf
+        self.resume = resume
+        self.journal = None
+        self.lock = threading.Lock()
+
+    @property
+    def filename(self):
+        """
+        Retrieve the name of the journal file.
+        """
+
+        if not self.directory:
+            return None
+
+        name = self.command
+        if self.repo_conf:
+            path = os.path.abspath(os.path.expanduser(self.repo_conf))
+            name = '%s-%s' % (name, hashlib.sha1(path).hexdigest()[:12])
+
+        return os.path.join(self.directory, '%s.journal' % name)
+
+    def completed(self):
+        """
+        Determine which repositories an interrupted run finished with.
+
+        :returns: A set of the directories of the repositories which
+                  need not be acted upon again.
+        """
+
+        directories = set()
+        if not self.filename or not os.path.exists(self.filename):
+            return directories
+
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The line was cut short by the interruption
+                    continue
+                if entry.get('outcome') in self.finished:
+                    directories.add(entry['directory'])
+
+        return directories
+
+    def __enter__(self):
+        """
+        Opens the journal upon entry to a "with" statement.
+
+        :returns: The Journal object.
+        """
+
+        if not self.directory:
+            return self
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        partial = False
+        if self.resume and os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    partial = f.read(1) != '\n'
+
+        self.journal = open(self.filename, 'a' if self.resume else 'w')
+
+        # Terminate a line cut short by the interruption, so that it
+        # does not swallow the first new entry
+        if partial:
+            self.journal.write('\n')
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Closes the journal upon exit from a "with" statement.  The
+        journal is removed unless the run was interrupted by an
+        exception.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        if self.journal is None:
+            return
+
+        with self.lock:
+            self.journal.close()
+            self.journal = None
+
+        if exc_type is None:
+            os.unlink(self.filename)
+
+    def record(self, repo, outcome, error=None):
+        """
+        Record that the run has finished with a repository.
+
+        :param repo: The Repo object acted upon.
+        :param outcome: A string describing the outcome, such as
+                        "succeeded", "failed", or "skipped".
+        :param error: The exception which caused the failure, if
+                      any.
+        """
+
+        if self.journal is None:
+            return
+
+        line = json.dumps({
+            'name': repo.name,
+            'directory': repo.directory,
+            'outcome': outcome,
+            'finished': time.time(),
+        }, sort_keys=True)
+
+        with self.lock:
+            self.journal.write('%s\n' % line)
+
+            # The journal must survive the process being killed
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+
+class Profiler(object):
+    """
+    Profile a run with cProfile.  Threads started while the profiler
+    is running, such as those running jobs, are profiled as well,
+    except for the threads writing the output and running the event
+    loop of the asyncio backend, which are idle most of the time.
+    Since a profiler can only be disabled by its own thread, the
+    profile of a thread is only included if the thread has finished
+    when profiling stops.  The time spent waiting on child processes,
+    such as git, is determined from the profile, to distinguish it
+    from time spent in Python.
+    """
+
+    # The subprocess.Popen methods which wait on a child process, by
+    # module and name
+    wait_funcs = set([
+        ('subprocess', 'communicate'),
+        ('subprocess', 'wait'),
+    ])
+
+    # The functions of this module which wait on a child process, by
+    # code object, so that no other function of the same name is
+    # counted: "stream_process()", which waits while threads read the
+    # output of the child, and "AsyncioBackend.run()", which waits
+    # while the event loop does
+    wait_codes = set([
+        cProfile.label(stream_process.__code__),
+        cProfile.label(AsyncioBackend.run.__code__),
+    ])
+
+    # The functions in which threads wait idly for work or for each
+    # other, which are left out of the report so as not to obscure
+    # the hotspots
+    idle_funcs = set([
+        ('Queue', 'get'),
+        ('threading', 'wait'),
+        ('~', '<time.sleep>'),
+    ])
+
+    # The names of the threads which are not profiled
+    ignore_threads = set(['freshen-output', 'freshen-git'])
+
+    def __init__(self, filename, top=20):
+        """
+        Initialize a Profiler object.
+
+        :param filename: The name of the file to which the profile
+                         data will be written, in the format read by
+                         the pstats module.
+        :param top: The number of functions to report, sorted by
+                    cumulative time.
+        """
+
+        self.filename = filename
+        self.top = top
+        self.profiler = None
+        self.thread_profilers = []
+        self.lock = threading.Lock()
+        self.started = None
+        self.elapsed = None
+        self.children = None
+
+    def _thread_hook(self, frame, event, arg):
+        """
+        Start profiling a new thread.  This is installed with
+        ``threading.setprofile()``, and is called for the first event
+        in each new thread; enabling a profiler replaces it.
+
+        :param frame: The current stack frame.
+        :param event: The profiling event.
+        :param arg: The argument for the event.
+        """
+
+        thread = threading.current_thread()
+        if thread.name in self.ignore_threads:
+            # Don't call the hook again for this thread
+            sys.setprofile(None)
+            return
+
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.thread_profilers.append((thread, profiler))
+        profiler.enable()
+
+    def start(self):
+        """
+        Start profiling.
+        """
+
+        self.thread_profilers = []
+        self.profiler = cProfile.Profile()
+        self.started = time.time()
+        times = os.times()
+        self.children = times[2] + times[3]
+
+        threading.setprofile(self._thread_hook)
+        self.profiler.enable()
+
+    def stop(self):
+        """
+        Stop profiling.  The profile data, including that of any
+        threads, is written to the file.
+
+        :returns: A pstats.Stats object containing the profile data.
+        """
+
+        self.profiler.disable()
+        threading.setprofile(None)
+
+        self.elapsed = time.time() - self.started
+        times = os.times()
+        self.children = times[2] + times[3] - self.children
+
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            for thread, profiler in self.thread_profilers:
+                # The profiler of a running thread is still collecting
+                if not thread.is_alive():
+                    stats.add(profiler)
+        stats.dump_stats(self.filename)
+
+        return stats
+
+    def child_wait(self, stats):
+        """
+        Determine the time spent waiting on child processes.  When
+        jobs are run in parallel, this may exceed the elapsed time.
+
+        :param stats: A pstats.Stats object containing the profile
+                      data.
+
+        :returns: The time, in seconds, spent in the functions
+                  which wait on a child process, excluding time
+                  counted by an outer call to another such function.
+        """
+
+        def is_wait(func):
+            return (func in self.wait_codes or
+                    self.matches(func, self.wait_funcs))
+
+        total = 0.0
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not is_wait(func):
+                continue
+            total += ct
+            for caller, caller_stats in callers.items():
+                if is_wait(caller):
+                    total -= caller_stats[3]
+
+        return total
+
+    @staticmethod
+    def matches(func, funcs):
+        """
+        Determine whether a function in the profile data is one of a
+        set of functions.
+
+        :param func: The function, as a tuple of the file name, the
+                     line number, and the function name.
+        :param funcs: A set of tuples of the module and the name of
+                      the functions.  Built-in functions have the
+                      module "~".
+
+        :returns: True if the function is in the set, False
+                  otherwise.
+        """
+
+        filename, line, name = func
+        module = os.path.splitext(os.path.basename(filename))[0]
+        return (module, name) in funcs
+
+    def report(self, stats, stream):
+        """
+        Report the results of profiling.
+
+        :param stats: A pstats.Stats object containing the profile
+                      data.  The idle functions are removed from it.
+        :param stream: The stream to which to write the report.
+        """
+
+        stream.write("Profile data written to %s\n" % self.filename)
+        stream.write("Elapsed time %.3fs; waiting on child processes "
+                     "%.3fs; child process CPU time %.3fs\n" %
+                     (self.elapsed, self.child_wait(stats), self.children))
+
+        for func in list(stats.stats):
+            if self.matches(func, self.idle_funcs):
+                del stats.stats[func]
+
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(self.top)
+
+
+def profile(args):
+    """
+    A processor for the console scripts which runs the command under
+    the profiler if the "--profile" option was given.  The hotspots
+    are reported on standard output once the command completes.
+
+    :param args: The parsed command line arguments.
+    """
+
+    if not getattr(args, 'profile', None):
+        return
+
+    profiler = Profiler(os.path.expanduser(args.profile), args.profile_top)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.report(profiler.stop(), sys.stdout)
+
+
+class HostLimiter(object):
+    """
+    Limit the number of operations performed at once on each remote
+    host.
+    """
+
+    def __init__(self, limit):
+        """
+        Initialize a HostLimiter object.
+
+        :param limit: The maximum number of operations to perform at
+                      once on any one host.
+        """
+
+        self.limit = limit
+
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @contextlib.contextmanager
+    def acquire(self, host):
+        """
+        A contextmanager method which waits until an operation may be
+        performed on a host.
+
+        :param host: The name of the host, or None for a local
+                     repository, which is not limited.
+        """
+
+        if host is None:
+            yield
+            return
+
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.Semaphore(self.limit)
+                self._semaphores[host] = semaphore
+
+        with semaphore:
+            yield
+
+
+class SSHMultiplexer(object):
+    """
+    Share SSH connections to each host among the git commands of a
+    run.  While active, it provides options which make ssh use master
+    connections whose control sockets are kept in a private
+    directory; the master connections are shut down when the run
+    completes.
+    """
+
+    def __init__(self, enabled=True, persist=60):
+        """
+        Initialize an SSHMultiplexer object.
+
+        :param enabled: If False, the SSHMultiplexer does nothing.
+        :param persist: The time, in seconds, an idle master connection
+                        is kept open.
+        """
+
+        self.enabled = enabled
+        self.persist = persist
+        self.directory = None
+
+    @property
+    def options(self):
+        """
+        Retrieve the options to add to the ssh command, or None if
+        connections are not being shared.
+        """
+
+        if self.directory is None:
+            return None
+
+        return ('-o ControlMaster=auto -o ControlPath=%s '
+                '-o ControlPersist=%d' %
+                (pipes.quote(os.path.join(self.directory, '%C')),
+                 self.persist))
+
+    def __enter__(self):
+        """
+        Begin sharing SSH connections.
+
+        :returns: The SSHMultiplexer object.
+        """
+
+        if self.enabled:
+            # Control socket paths are limited to about 100 characters
+            self.directory = tempfile.mkdtemp(prefix='freshen-ssh-')
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Stop sharing SSH connections, shutting down the master
+        connections.
+
+        :param exc_type: The type of the exception, if one was raised.
+        :param exc_value: The exception, if one was raised.
+        :param exc_tb: The traceback, if an exception was raised.
+        """
+
+        if self.directory is None:
+            return
+
+        with open(os.devnull, 'w') as devnull:
+            for path in sorted(os.listdir(self.directory)):
+                # The host is ignored, since the control path is given
+                subprocess.call(
+                    ['ssh', '-o', 'ControlPath=%s' %
+                     os.path.join(self.directory, path), '-O', 'exit',
+                     'freshen'],
+                    stdin=devnull, stdout=devnull, stderr=devnull)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+class Output(object):
+    """
+    A class to generate output to both a log file and to standard
+    output.  While the log file is open, messages are passed through
+    a bounded queue to a background thread, which writes them to the
+    log file and to standard output through buffered files, flushing
+    them periodically and when the log file is closed.  Should the
+    background thread stop, messages are written directly instead.
+    """
+
+    def __init__(self, logfile, queue_size=1024, flush_interval=1.0):
+        """
+        Initialize an Output object.
+
+        :param logfile: The log file name.
+        :param queue_size: The maximum number of pending calls to
+                           "send()".  Once this many are pending,
+                           "send()" will wait for the background thread
+                           to catch up.
+        :param flush_interval: The maximum time, in seconds, that
+                               output may remain unflushed.
+        """
+
+        self.logfile = logfile
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.log = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.writer = None
+        self.error = None
+        self.stdout_error = None
+        self.writer_error = None
+
+    def __enter__(self):
+        """
+        Opens the log file and starts the background thread upon entry
+        to a "with" statement.
+
+        :returns: The Output object.
+        """
+
+        self.log = open(self.logfile, 'a')
+        self.queue = Queue.Queue(self.queue_size)
+        self.error = None
+        self.stdout_error = None
+        self.writer_error = None
+        self.writer = threading.Thread(target=self._writer,
+                                       name='freshen-output')
+        self.writer.daemon = True
+        self.writer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Waits for all pending messages to be written, then closes the
+        log file upon exit from a "with" statement.  This is done even
+        if an exception occurred, so no messages are lost.
+
+        :param exc_type: The type of the exception that occurred, or
+                         None.
+        :param exc_value: The actual exception that occurred, or None.
+        :param exc_tb: The traceback for the exception, or None.
+        """
+
+        self._put(self.queue, self.writer, None)
+        self.writer.join()
+
+        # Write anything left behind by a background thread which
+        # stopped unexpectedly
+        with self.lock:
+            self._drain(self.queue)
+        self._flush()
+
+        self.writer = None
+        self.queue = None
+
+        self.log.close()
+        self.log = None
+
+        # Report a failure to write the output, unless something
+        # else went wrong first
+        error = self.error or self.stdout_error or self.writer_error
+        if error is not None and exc_type is None:
+            raise error
+
+    def _put(self, queue, writer, item):
         """
-        Checks out the desired branch.
+        Pass an item to the background thread, waiting if the queue
+        is full, but only for as long as the thread is running.
 
-        :param output: An Output object to which the command outputs
-                       will be sent.
-        :param branch: The branch to check out.
+        :param queue: The queue.
+        :param writer: The background thread.
+        :param item: The item to pass.
+
+        :returns: True if the item was queued, or False if the
+                  background thread has stopped.
         """
 
-        output.send(self.handle.checkout(branch))
+        while writer.is_alive():
+            try:
+                queue.put(item, True, self.flush_interval)
+                return True
+            except Queue.Full:
+                pass
 
-    def git_fetch(self, output):
+        return False
+
+    def _drain(self, queue):
         """
-        Perform a "git fetch" operation from the default remote.
+        Write the messages pending in the queue of a background thread
+        which has stopped.  The lock must be held.
 
-        :param output: An Output object to which the command outputs
-                       will be sent.
+        :param queue: The queue.
         """
 
-        output.send("Fetching changes from origin")
-        output.send(self.handle.fetch())
+        while True:
+            try:
+                msgs = queue.get_nowait()
+            except Queue.Empty:
+                break
+            if msgs:
+                self._write(msgs)
 
-    def git_pull(self, output):
+    def _writer(self):
         """
-        Perform a "git pull" operation from the configured remote.
-
-        :param output: An Output object to which the command outputs
-                       will be sent.
+        The body of the background thread.  Writes messages from the
+        queue until told to stop, flushing the output if it is idle or
+        if it has gone unflushed for too long.
         """
 
-        if not self.pull:
-            return
+        try:
+            last_flush = time.time()
+            while True:
+                try:
+                    msgs = self.queue.get(True, self.flush_interval)
+                except Queue.Empty:
+                    msgs = []
 
-        output.send("Pulling in changes from %s" % self.pull)
-        output.send(self.handle.pull(self.pull, self.branch))
+                if msgs is None:
+                    break
 
-    def git_push(self, output):
-        """
-        Perform a "git push" operation to the configured remote.  The
-        push will be done with the "--force" flag.
+                self._write(msgs)
 
-        :param output: An Output object to which the command outputs
-                       will be sent.
-        """
+                now = time.time()
+                if not msgs or now - last_flush >= self.flush_interval:
+                    self._flush()
+                    last_flush = now
 
-        if not self.push:
-            return
+            self._flush()
+        except Exception as exc:
+            # Reported upon exit from the "with" statement
+            self.writer_error = exc
 
-        output.send("Pushing out changes to %s" % self.push)
-        output.send(self.handle.push('--force', self.push, self.branch))
+    def _write(self, msgs):
+        """
+        Write messages to the log file and to standard output.  A
+        failure to write to either is remembered, and stops further
+        writes to it, but not to the other.
 
-    def install(self, output):
+        :param msgs: A list of messages.
         """
-        Install the repository according to the configured install
-        mode.
 
-        :param output: An Output object to which the command outputs
-                       will be sent.
+        for msg in msgs:
+            if self.log and self.error is None:
+                try:
+                    self.log.write(msg)
+                except Exception as exc:
+                    self.error = exc
+            if self.stdout_error is None:
+                try:
+                    sys.stdout.write(msg)
+                except Exception as exc:
+                    self.stdout_error = exc
+
+    def _flush(self):
+        """
+        Flush the log file and standard output.
         """
 
-        if not self.install_mode:
-            return
+        if self.log and self.error is None:
+            try:
+                self.log.flush()
+            except Exception as exc:
+                self.error = exc
+        if self.stdout_error is None:
+            try:
+                sys.stdout.flush()
+            except Exception as exc:
+                self.stdout_error = exc
 
-        cmd = ['sudo', 'python', 'setup.py', self.install_mode]
-        output.send("Installing repository %s with command %r" %
-                    (self.name, ' '.join(cmd)))
+    def send(self, *msgs):
+        """
+        Send one or more messages to the log file and to standard
+        output.  Each positional argument is rendered independently,
+        and forced to be output with a trailing "\n".  Messages sent
+        in a single call will not be interleaved with messages sent
+        from other threads.
+        """
+
+        rendered = []
+        for msg in msgs:
+            if not msg:
+                continue
+            elif isinstance(msg, unicode):
+                # GitPython may return unicode, which the files would
+                # encode as ASCII
+                msg = msg.encode('utf-8')
+            if not msg.endswith('\n'):
+                msg += '\n'
+            rendered.append(msg)
 
-        install = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, cwd=self.directory)
-        out, err = install.communicate()
+        if not rendered:
+            return
 
-        if out:
-            output.send("Stdout:", out)
-        if err:
-            output.send("Stderr:", err)
+        queue, writer = self.queue, self.writer
+        if queue is not None and self._put(queue, writer, rendered):
+            return
 
-    def git_gc(self, output):
-        """
-        Perform a "git gc" operation.
+        with self.lock:
+            if queue is not None:
+                # Keep the messages in order
+                self._drain(queue)
+            self._write(rendered)
 
-        :param output: An Output object to which the command outputs
-                       will be sent.
+    def for_repo(self, name, max_lines=100):
         """
+        Construct an output for a single repository.  Messages sent to
+        it are prefixed with the repository name and buffered, then
+        sent to this Output as a unit, so that output from several
+        repositories being acted upon at once is not interleaved.
 
-        output.send(self.handle.gc())
+        :param name: The name of the repository.
+        :param max_lines: The maximum number of lines to buffer.
 
-    @property
-    def handle(self):
-        """
-        Retrieve a GitPython handle for the repository.
+        :returns: A RepoOutput object.
         """
 
-        if self._handle is None:
-            self._handle = git.Git(self.directory)
-        return self._handle
+        return RepoOutput(self, name, max_lines)
 
 
-class Output(object):
+class RepoOutput(object):
     """
-    A class to generate output to both a log file and to standard
-    output.
+    A class to buffer the output for a single repository.  Each line
+    is prefixed with the repository name, and the buffered lines are
+    sent to the underlying Output with a single call when the buffer
+    fills or is flushed.  May be used as the target of a "with"
+    statement, which flushes the buffer upon exit.
     """
 
-    def __init__(self, logfile):
+    def __init__(self, output, name, max_lines=100):
         """
-        Initialize an Output object.
+        Initialize a RepoOutput object.
 
-        :param logfile: The log file name.
+        :param output: The underlying Output object.
+        :param name: The name of the repository.
+        :param max_lines: The maximum number of lines to buffer.
         """
 
-        self.logfile = logfile
-        self.log = None
+        self.output = output
+        self.name = name
+        self.max_lines = max_lines
+        self.lines = []
+        self.lock = threading.Lock()
 
     def __enter__(self):
         """
-        Opens the log file upon entry to a "with" statement.
+        Upon entry to a "with" statement, returns the RepoOutput
+        object.
 
-        :returns: The Output object.
+        :returns: The RepoOutput object.
         """
 
-        self.log = open(self.logfile, 'a', 0)
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         """
-        Closes the log file upon exit from a "with" statement.
+        Flushes the buffer upon exit from a "with" statement.
 
         :param exc_type: The type of the exception that occurred, or
                          None.
@@ -249,25 +3215,46 @@ class Output(object):
         :param exc_tb: The traceback for the exception, or None.
         """
 
-        self.log.close()
-        self.log = None
+        self.flush()
 
     def send(self, *msgs):
         """
-        Send one or more messages to the log file and to standard
-        output.  Each positional argument is rendered independently,
-        and forced to be output with a trailing "\n".
+        Buffer one or more messages.  Each line of each message is
+        prefixed with the repository name.
         """
 
-        for msg in msgs:
-            if not msg:
-                continue
-            elif not msg.endswith('\n'):
-                msg += '\n'
+        prefix = '[%s] ' % self.name
+        with self.lock:
+            for msg in msgs:
+                if not msg:
+                    continue
+                elif isinstance(msg, unicode):
+                    # Install output arrives as bytes, so keep the
+                    # buffer to one type before joining it
+                    msg = msg.encode('utf-8')
+                for line in msg.splitlines():
+                    self.lines.append(prefix + line + '\n')
+
+            if len(self.lines) >= self.max_lines:
+                self._flush()
+
+    def flush(self):
+        """
+        Send all buffered lines to the underlying Output.
+        """
+
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        Send all buffered lines to the underlying Output.  The lock
+        must be held.
+        """
 
-            if self.log:
-                self.log.write(msg)
-            sys.stdout.write(msg)
+        if self.lines:
+            self.output.send(''.join(self.lines))
+            self.lines = []
 
 
 def get_repos(cfg, repo_list=None):
@@ -313,6 +3300,378 @@ def get_repos(cfg, repo_list=None):
     return repos
 
 
+def get_option(cfg, option, value=None, default=None):
+    """
+    Retrieve an option from the "[repos]" section of the repository
+    configuration.  A value given on the command line takes
+    precedence over the configuration.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param option: The name of the option to retrieve.
+    :param value: The value of the option given on the command line,
+                  or None if it was not given.
+    :param default: The value to return if the option was neither
+                    given on the command line nor configured.
+
+    :returns: The value of the option.
+    """
+
+    if value is not None:
+        return value
+
+    try:
+        return cfg.get('repos', option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+
+def run_jobs(repos, action, done, jobs=1):
+    """
+    Perform an action on each of a list of repositories.  If more
+    than one job is allowed, the action will be performed on several
+    repositories at once by a pool of worker threads.
+
+    :param repos: A list of Repo objects to act upon.
+    :param action: A callable to be called with each Repo object.
+    :param done: A callable to be called with each Repo object and
+                 the exception raised by the action, or None if the
+                 action succeeded.  This is always called from the
+                 calling thread, in the order in which the actions
+                 complete.
+    :param jobs: The maximum number of repositories to act upon at
+                 once.
+    """
+
+    if jobs <= 1 or len(repos) <= 1:
+        for repo in repos:
+            try:
+                action(repo)
+            except Exception as exc:
+                done(repo, exc)
+            else:
+                done(repo, None)
+        return
+
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+    for repo in repos:
+        pending.put(repo)
+
+    def worker():
+        while True:
+            try:
+                repo = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                action(repo)
+            except Exception as exc:
+                finished.put((repo, exc))
+            else:
+                finished.put((repo, None))
+
+    threads = []
+    for i in range(min(jobs, len(repos))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Use a timeout so that a KeyboardInterrupt can get through
+    remaining = len(repos)
+    while remaining:
+        try:
+            repo, exc = finished.get(True, 0.5)
+        except Queue.Empty:
+            continue
+
+        remaining -= 1
+        done(repo, exc)
+
+    # Everything is done; the workers exit once they find no more work
+    for thread in threads:
+        thread.join()
+
+
+def get_state(cfg, command):
+    """
+    Construct the StateStore for a command from the "state_db" option
+    of the "[repos]" section of the repository configuration.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param command: The name of the command being run.
+
+    :returns: A StateStore object.  If the option is set to an empty
+              value, nothing will be recorded.
+    """
+
+    filename = get_option(cfg, 'state_db', None, '~/.freshen.db')
+    if filename:
+        filename = os.path.expanduser(filename)
+
+    return StateStore(filename, command)
+
+
+def run_pipeline(repos, first, second, done, jobs=1):
+    """
+    Perform a two-stage action on each of a list of repositories.
+    The first stage is performed on several repositories at once by a
+    pool of worker threads; as each repository completes the first
+    stage, it is queued for the second stage, which is performed on
+    one repository at a time by a single thread.  This allows, for
+    instance, network operations to proceed in parallel while
+    installs, which cannot safely be run simultaneously, are
+    serialized, without waiting for all network operations to
+    complete first.
+
+    :param repos: A list of Repo objects to act upon.
+    :param first: A callable to be called with each Repo object to
+                  perform the first stage.
+    :param second: A callable to be called with each Repo object for
+                   which the first stage succeeded, to perform the
+                   second stage.
+    :param done: A callable to be called with each Repo object and
+                 the exception raised by either stage, or None if both
+                 stages succeeded.  This is always called from the
+                 calling thread, in the order in which the repositories
+                 complete.
+    :param jobs: The maximum number of repositories for which to
+                 perform the first stage at once.
+    """
+
+    def action(repo):
+        first(repo)
+        second(repo)
+
+    if jobs <= 1 or len(repos) <= 1:
+        run_jobs(repos, action, done)
+        return
+
+    pending = Queue.Queue()
+    waiting = Queue.Queue()
+    finished = Queue.Queue()
+    for repo in repos:
+        pending.put(repo)
+
+    def worker():
+        while True:
+            try:
+                repo = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                first(repo)
+            except Exception as exc:
+                finished.put((repo, exc))
+            else:
+                waiting.put(repo)
+
+    def finisher():
+        while True:
+            repo = waiting.get()
+            if repo is None:
+                return
+
+            try:
+                second(repo)
+            except Exception as exc:
+                finished.put((repo, exc))
+            else:
+                finished.put((repo, None))
+
+    threads = [threading.Thread(target=finisher)]
+    for i in range(min(jobs, len(repos))):
+        threads.append(threading.Thread(target=worker))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Use a timeout so that a KeyboardInterrupt can get through
+    remaining = len(repos)
+    while remaining:
+        try:
+            repo, exc = finished.get(True, 0.5)
+        except Queue.Empty:
+            continue
+
+        remaining -= 1
+        done(repo, exc)
+
+    # Everything is done; stop the second stage thread, and wait for
+    # it and the workers to exit, since the profile of a thread still
+    # running is dropped
+    waiting.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def get_report(cfg, report, command):
+    """
+    Construct the RunReport for a command.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param report: The report file name given on the command line, or
+                   None.  If None, the "report" option of the
+                   "[repos]" section of the configuration will be
+                   used.  Will be tilde-expanded.
+    :param command: The name of the command being run.
+
+    :returns: A RunReport object.  If no report file is given or
+              configured, no report will be written.
+    """
+
+    filename = get_option(cfg, 'report', report)
+    if filename:
+        filename = os.path.expanduser(filename)
+
+    return RunReport(filename, command)
+
+
+def get_metrics(cfg, metrics, command):
+    """
+    Construct the MetricsExporter for a command.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param metrics: The metrics directory given on the command line,
+                    or None.  If None, the "metrics" option of the
+                    "[repos]" section of the configuration will be
+                    used.  Will be tilde-expanded.
+    :param command: The name of the command being run.
+
+    :returns: A MetricsExporter object.  If no directory is given or
+              configured, no metrics will be written.
+    """
+
+    directory = get_option(cfg, 'metrics', metrics)
+    if directory:
+        directory = os.path.expanduser(directory)
+
+    return MetricsExporter(directory, command)
+
+
+def get_journal(cfg, command, repo_conf, resume=False):
+    """
+    Construct the Journal for a command from the "journal" option of
+    the "[repos]" section of the repository configuration.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param command: The name of the command being run.
+    :param repo_conf: The repository configuration file.
+    :param resume: If True, an interrupted run is being resumed.
+
+    :returns: A Journal object.  If the option is set to an empty
+              value, no journal will be kept.
+    """
+
+    directory = get_option(cfg, 'journal', None, '~/.freshen')
+    if directory:
+        directory = os.path.expanduser(directory)
+
+    return Journal(directory, command, repo_conf, resume)
+
+
+def resumable(output, repos, journal, verb):
+    """
+    Select the repositories an interrupted run did not finish with.
+
+    :param output: An Output object to which a message will be sent.
+    :param repos: A list of the Repo objects to act upon.
+    :param journal: The Journal of the interrupted run.
+    :param verb: The past tense of the command, for the message,
+                 e.g., "freshened".
+
+    :returns: A list of the Repo objects still to be acted upon.
+    """
+
+    completed = journal.completed()
+    todo = [repo for repo in repos if repo.directory not in completed]
+    output.send("Resuming interrupted run; %d repositories already %s" %
+                (len(repos) - len(todo), verb))
+
+    return todo
+
+
+def get_backend(cfg, backend):
+    """
+    Construct the AsyncioBackend for a command.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param backend: The backend given on the command line, either
+                    "gitpython" or "asyncio", or None.  If None, the
+                    "backend" option of the "[repos]" section of the
+                    configuration will be used.
+
+    :returns: An AsyncioBackend object.  Unless the "asyncio" backend
+              is selected, it is disabled, and git commands are run
+              through GitPython.
+    """
+
+    backend = get_option(cfg, 'backend', backend, 'gitpython')
+    if backend not in ('gitpython', 'asyncio'):
+        raise ValueError("Unknown backend %r" % backend)
+    elif backend == 'asyncio' and asyncio is None:
+        raise ValueError("The asyncio backend requires trollius")
+
+    return AsyncioBackend(backend == 'asyncio')
+
+
+def get_limits(cfg, nice=None, ionice=None, window_memory=None, jobs=1):
+    """
+    Determine the resource limits for compacting repositories.
+
+    :param cfg: A ConfigParser.ConfigParser instance containing the
+                configuration.
+    :param nice: The CPU niceness for the git commands.  If None, the
+                 "compact_nice" option of the "[repos]" section of the
+                 configuration will be used.
+    :param ionice: The I/O scheduling class for the git commands, as
+                   accepted by the "-c" option of "ionice".  If None,
+                   the "compact_ionice" option of the "[repos]"
+                   section of the configuration will be used.
+    :param window_memory: The maximum memory used by each thread for
+                          delta compression while packing, as accepted
+                          by the "pack.windowMemory" git
+                          configuration.  If None, the
+                          "compact_window_memory" option of the
+                          "[repos]" section of the configuration will
+                          be used.
+    :param jobs: The number of repositories being compacted at once.
+                 If more than one, the number of threads used for
+                 packing is limited so that the jobs together use no
+                 more threads than there are processors.
+
+    :returns: A tuple of a command prefix and a dictionary of git
+              configuration overrides, suitable for the
+              "command_prefix" and "git_config" attributes of a Repo
+              object.
+    """
+
+    prefix = []
+    nice = get_option(cfg, 'compact_nice', nice)
+    if nice:
+        prefix.extend(['nice', '-n', str(int(nice))])
+    ionice = get_option(cfg, 'compact_ionice', ionice)
+    if ionice:
+        prefix.extend(['ionice', '-c', ionice])
+
+    config = {}
+    window_memory = get_option(cfg, 'compact_window_memory', window_memory)
+    if window_memory:
+        config['pack.windowMemory'] = window_memory
+    if jobs > 1:
+        config['pack.threads'] = max(multiprocessing.cpu_count() // jobs, 1)
+
+    return prefix, config
+
+
 def prepare(repo_conf, logfile, restrict):
     """
     Prepare for either a "freshen" or "compact".  Loads the repository
@@ -327,23 +3686,20 @@ def prepare(repo_conf, logfile, restrict):
                      empty, all configured repositories will be
                      operated on.
 
-    :returns: A tuple of the list of Repo objects and the Output
-              object.
+    :returns: A tuple of the list of Repo objects, the Output object,
+              and the ConfigParser.ConfigParser instance containing
+              the configuration.
     """
 
     cfg = ConfigParser.SafeConfigParser()
     cfg.read(os.path.expanduser(repo_conf))
 
-    if logfile is None:
-        try:
-            logfile = cfg.get('repos', 'logfile')
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-            logfile = '~/freshen.log'
+    logfile = get_option(cfg, 'logfile', logfile, '~/freshen.log')
 
     repos = get_repos(cfg, restrict)
     output = Output(os.path.expanduser(logfile))
 
-    return repos, output
+    return repos, output, cfg
 
 
 @cli_tools.argument('restrict',
@@ -356,7 +3712,38 @@ def prepare(repo_conf, logfile, restrict):
 @cli_tools.argument('--logfile', '-l',
                     default=None,
                     help="Location of the log file, for output.")
-def freshen(repo_conf, logfile=None, restrict=None):
+@cli_tools.argument('--jobs', '-j',
+                    type=int,
+                    default=None,
+                    help="Number of repositories to freshen at once.")
+@cli_tools.argument('--incremental', '-i',
+                    action='store_true',
+                    default=None,
+                    help="Skip repositories with no upstream changes.")
+@cli_tools.argument('--report', '-r',
+                    default=None,
+                    help="Location of a JSON report of the run.")
+@cli_tools.argument('--metrics', '-m',
+                    default=None,
+                    help="Directory to write Prometheus metrics to.")
+@cli_tools.argument('--profile', '-p',
+                    default=None,
+                    help="Location of a file to write profile data to.")
+@cli_tools.argument('--profile-top',
+                    type=int,
+                    default=20,
+                    help="Number of functions to report when profiling.")
+@cli_tools.argument('--backend', '-b',
+                    choices=['gitpython', 'asyncio'],
+                    default=None,
+                    help="Backend used to run git commands.")
+@cli_tools.argument('--resume',
+                    action='store_true',
+                    default=False,
+                    help="Skip repositories an interrupted run finished.")
+def freshen(repo_conf, logfile=None, restrict=None, jobs=None,
+            incremental=None, report=None, metrics=None, backend=None,
+            resume=False):
     """
     Refresh a configured branch of a list of repositories to track
     their upstream.
@@ -368,16 +3755,173 @@ def freshen(repo_conf, logfile=None, restrict=None):
                     configured, a default will be used.
     :param restrict: Optional; a list of repositories that the freshen
                      operation should be restricted to.
+    :param jobs: The number of repositories to freshen at once.  If
+                 not provided, the value will be derived from the
+                 configuration.  If not configured, repositories will
+                 be freshened one at a time.
+    :param incremental: If True, the upstream of each repository will
+                        be checked first, and repositories with no
+                        upstream changes will not be freshened,
+                        unless their last freshen failed.  If not
+                        provided, the value will be derived from
+                        the configuration.  If not configured, all
+                        repositories will be freshened.
+    :param report: The name of a file to which a JSON report of the
+                   run will be written.  If not provided, the file
+                   will be derived from the configuration.  If not
+                   configured, no report will be written.
+    :param metrics: The directory, usually that of the node exporter
+                    textfile collector, to which Prometheus metrics
+                    describing the run will be written.  If not
+                    provided, the directory will be derived from the
+                    configuration.  If not configured, no metrics will
+                    be written.
+    :param backend: The backend used to run git commands: either
+                    "gitpython" or "asyncio".  If not provided, the
+                    value will be derived from the configuration.  If
+                    not configured, "gitpython" will be used.
+    :param resume: If True, repositories which an interrupted run
+                   finished with, according to its journal, will be
+                   skipped.
+
+    :returns: None if all repositories were freshened successfully,
+              otherwise a message describing the failures.
     """
 
-    repos, output = prepare(repo_conf, logfile, restrict)
+    repos, output, cfg = prepare(repo_conf, logfile, restrict)
+    try:
+        git_backend = get_backend(cfg, backend)
+    except ValueError as exc:
+        return str(exc)
+    jobs = int(get_option(cfg, 'jobs', jobs, 1))
+    incremental = to_bool(get_option(cfg, 'incremental', incremental, False))
+    state = get_state(cfg, 'freshen')
+    metrics = get_metrics(cfg, metrics, 'freshen')
+    journal = get_journal(cfg, 'freshen', repo_conf, resume)
+    recorders = Recorders(state, get_report(cfg, report, 'freshen'),
+                          metrics, journal)
+    multiplexer = SSHMultiplexer(
+        to_bool(get_option(cfg, 'ssh_multiplex', None, False)))
+    host_concurrency = int(get_option(cfg, 'host_concurrency', None, 0))
+    host_limiter = HostLimiter(host_concurrency) if host_concurrency else None
+    for repo in repos:
+        if git_backend.enabled:
+            repo.git_backend = git_backend
+        repo.state = state
+        repo.measure_fetch = bool(metrics.directory)
+        repo.host_limiter = host_limiter
+
+    changed = set()
+
+    def check(repo):
+        # Unless its last freshen is known to have succeeded, the
+        # repository is retried even if its upstream is unchanged
+        if state.filename:
+            last = state.last_result(repo.directory)
+            if last is None or last['outcome'] == 'failed':
+                changed.add(repo)
+                return
+
+        if repo.is_changed():
+            changed.add(repo)
+
+    def checked(repo, exc):
+        if exc is not None:
+            # Let the freshen report the problem
+            output.send("Unable to check repository %s: %s" %
+                        (repo.name, exc))
+            changed.add(repo)
+
+    # Output from a single job needn't be buffered
+    max_lines = 100 if jobs > 1 else 1
+
+    def action(repo):
+        with output.for_repo(repo.name, max_lines) as repo_output:
+            repo_output.send("Freshening repository %s..." % repo.name)
+            repo.freshen(repo_output)
+
+    def update(repo):
+        with output.for_repo(repo.name, max_lines) as repo_output:
+            repo_output.send("Freshening repository %s..." % repo.name)
+            repo.update(repo_output, keep_branch=True)
+
+    def install(repo):
+        with output.for_repo(repo.name, max_lines) as repo_output:
+            repo.install_branch(repo_output)
+
+    def update_mirror(repo):
+        with output.for_repo(repo.name, max_lines) as repo_output:
+            repo.update_mirror(repo_output)
+
+    def mirrored(repo, exc):
+        if exc is not None:
+            # The repositories will fetch everything themselves
+            output.send("Unable to update mirror %s: %s" %
+                        (repo.mirror, exc))
+
+    failed = []
+
+    def done(repo, exc):
+        if exc is None:
+            output.send("Repository %s freshened" % repo.name)
+            recorders.record(repo, 'succeeded')
+        else:
+            output.send("Repository %s failed: %s" % (repo.name, exc))
+            recorders.record(repo, 'failed', exc)
+            failed.append(repo.name)
 
     with output:
         output.send("Freshening repositories at %s" %
                     datetime.datetime.now())
-        for repo in repos:
-            output.send("Freshening repository %s..." % repo.name)
-            repo.freshen(output)
+        if resume:
+            repos = resumable(output, repos, journal, 'freshened')
+
+        with recorders:
+            with multiplexer:
+                with git_backend:
+                    for repo in repos:
+                        repo.ssh_options = multiplexer.options
+
+                    todo = repos
+                    if incremental:
+                        output.send("Checking repositories for upstream "
+                                    "changes...")
+                        run_jobs(repos, check, checked, jobs)
+                        todo = []
+                        for repo in repos:
+                            if repo in changed:
+                                todo.append(repo)
+                            else:
+                                output.send("Repository %s unchanged; "
+                                            "skipping" % repo.name)
+                                recorders.record(repo, 'skipped')
+
+                    # Update each mirror once, before the repositories
+                    # using it are fetched
+                    mirrors = {}
+                    for repo in todo:
+                        if repo.mirror:
+                            mirrors.setdefault(repo.mirror, repo)
+                    if mirrors:
+                        output.send("Updating mirrors...")
+                        run_jobs([mirrors[mirror]
+                                  for mirror in sorted(mirrors)],
+                                 update_mirror, mirrored, jobs)
+
+                    if jobs > 1:
+                        # Update in parallel, but install one at a time
+                        run_pipeline(todo, update, install, done, jobs)
+                    else:
+                        run_jobs(todo, action, done)
+
+        output.send("Freshened %d repositories: %d succeeded, %d failed, "
+                    "%d skipped" %
+                    (len(repos), len(todo) - len(failed), len(failed),
+                     len(repos) - len(todo)))
+
+    if failed:
+        return "Failed to freshen repositories: %s" % ', '.join(
+            repo.name for repo in repos if repo.name in failed)
 
 
 @cli_tools.argument('restrict',
@@ -390,7 +3934,57 @@ def freshen(repo_conf, logfile=None, restrict=None):
 @cli_tools.argument('--logfile', '-l',
                     default=None,
                     help="Location of the log file, for output.")
-def compact(repo_conf, logfile=None, restrict=None):
+@cli_tools.argument('--report', '-r',
+                    default=None,
+                    help="Location of a JSON report of the run.")
+@cli_tools.argument('--metrics', '-m',
+                    default=None,
+                    help="Directory to write Prometheus metrics to.")
+@cli_tools.argument('--profile', '-p',
+                    default=None,
+                    help="Location of a file to write profile data to.")
+@cli_tools.argument('--profile-top',
+                    type=int,
+                    default=20,
+                    help="Number of functions to report when profiling.")
+@cli_tools.argument('--threshold', '-t',
+                    action='store_true',
+                    default=None,
+                    help="Only compact repositories with too many loose "
+                    "objects or packs.")
+@cli_tools.argument('--strategy', '-s',
+                    choices=['full', 'incremental'],
+                    default=None,
+                    help="Compact with a full \"git gc\", or with "
+                    "incremental maintenance.")
+@cli_tools.argument('--jobs', '-j',
+                    type=int,
+                    default=None,
+                    help="Number of repositories to compact at once.")
+@cli_tools.argument('--nice', '-n',
+                    type=int,
+                    default=None,
+                    help="CPU niceness for the git commands.")
+@cli_tools.argument('--ionice',
+                    default=None,
+                    help="I/O scheduling class for the git commands, e.g., "
+                    "\"idle\".")
+@cli_tools.argument('--window-memory', '-w',
+                    default=None,
+                    help="Memory limit for each packing thread, e.g., "
+                    "\"256m\".")
+@cli_tools.argument('--backend', '-b',
+                    choices=['gitpython', 'asyncio'],
+                    default=None,
+                    help="Backend used to run git commands.")
+@cli_tools.argument('--resume',
+                    action='store_true',
+                    default=False,
+                    help="Skip repositories an interrupted run finished.")
+def compact(repo_conf, logfile=None, restrict=None, report=None,
+            metrics=None, threshold=None, strategy=None, jobs=None,
+            nice=None, ionice=None, window_memory=None, backend=None,
+            resume=False):
     """
     Compact a list of repositories--that is, call "git gc" on the
     repositories.
@@ -402,13 +3996,144 @@ def compact(repo_conf, logfile=None, restrict=None):
                     configured, a default will be used.
     :param restrict: Optional; a list of repositories that the compact
                      operation should be restricted to.
+    :param report: The name of a file to which a JSON report of the
+                   run will be written.  If not provided, the file
+                   will be derived from the configuration.  If not
+                   configured, no report will be written.
+    :param metrics: The directory, usually that of the node exporter
+                    textfile collector, to which Prometheus metrics
+                    describing the run will be written.  If not
+                    provided, the directory will be derived from the
+                    configuration.  If not configured, no metrics will
+                    be written.
+    :param threshold: If True, only repositories with at least as
+                      many loose objects or packs as their configured
+                      thresholds will be compacted.  If not provided,
+                      the value will be derived from the
+                      configuration.  If not configured, all
+                      repositories will be compacted.
+    :param strategy: Either "full", to run "git gc", or "incremental",
+                     to run cheaper incremental maintenance tasks.  If
+                     not provided, the value will be derived from the
+                     configuration.  If not configured, "full" will be
+                     used.
+    :param jobs: The number of repositories to compact at once.  If
+                 not provided, the value will be derived from the
+                 configuration.  If not configured, repositories will
+                 be compacted one at a time.  When more than one
+                 repository is compacted at once, the largest
+                 repositories are compacted first.
+    :param nice: The CPU niceness for the git commands.  If not
+                 provided, the value will be derived from the
+                 configuration.  If not configured, the niceness is
+                 not changed.
+    :param ionice: The I/O scheduling class for the git commands.  If
+                   not provided, the value will be derived from the
+                   configuration.  If not configured, the class is not
+                   changed.
+    :param window_memory: The memory limit for each packing thread.
+                          If not provided, the value will be derived
+                          from the configuration.  If not configured,
+                          git's own configuration applies.
+    :param backend: The backend used to run git commands: either
+                    "gitpython" or "asyncio".  If not provided, the
+                    value will be derived from the configuration.  If
+                    not configured, "gitpython" will be used.
+    :param resume: If True, repositories which an interrupted run
+                   finished with, according to its journal, will be
+                   skipped.
+
+    :returns: None if all repositories were compacted successfully,
+              otherwise a message describing the problem.
     """
 
-    repos, output = prepare(repo_conf, logfile, restrict)
+    repos, output, cfg = prepare(repo_conf, logfile, restrict)
+    try:
+        git_backend = get_backend(cfg, backend)
+    except ValueError as exc:
+        return str(exc)
+    jobs = int(get_option(cfg, 'compact_jobs', jobs, 1))
+    threshold = to_bool(get_option(cfg, 'gc_threshold', threshold, False))
+    strategy = get_option(cfg, 'compact_strategy', strategy, 'full')
+    if strategy not in ('full', 'incremental'):
+        return "Unknown compact strategy %r" % strategy
+    journal = get_journal(cfg, 'compact', repo_conf, resume)
+    recorders = Recorders(get_state(cfg, 'compact'),
+                          get_report(cfg, report, 'compact'),
+                          get_metrics(cfg, metrics, 'compact'), journal)
+    prefix, config = get_limits(cfg, nice, ionice, window_memory, jobs)
+    for repo in repos:
+        if git_backend.enabled:
+            repo.git_backend = git_backend
+        repo.command_prefix = prefix
+        repo.git_config = config
+
+    skipped = set()
+
+    # Output from a single job needn't be buffered
+    max_lines = 100 if jobs > 1 else 1
+
+    def action(repo):
+        with output.for_repo(repo.name, max_lines) as repo_output:
+            if threshold:
+                needed, reason = repo.needs_gc()
+                if not needed:
+                    repo_output.send("Repository %s skipped: %s" %
+                                     (repo.name, reason))
+                    skipped.add(repo)
+                    return
+                repo_output.send("Compacting repository %s: %s" %
+                                 (repo.name, reason))
+            else:
+                repo_output.send("Compacting repository %s..." % repo.name)
+
+            with repo.streaming(repo_output):
+                if strategy == 'incremental':
+                    repo.git_maintenance(repo_output)
+                else:
+                    repo.git_gc(repo_output)
+
+    failed = []
+
+    def done(repo, exc):
+        if exc is not None:
+            output.send("Repository %s failed: %s" % (repo.name, exc))
+            recorders.record(repo, 'failed', exc)
+            failed.append(repo.name)
+        elif repo in skipped:
+            recorders.record(repo, 'skipped')
+        else:
+            output.send("Repository %s compacted" % repo.name)
+            recorders.record(repo, 'succeeded')
 
     with output:
         output.send("Compacting repositories at %s" %
                     datetime.datetime.now())
-        for repo in repos:
-            output.send("Compacting repository %s..." % repo.name)
-            repo.git_gc(output)
+        if resume:
+            repos = resumable(output, repos, journal, 'compacted')
+
+        with recorders:
+            with git_backend:
+                todo = repos
+                if jobs > 1:
+                    # Start the largest repositories first, so a large
+                    # repository doesn't stretch out the end of the run
+                    sizes = dict((repo, repo.get_object_bytes() or 0)
+                                 for repo in repos)
+                    todo = sorted(repos, key=lambda repo: sizes[repo],
+                                  reverse=True)
+                run_jobs(todo, action, done, jobs)
+
+        output.send("Compacted %d repositories: %d succeeded, %d failed, "
+                    "%d skipped" %
+                    (len(repos), len(repos) - len(failed) - len(skipped),
+                     len(failed), len(skipped)))
+
+    if failed:
+        return "Failed to compact repositories: %s" % ', '.join(
+            repo.name for repo in repos if repo.name in failed)
+
+
+# Either command may be run under the profiler
+freshen.processor(profile)
+compact.processor(profile)
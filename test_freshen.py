@@ -14,15 +14,162 @@
 #    under the License.
 
 import ConfigParser
+import json
+import os
+import re
+import shutil
+import sqlite3
+import StringIO
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
+import git
 import mock
 import unittest2
 
 import freshen
 
 
+class FakeOutput(object):
+    """
+    A thread-safe stand-in for an Output object, which records the
+    messages sent to it.
+    """
+
+    def __init__(self):
+        self.msgs = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+    def send(self, *msgs):
+        with self.lock:
+            self.msgs.extend(msgs)
+
+    def for_repo(self, name, max_lines=100):
+        return freshen.RepoOutput(self, name, max_lines)
+
+    def stream(self, label):
+        return [msg for msg in self.msgs if msg.startswith(label)]
+
+
+def make_proc(out, err, returncode):
+    return mock.Mock(**{
+        'stdout': StringIO.StringIO(out),
+        'stderr': StringIO.StringIO(err),
+        'wait.return_value': returncode,
+    })
+
+
+def each_backend():
+    """
+    Yield the backend for Repo objects to use for each backend in
+    turn: None, for GitPython, then, if trollius is available, a
+    running AsyncioBackend.
+    """
+
+    yield None
+    if freshen.asyncio is not None:
+        with freshen.AsyncioBackend() as backend:
+            yield backend
+
+
+def make_tempdir(test):
+    tempdir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tempdir)
+    return tempdir
+
+
+def make_repo(name='repo', **kwargs):
+    """
+    Make a stand-in for a Repo object which has been acted upon, as
+    passed to the recorders.
+    """
+
+    repo = mock.Mock(directory='/src/%s' % name, timings={},
+                     start_sha='1111', end_sha='2222', fetched_bytes=None)
+    repo.name = name
+    for key, value in kwargs.items():
+        setattr(repo, key, value)
+    return repo
+
+
+class TestToBool(unittest2.TestCase):
+    def test_strings(self):
+        for value in ('1', 'yes', 'True', 'on'):
+            self.assertEqual(freshen.to_bool(value), True)
+        for value in ('0', 'No', 'false', 'OFF'):
+            self.assertEqual(freshen.to_bool(value), False)
+
+    def test_bad_string(self):
+        self.assertRaises(ValueError, freshen.to_bool, 'maybe')
+
+    def test_other(self):
+        self.assertEqual(freshen.to_bool(1), True)
+        self.assertEqual(freshen.to_bool(None), False)
+
+
+class TestStage(unittest2.TestCase):
+    @mock.patch('time.time', side_effect=[10.0, 12.5, 20.0, 21.0])
+    def test_timing(self, mock_time):
+        class Thing(object):
+            timings = {}
+
+            @freshen.stage
+            def succeed(self, arg):
+                return 'result %s' % arg
+
+            @freshen.stage
+            def fail(self):
+                raise Exception('failed')
+
+        thing = Thing()
+
+        self.assertEqual(thing.succeed('arg'), 'result arg')
+        self.assertRaises(Exception, thing.fail)
+        self.assertEqual(thing.timings, {'succeed': 2.5, 'fail': 1.0})
+
+
+class TestStreamProcess(unittest2.TestCase):
+    def test_stream(self):
+        output = FakeOutput()
+        proc = make_proc('out 1\nout 2 is long\nout 3', 'err 1\n', 3)
+
+        result = freshen.stream_process(output, proc, 8)
+
+        self.assertEqual(result, 3)
+        self.assertEqual(output.stream('Stdout:'), [
+            'Stdout: out 1\n',
+            'Stdout: out 2 is',
+            'Stdout:  long\n',
+            'Stdout: out 3',
+        ])
+        self.assertEqual(output.stream('Stderr:'), ['Stderr: err 1\n'])
+        self.assertEqual(len(output.msgs), 5)
+        proc.wait.assert_called_once_with()
+
+    def test_real_process(self):
+        output = FakeOutput()
+        proc = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys; sys.stdout.write("out\\n"); sys.stdout.flush(); '
+             'sys.stderr.write("err\\n"); sys.exit(2)'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        result = freshen.stream_process(output, proc)
+
+        self.assertEqual(result, 2)
+        self.assertEqual(sorted(output.msgs),
+                         ['Stderr: err\n', 'Stdout: out\n'])
+
+
 class TestWithBranch(unittest2.TestCase):
     def test_same_branch(self):
         repo = mock.Mock(**{
@@ -58,6 +205,332 @@ class TestWithBranch(unittest2.TestCase):
         output.send.assert_called_once_with(mock.ANY)
         repo.git_checkout.assert_called_once_with(output, 'other')
 
+    def test_keep(self):
+        repo = mock.Mock(**{
+            'get_current_branch.return_value': 'other',
+        })
+        output = mock.Mock()
+
+        with freshen.with_branch(output, repo, 'master',
+                                 restore=False) as save_branch:
+            self.assertEqual(save_branch, 'other')
+
+        repo.git_checkout.assert_called_once_with(output, 'master')
+
+    def test_keep_error(self):
+        repo = mock.Mock(**{
+            'get_current_branch.return_value': 'other',
+        })
+        output = mock.Mock()
+
+        with self.assertRaises(Exception):
+            with freshen.with_branch(output, repo, 'master', restore=False):
+                raise Exception('failed')
+
+        repo.git_checkout.assert_has_calls([
+            mock.call(output, 'master'),
+            mock.call(output, 'other'),
+        ])
+
+
+class TestUrlHost(unittest2.TestCase):
+    def test_url(self):
+        self.assertEqual(freshen.url_host('ssh://git@Example.com:22/r.git'),
+                         'example.com')
+        self.assertEqual(freshen.url_host('https://example.com/r.git'),
+                         'example.com')
+        self.assertEqual(freshen.url_host('ssh://[::1]:2222/r.git'), '::1')
+
+    def test_scp(self):
+        self.assertEqual(freshen.url_host('git@example.com:r.git'),
+                         'example.com')
+        self.assertEqual(freshen.url_host('example.com:/srv/r.git'),
+                         'example.com')
+
+    def test_local(self):
+        self.assertEqual(freshen.url_host('file:///srv/r.git'), None)
+        self.assertEqual(freshen.url_host('/srv/r.git'), None)
+        self.assertEqual(freshen.url_host('../r:1.git'), None)
+
+
+@unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+class TestAsyncioBackend(unittest2.TestCase):
+    def test_disabled(self):
+        backend = freshen.AsyncioBackend(False)
+
+        with backend:
+            self.assertEqual(backend.loop, None)
+            self.assertRaises(RuntimeError, backend.run, ['true'])
+
+    def test_run(self):
+        tempdir = make_tempdir(self)
+
+        with freshen.AsyncioBackend() as backend:
+            thread = backend.thread
+            self.assertTrue(thread.is_alive())
+
+            result = backend.run(['sh', '-c', 'pwd; echo err >&2; exit 3'],
+                                 cwd=tempdir, env={'PATH': os.defpath})
+
+        self.assertEqual(result, (3, '%s\n' % os.path.realpath(tempdir),
+                                  'err\n', False))
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(backend.loop, None)
+        self.assertRaises(RuntimeError, backend.run, ['true'])
+
+    def test_run_stream(self):
+        lines = []
+
+        with freshen.AsyncioBackend() as backend:
+            result = backend.run(['sh', '-c', 'echo out; echo one >&2; '
+                                  'sleep 0.1; printf two >&2'],
+                                 stream=lines.append)
+
+        self.assertEqual(result, (0, 'out\n', 'one\ntwo', False))
+        self.assertEqual(lines, ['one', 'two'])
+
+    def test_run_detached(self):
+        with freshen.AsyncioBackend() as backend:
+            result = backend.run([sys.executable, '-c',
+                                  'import os, sys; '
+                                  'print(os.getsid(0) == os.getpid()); '
+                                  'print(repr(sys.stdin.read()))'])
+
+            # A prompt fails rather than waiting on the terminal
+            status = backend.run(['sh', '-c', 'exec 3</dev/tty'])[0]
+
+        self.assertEqual(result, (0, "True\n''\n", '', False))
+        self.assertNotEqual(status, 0)
+
+    def test_run_timeout(self):
+        with freshen.AsyncioBackend() as backend:
+            # The child holding the pipes open is killed as well
+            start = time.time()
+            status, stdout, stderr, timed_out = backend.run(
+                ['sh', '-c', 'echo started; sleep 10 & sleep 10'],
+                timeout=0.2)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertNotEqual(status, 0)
+        self.assertEqual(stdout, 'started\n')
+        self.assertEqual(timed_out, True)
+
+    def test_run_concurrent(self):
+        results = []
+
+        with freshen.AsyncioBackend() as backend:
+            def worker():
+                results.append(backend.run(['sleep', '0.5']))
+
+            threads = [threading.Thread(target=worker) for i in range(10)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [(0, '', '', False)] * 10)
+        self.assertLess(time.time() - start, 2.5)
+
+    def test_exit_kills(self):
+        errors = []
+
+        def worker():
+            try:
+                backend.run(['sleep', '10'])
+            except Exception as exc:
+                errors.append(exc)
+
+        start = time.time()
+        with freshen.AsyncioBackend() as backend:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            time.sleep(0.2)
+        thread.join()
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(errors), 1)
+
+
+@unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+class TestAsyncGit(unittest2.TestCase):
+    def test_getattr(self):
+        handle = freshen.AsyncGit('/repo', 'backend')
+
+        with mock.patch.object(handle, 'execute',
+                               return_value='output') as mock_execute:
+            result = handle.count_objects('-v', with_exceptions=False)
+
+        self.assertEqual(result, 'output')
+        mock_execute.assert_called_once_with(
+            ['git', 'count-objects', '-v'], with_exceptions=False)
+
+    def test_getattr_private(self):
+        handle = freshen.AsyncGit('/repo', 'backend')
+
+        self.assertRaises(AttributeError, getattr, handle, '_private')
+
+    def test_update_environment(self):
+        handle = freshen.AsyncGit('/repo', 'backend')
+
+        self.assertEqual(handle.update_environment(ONE='1', TWO='2'),
+                         {'ONE': None, 'TWO': None})
+        self.assertEqual(handle.update_environment(ONE=None, TWO='3'),
+                         {'ONE': '1', 'TWO': '2'})
+        self.assertEqual(handle.environment(), {'TWO': '3'})
+
+    def test_execute(self):
+        tempdir = make_tempdir(self)
+        lines = []
+
+        with freshen.AsyncioBackend() as backend:
+            handle = freshen.AsyncGit(tempdir, backend, lines.append)
+            handle.update_environment(FRESHEN_TEST='value')
+
+            result = handle.execute(['sh', '-c', 'pwd; echo $FRESHEN_TEST '
+                                     '$LC_ALL; echo progress >&2'])
+
+        self.assertEqual(result, '%s\nvalue C' % os.path.realpath(tempdir))
+        self.assertEqual(lines, ['progress'])
+
+    def test_execute_git(self):
+        tempdir = make_tempdir(self)
+
+        with freshen.AsyncioBackend() as backend:
+            handle = freshen.AsyncGit(tempdir, backend)
+            handle.init('-b', 'main')
+
+            result = handle.symbolic_ref('HEAD')
+
+        self.assertEqual(result, 'refs/heads/main')
+
+    def test_execute_failure(self):
+        with freshen.AsyncioBackend() as backend:
+            handle = freshen.AsyncGit(None, backend)
+
+            with self.assertRaises(git.exc.GitCommandError) as cm:
+                handle.execute(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+            result = handle.execute(['sh', '-c', 'echo out; exit 3'],
+                                    with_exceptions=False)
+
+        self.assertEqual(cm.exception.status, 3)
+        self.assertIn('err', cm.exception.stderr)
+        self.assertEqual(result, 'out')
+
+    def test_execute_timeout(self):
+        with freshen.AsyncioBackend() as backend:
+            handle = freshen.AsyncGit(None, backend)
+
+            with self.assertRaises(git.exc.GitCommandError) as cm:
+                handle.execute(['sleep', '5'], kill_after_timeout=0.1)
+
+        self.assertIn('did not complete in 0.1 secs', cm.exception.stderr)
+
+    def test_execute_not_found(self):
+        tempdir = make_tempdir(self)
+
+        with freshen.AsyncioBackend() as backend:
+            handle = freshen.AsyncGit(os.path.join(tempdir, 'missing'),
+                                      backend)
+
+            self.assertRaises(git.exc.GitCommandNotFound, handle.status)
+
+
+class TestRefReader(unittest2.TestCase):
+    def make_tree(self, files):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        for name, contents in files.items():
+            path = os.path.join(tempdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        return tempdir
+
+    def test_loose(self):
+        tempdir = self.make_tree({
+            'repo/.git/HEAD': 'ref: refs/heads/master\n',
+            'repo/.git/refs/heads/master': 'abc123\n',
+            'repo/.git/refs/remotes/origin/HEAD':
+            'ref: refs/remotes/origin/master\n',
+            'repo/.git/refs/remotes/origin/master': 'def456\n',
+        })
+        refs = freshen.RefReader(os.path.join(tempdir, 'repo'))
+
+        self.assertEqual(refs.gitdir, os.path.join(tempdir, 'repo/.git'))
+        self.assertEqual(refs.commondir, refs.gitdir)
+        self.assertEqual(refs.head(), 'master')
+        self.assertEqual(refs.resolve('HEAD'), 'abc123')
+        self.assertEqual(refs.resolve('refs/remotes/origin/HEAD'), 'def456')
+        self.assertEqual(refs.resolve('refs/heads/missing'), None)
+        self.assertEqual(refs.resolve('refs/heads'), None)
+
+    def test_packed(self):
+        tempdir = self.make_tree({
+            'repo/.git/HEAD': 'ref: refs/heads/stable\n',
+            'repo/.git/refs/heads/master': 'abc123\n',
+            'repo/.git/packed-refs': (
+                '# pack-refs with: peeled fully-peeled sorted\n'
+                '111111 refs/heads/master\n'
+                '222222 refs/heads/stable\n'
+                '333333 refs/tags/v1\n'
+                '^444444\n'),
+        })
+        refs = freshen.RefReader(os.path.join(tempdir, 'repo'))
+
+        # Loose refs take precedence over packed refs
+        self.assertEqual(refs.resolve('refs/heads/master'), 'abc123')
+        self.assertEqual(refs.resolve('HEAD'), '222222')
+        self.assertEqual(refs.packed_refs(), {
+            'refs/heads/master': '111111',
+            'refs/heads/stable': '222222',
+            'refs/tags/v1': '333333',
+        })
+
+        with mock.patch('__builtin__.open', side_effect=AssertionError):
+            self.assertEqual(refs.packed_refs()['refs/tags/v1'], '333333')
+
+    def test_worktree(self):
+        tempdir = self.make_tree({
+            'repo/.git/HEAD': 'ref: refs/heads/master\n',
+            'repo/.git/refs/heads/master': 'abc123\n',
+            'repo/.git/worktrees/wt/HEAD': 'def456\n',
+            'repo/.git/worktrees/wt/commondir': '../..\n',
+            'repo/.git/worktrees/wt/refs/bisect/bad': '777777\n',
+            'wt/.git': 'gitdir: ../repo/.git/worktrees/wt\n',
+        })
+        refs = freshen.RefReader(os.path.join(tempdir, 'wt'))
+
+        self.assertEqual(refs.gitdir,
+                         os.path.join(tempdir, 'repo/.git/worktrees/wt'))
+        self.assertEqual(refs.commondir, os.path.join(tempdir, 'repo/.git'))
+        self.assertEqual(refs.head(), 'def456')
+        self.assertEqual(refs.resolve('refs/heads/master'), 'abc123')
+        self.assertEqual(refs.resolve('refs/bisect/bad'), '777777')
+
+    def test_bare(self):
+        tempdir = self.make_tree({
+            'repo.git/HEAD': 'ref: refs/heads/master\n',
+            'repo.git/refs/heads/master': 'abc123\n',
+        })
+        refs = freshen.RefReader(os.path.join(tempdir, 'repo.git'))
+
+        self.assertEqual(refs.gitdir, os.path.join(tempdir, 'repo.git'))
+        self.assertEqual(refs.resolve('HEAD'), 'abc123')
+
+    def test_unsupported(self):
+        tempdir = self.make_tree({
+            'reftable/.git/HEAD': 'ref: refs/heads/.invalid\n',
+            'reftable/.git/reftable/tables.list': '',
+            'loop/.git/HEAD': 'ref: HEAD\n',
+            'empty/README': '',
+        })
+
+        for name in ('reftable', 'loop', 'empty'):
+            refs = freshen.RefReader(os.path.join(tempdir, name))
+            self.assertRaises(ValueError, refs.resolve, 'HEAD')
+
 
 class TestRepo(unittest2.TestCase):
     @mock.patch('os.path.expanduser',
@@ -71,7 +544,24 @@ class TestRepo(unittest2.TestCase):
         self.assertEqual(repo.push, None)
         self.assertEqual(repo.branch, 'master')
         self.assertEqual(repo.install_mode, None)
+        self.assertEqual(repo.single_fetch, False)
+        self.assertEqual(repo.fetch_refspec, None)
+        self.assertEqual(repo.fetch_tags, None)
+        self.assertEqual(repo.fetch_prune, False)
+        self.assertEqual(repo.fetch_depth, None)
+        self.assertEqual(repo.fetch_filter, None)
+        self.assertEqual(repo.install_cache, True)
+        self.assertEqual(repo.gc_loose_threshold, 6700)
+        self.assertEqual(repo.gc_pack_threshold, 50)
+        self.assertEqual(repo.no_checkout, False)
+        self.assertEqual(repo.git_timeout, None)
+        self.assertEqual(repo.git_backend, None)
+        self.assertEqual(repo.progress, None)
+        self.assertEqual(repo.state, None)
         self.assertEqual(repo.directory, '/home/test/devel/src/repo')
+        self.assertEqual(repo.timings, {})
+        self.assertEqual(repo.start_sha, None)
+        self.assertEqual(repo.end_sha, None)
         self.assertEqual(repo._handle, None)
 
     @mock.patch('os.path.expanduser',
@@ -79,7 +569,7 @@ class TestRepo(unittest2.TestCase):
     def test_init(self, mock_expanduser):
         repo = freshen.Repo('repo', basedir='~/src', pull='remote',
                             push='origin', branch='development',
-                            install_mode='develop')
+                            install_mode='develop', single_fetch='yes')
 
         self.assertEqual(repo.name, 'repo')
         self.assertEqual(repo.basedir, '/home/test/src')
@@ -87,23 +577,33 @@ class TestRepo(unittest2.TestCase):
         self.assertEqual(repo.push, 'origin')
         self.assertEqual(repo.branch, 'development')
         self.assertEqual(repo.install_mode, 'develop')
+        self.assertEqual(repo.single_fetch, True)
         self.assertEqual(repo.directory, '/home/test/src/repo')
         self.assertEqual(repo._handle, None)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
     @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
     @mock.patch.object(freshen.Repo, 'git_fetch')
     @mock.patch.object(freshen.Repo, 'git_pull')
     @mock.patch.object(freshen.Repo, 'git_push')
     @mock.patch.object(freshen.Repo, 'install')
     def test_freshen(self, mock_install, mock_git_push, mock_git_pull,
-                     mock_git_fetch, mock_with_branch, mock_expanduser):
+                     mock_git_fetch, mock_get_sha, mock_with_branch,
+                     mock_expanduser):
         repo = freshen.Repo('repo')
 
         repo.freshen('output')
 
-        mock_with_branch.assert_called_once_with('output', repo, 'master')
+        self.assertEqual(repo.start_sha, 'old')
+        self.assertEqual(repo.end_sha, 'new')
+        mock_get_sha.assert_has_calls([
+            mock.call('refs/heads/master'),
+            mock.call('refs/heads/master'),
+        ])
+        mock_with_branch.assert_called_once_with('output', repo, 'master',
+                                                 restore=True)
         mock_with_branch.return_value.__enter__.assert_called_once_with()
         mock_with_branch.return_value.__exit__.assert_called_once_with(
             None, None, None)
@@ -114,230 +614,2506 @@ class TestRepo(unittest2.TestCase):
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'branch.return_value': '  other\n  something\n* master\n  new',
-    }))
-    def test_get_current_branch(self, mock_expanduser):
-        repo = freshen.Repo('repo')
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_update(self, mock_install, mock_git_push, mock_git_pull,
+                    mock_git_fetch, mock_get_sha, mock_with_branch,
+                    mock_expanduser):
+        repo = freshen.Repo('repo', install_mode='develop')
 
-        result = repo.get_current_branch()
+        repo.update('output')
 
-        repo.handle.branch.assert_called_once_with()
-        self.assertEqual(result, 'master')
+        self.assertEqual(repo.start_sha, 'old')
+        self.assertEqual(repo.end_sha, 'new')
+        mock_with_branch.assert_called_once_with('output', repo, 'master',
+                                                 restore=True)
+        mock_git_fetch.assert_called_once_with('output')
+        mock_git_pull.assert_called_once_with('output')
+        mock_git_push.assert_called_once_with('output')
+        self.assertFalse(mock_install.called)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'checkout.return_value': 'checkout return value',
-    }))
-    def test_git_checkout(self, mock_expanduser):
-        output = mock.Mock()
-        repo = freshen.Repo('repo')
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_reset')
+    @mock.patch.object(freshen.Repo, 'git_merge')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    def test_update_shallow(self, mock_git_push, mock_git_pull,
+                            mock_git_merge, mock_git_reset, mock_git_fetch,
+                            mock_get_sha, mock_with_branch, mock_expanduser):
+        repo = freshen.Repo('repo', single_fetch=True, fetch_depth='1')
 
-        repo.git_checkout(output, 'branch')
+        repo.update('output')
 
-        output.send.assert_called_once_with('checkout return value')
-        repo.handle.checkout.assert_called_once_with('branch')
+        mock_git_fetch.assert_called_once_with('output')
+        mock_git_reset.assert_called_once_with('output')
+        self.assertFalse(mock_git_merge.called)
+        self.assertFalse(mock_git_pull.called)
+        mock_git_push.assert_called_once_with('output')
+
+    @mock.patch.dict(os.environ, GIT_AUTHOR_NAME='Test',
+                     GIT_AUTHOR_EMAIL='test@example.com',
+                     GIT_COMMITTER_NAME='Test',
+                     GIT_COMMITTER_EMAIL='test@example.com')
+    def test_update_shallow_git(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        upstream = git.Git(os.path.join(tempdir, 'upstream'))
+        url = 'file://%s' % os.path.join(tempdir, 'upstream')
+
+        def advance(count):
+            for i in range(count):
+                upstream.commit('--allow-empty', '-m', 'commit %d' % i)
+            return upstream.rev_parse('HEAD')
+
+        git.Git(tempdir).init('-b', 'master', 'upstream')
+        advance(3)
+        git.Git(tempdir).clone('--depth=1', url, 'checkout')
+        git.Git(tempdir).clone('--depth=1', url, 'worktree')
+        git.Git(os.path.join(tempdir, 'worktree')).checkout('-b', 'other')
+        repos = [
+            freshen.Repo('checkout', basedir=tempdir, fetch_depth='1'),
+            freshen.Repo('worktree', basedir=tempdir, fetch_depth='1',
+                         no_checkout=True),
+            freshen.Repo('checkout', basedir=tempdir, fetch_depth='1',
+                         single_fetch=True),
+        ]
+
+        # Each freshen must follow the upstream tip past the cut-off
+        for repo in repos:
+            for count in (2, 5):
+                tip = advance(count)
+
+                repo.update(FakeOutput())
+
+                self.assertEqual(repo.end_sha, tip)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'fetch.return_value': 'fetch return value',
-    }))
-    def test_git_fetch(self, mock_expanduser):
-        output = mock.Mock()
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_install_branch_none(self, mock_install, mock_with_branch,
+                                 mock_expanduser):
         repo = freshen.Repo('repo')
 
-        repo.git_fetch(output)
+        repo.install_branch('output')
 
-        output.send.assert_has_calls([
-            mock.call("Fetching changes from origin"),
-            mock.call("fetch return value"),
-        ])
-        repo.handle.fetch.assert_called_once_with()
+        self.assertFalse(mock_with_branch.called)
+        self.assertFalse(mock_install.called)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'pull.return_value': 'pull return value',
-    }))
-    def test_git_pull_none(self, mock_expanduser):
-        output = mock.Mock()
-        repo = freshen.Repo('repo', pull=None)
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_install_branch(self, mock_install, mock_with_branch,
+                            mock_expanduser):
+        repo = freshen.Repo('repo', branch='stable', install_mode='develop')
 
-        repo.git_pull(output)
+        repo.install_branch('output')
 
-        self.assertFalse(output.send.called)
-        self.assertFalse(repo.handle.pull.called)
+        mock_with_branch.assert_called_once_with('output', repo, 'stable')
+        mock_with_branch.return_value.__enter__.assert_called_once_with()
+        mock_install.assert_called_once_with('output')
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'pull.return_value': 'pull return value',
-    }))
-    def test_git_pull(self, mock_expanduser):
+    @mock.patch.object(freshen.Repo, 'get_current_branch',
+                       return_value='other')
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='sha')
+    @mock.patch.object(freshen.Repo, 'git_checkout')
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_install_branch_kept(self, mock_install, mock_git_push,
+                                 mock_git_pull, mock_git_fetch,
+                                 mock_git_checkout, mock_get_sha,
+                                 mock_get_current_branch, mock_expanduser):
         output = mock.Mock()
-        repo = freshen.Repo('repo')
+        repo = freshen.Repo('repo', install_mode='develop')
 
-        repo.git_pull(output)
+        repo.update(output, keep_branch=True)
 
-        output.send.assert_has_calls([
-            mock.call("Pulling in changes from origin"),
-            mock.call("pull return value"),
-        ])
-        repo.handle.pull.assert_called_once_with('origin', 'master')
+        self.assertEqual(repo.saved_branch, 'other')
+        mock_git_checkout.assert_called_once_with(output, 'master')
+        mock_git_checkout.reset_mock()
+
+        repo.install_branch(output)
+
+        # The desired branch is checked out and left only once
+        self.assertEqual(repo.saved_branch, None)
+        mock_install.assert_called_once_with(output)
+        mock_git_checkout.assert_called_once_with(output, 'other')
+        self.assertEqual(mock_get_current_branch.call_count, 1)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'push.return_value': 'push return value',
-    }))
-    def test_git_push_none(self, mock_expanduser):
+    @mock.patch.object(freshen.Repo, 'get_current_branch',
+                       return_value='other')
+    @mock.patch.object(freshen.Repo, 'git_checkout')
+    @mock.patch.object(freshen.Repo, 'install',
+                       side_effect=Exception('install failed'))
+    def test_install_branch_kept_error(self, mock_install, mock_git_checkout,
+                                       mock_get_current_branch,
+                                       mock_expanduser):
         output = mock.Mock()
-        repo = freshen.Repo('repo')
+        repo = freshen.Repo('repo', install_mode='develop')
+        repo.saved_branch = 'other'
 
-        repo.git_push(output)
+        with self.assertRaises(Exception):
+            repo.install_branch(output)
 
-        self.assertFalse(output.send.called)
-        self.assertFalse(repo.handle.push.called)
+        self.assertEqual(repo.saved_branch, None)
+        mock_git_checkout.assert_called_once_with(output, 'other')
+        self.assertFalse(mock_get_current_branch.called)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'push.return_value': 'push return value',
-    }))
-    def test_git_push(self, mock_expanduser):
-        output = mock.Mock()
-        repo = freshen.Repo('repo', push='origin')
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_current_branch',
+                       return_value='feature')
+    @mock.patch.object(freshen.Repo, 'git_worktree', return_value='/wt')
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_install_branch_no_checkout(self, mock_install, mock_git_worktree,
+                                        mock_get_current_branch,
+                                        mock_with_branch, mock_expanduser):
+        repo = freshen.Repo('repo', branch='stable', install_mode='develop',
+                            no_checkout='yes')
 
-        repo.git_push(output)
+        repo.install_branch('output')
 
-        output.send.assert_has_calls([
-            mock.call("Pushing out changes to origin"),
-            mock.call("push return value"),
-        ])
-        repo.handle.push.assert_called_once_with('--force', 'origin', 'master')
+        self.assertFalse(mock_with_branch.called)
+        mock_git_worktree.assert_called_once_with('output')
+        mock_install.assert_called_once_with('output', '/wt',
+                                             'refs/heads/stable')
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(subprocess, 'Popen', return_value=mock.Mock(**{
-        'communicate.return_value': ('', ''),
-    }))
-    def test_install_none(self, mock_Popen, mock_expanduser):
-        output = mock.Mock()
-        repo = freshen.Repo('repo')
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_current_branch',
+                       return_value='feature')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_fast_forward')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    @mock.patch.object(freshen.Repo, 'install_worktree')
+    def test_freshen_no_checkout(self, mock_install_worktree, mock_git_push,
+                                 mock_git_pull, mock_git_fast_forward,
+                                 mock_git_fetch, mock_get_sha,
+                                 mock_get_current_branch, mock_with_branch,
+                                 mock_expanduser):
+        repo = freshen.Repo('repo', install_mode='develop', no_checkout='yes')
 
-        repo.install(output)
+        repo.freshen('output')
 
-        self.assertFalse(output.send.called)
-        self.assertFalse(mock_Popen.called)
+        self.assertEqual(repo.start_sha, 'old')
+        self.assertEqual(repo.end_sha, 'new')
+        self.assertFalse(mock_with_branch.called)
+        mock_git_fetch.assert_called_once_with('output')
+        mock_git_fast_forward.assert_called_once_with('output')
+        self.assertFalse(mock_git_pull.called)
+        mock_git_push.assert_called_once_with('output')
+        mock_install_worktree.assert_called_once_with('output')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: ('/home/test%s' % x[1:]
+                                       if x.startswith('~') else x))
+    def test_init_mirror(self, mock_expanduser):
+        repo = freshen.Repo('repo', mirror='mirrors/upstream.git')
+        other = freshen.Repo('repo', mirror='~/upstream.git')
+
+        self.assertEqual(repo.mirror,
+                         '/home/test/devel/src/mirrors/upstream.git')
+        self.assertEqual(other.mirror, '/home/test/upstream.git')
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(subprocess, 'Popen', return_value=mock.Mock(**{
-        'communicate.return_value': ('', ''),
+    @mock.patch('os.path.isdir', return_value=True)
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'add_alternate')
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    def test_update_mirror_alternate(self, mock_git_push, mock_git_pull,
+                                     mock_git_fetch, mock_add_alternate,
+                                     mock_get_sha, mock_with_branch,
+                                     mock_isdir, mock_expanduser):
+        repo = freshen.Repo('repo', mirror='~/mirror.git')
+
+        repo.update('output')
+
+        mock_isdir.assert_called_once_with('/home/test/mirror.git')
+        mock_add_alternate.assert_called_once_with('output')
+        mock_git_fetch.assert_called_once_with('output')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch('os.path.isdir', return_value=True)
+    @mock.patch.object(freshen.Repo, 'make_handle', return_value=mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
     }))
-    def test_install_no_output(self, mock_Popen, mock_expanduser):
+    def test_update_mirror_existing(self, mock_make_handle, mock_isdir,
+                                    mock_expanduser):
         output = mock.Mock()
-        repo = freshen.Repo('repo', install_mode='install')
+        repo = freshen.Repo('repo', mirror='~/mirror.git')
 
-        repo.install(output)
+        repo.update_mirror(output)
 
         output.send.assert_has_calls([
-            mock.call('Installing repository repo with command '
-                      "'sudo python setup.py install'"),
+            mock.call("Updating mirror /home/test/mirror.git"),
+            mock.call("fetch return value"),
+        ])
+        mock_make_handle.assert_called_once_with('/home/test/mirror.git')
+        mock_make_handle.return_value.fetch.assert_called_once_with(
+            '--no-prune', 'origin')
+        self.assertIn('update_mirror', repo.timings)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch('os.path.isdir', return_value=False)
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'ls_remote.return_value': 'git@example.com:upstream.git',
+    }))
+    @mock.patch.object(freshen.Repo, 'make_handle', return_value=mock.Mock(**{
+        'clone.return_value': 'clone return value',
+    }))
+    def test_update_mirror_create(self, mock_make_handle, mock_isdir,
+                                  mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull='upstream', mirror='~/mirror.git')
+
+        repo.update_mirror(output)
+
+        output.send.assert_has_calls([
+            mock.call("Creating mirror /home/test/mirror.git from "
+                      "git@example.com:upstream.git"),
+            mock.call("clone return value"),
+        ])
+        repo.handle.ls_remote.assert_called_once_with('--get-url',
+                                                      'upstream')
+        mock_make_handle.assert_has_calls([
+            mock.call('/home/test/devel/src'),
+            mock.call('/home/test/mirror.git'),
+        ])
+        handle = mock_make_handle.return_value
+        handle.clone.assert_called_once_with(
+            '--mirror', 'git@example.com:upstream.git',
+            '/home/test/mirror.git')
+        handle.config.assert_called_once_with('gc.pruneExpire', 'never')
+
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    def test_add_alternate(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        os.makedirs(os.path.join(tempdir, 'repo', '.git', 'objects', 'info'))
+        path = os.path.join(tempdir, 'repo', '.git', 'objects', 'info',
+                            'alternates')
+        output = mock.Mock()
+        repo = freshen.Repo('repo', basedir=tempdir, mirror='mirror.git')
+
+        repo.add_alternate(output)
+        repo.add_alternate(output)
+
+        with open(path) as f:
+            self.assertEqual(f.read(), '%s/mirror.git/objects\n' % tempdir)
+        output.send.assert_called_once_with(
+            "Borrowing objects from mirror %s/mirror.git" % tempdir)
+        self.assertFalse(repo.handle.rev_parse.called)
+
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'rev_parse.return_value': '.git/objects/info/alternates',
+    }))
+    def test_add_alternate_reftable(self):
+        tempdir = make_tempdir(self)
+        os.makedirs(os.path.join(tempdir, 'repo', '.git', 'objects', 'info'))
+        os.makedirs(os.path.join(tempdir, 'repo', '.git', 'reftable'))
+        path = os.path.join(tempdir, 'repo', '.git', 'objects', 'info',
+                            'alternates')
+        repo = freshen.Repo('repo', basedir=tempdir, mirror='mirror.git')
+
+        repo.add_alternate(mock.Mock())
+
+        with open(path) as f:
+            self.assertEqual(f.read(), '%s/mirror.git/objects\n' % tempdir)
+        repo.handle.rev_parse.assert_called_once_with(
+            '--git-path', 'objects/info/alternates')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_current_branch',
+                       return_value='master')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_fast_forward')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    def test_update_no_checkout_current(self, mock_git_push, mock_git_pull,
+                                        mock_git_fast_forward,
+                                        mock_git_fetch, mock_get_sha,
+                                        mock_get_current_branch,
+                                        mock_with_branch, mock_expanduser):
+        repo = freshen.Repo('repo', no_checkout='yes')
+
+        repo.update('output')
+
+        mock_with_branch.assert_called_once_with('output', repo, 'master',
+                                                 restore=True)
+        self.assertFalse(mock_git_fast_forward.called)
+        mock_git_pull.assert_called_once_with('output')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen, 'with_branch', return_value=mock.MagicMock())
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='sha')
+    @mock.patch.object(freshen.Repo, 'git_fetch')
+    @mock.patch.object(freshen.Repo, 'git_merge')
+    @mock.patch.object(freshen.Repo, 'git_pull')
+    @mock.patch.object(freshen.Repo, 'git_push')
+    @mock.patch.object(freshen.Repo, 'install')
+    def test_freshen_single_fetch(self, mock_install, mock_git_push,
+                                  mock_git_pull, mock_git_merge,
+                                  mock_git_fetch, mock_get_sha,
+                                  mock_with_branch, mock_expanduser):
+        repo = freshen.Repo('repo', single_fetch=True)
+
+        repo.freshen('output')
+
+        mock_with_branch.assert_called_once_with('output', repo, 'master',
+                                                 restore=True)
+        mock_git_fetch.assert_called_once_with('output')
+        mock_git_merge.assert_called_once_with('output')
+        self.assertFalse(mock_git_pull.called)
+        mock_git_push.assert_called_once_with('output')
+        mock_install.assert_called_once_with('output')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'branch.return_value': '  other\n  something\n* master\n  new',
+    }))
+    def test_get_current_branch(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_current_branch()
+
+        repo.handle.branch.assert_called_once_with()
+        self.assertEqual(result, 'master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'refs', mock.Mock(**{
+        'head.return_value': 'stable',
+        'resolve.return_value': 'abc123',
+    }))
+    def test_refs_read(self, mock_handle, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.get_current_branch(), 'stable')
+        self.assertEqual(repo.get_sha('refs/heads/master'), 'abc123')
+        self.assertEqual(repo.get_sha('refs/remotes/origin/master'),
+                         'abc123')
+        self.assertEqual(repo.get_sha('HEAD'), 'abc123')
+        self.assertEqual(mock_handle.mock_calls, [])
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'rev_parse.return_value': 'abc123',
+    }))
+    @mock.patch.object(freshen.Repo, 'refs')
+    def test_get_sha_tag(self, mock_refs, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_sha('refs/tags/v1')
+
+        self.assertEqual(result, 'abc123')
+        self.assertFalse(mock_refs.resolve.called)
+        repo.handle.rev_parse.assert_called_once_with(
+            '--verify', '--quiet', 'refs/tags/v1^{commit}')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'rev_parse.return_value': 'abc123',
+    }))
+    def test_get_sha(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_sha('refs/heads/master')
+
+        self.assertEqual(result, 'abc123')
+        repo.handle.rev_parse.assert_called_once_with(
+            '--verify', '--quiet', 'refs/heads/master^{commit}')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'rev_parse.side_effect': git.exc.GitCommandError('rev-parse', 1),
+    }))
+    def test_get_sha_missing(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_sha('refs/heads/master')
+
+        self.assertEqual(result, None)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'ls_remote.return_value': ('abc123\trefs/heads/master/sub\n'
+                                   'def456\trefs/heads/master'),
+    }))
+    def test_get_remote_sha(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_remote_sha('upstream')
+
+        self.assertEqual(result, 'def456')
+        repo.handle.ls_remote.assert_called_once_with(
+            'upstream', 'refs/heads/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'ls_remote.return_value': '',
+    }))
+    def test_get_remote_sha_missing(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.get_remote_sha('upstream')
+
+        self.assertEqual(result, None)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'get_remote_sha')
+    def test_is_changed_nopull(self, mock_get_remote_sha, mock_expanduser):
+        repo = freshen.Repo('repo', pull=None)
+
+        self.assertEqual(repo.is_changed(), True)
+        self.assertFalse(mock_get_remote_sha.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'get_remote_sha', return_value=None)
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='abc123')
+    def test_is_changed_noremote(self, mock_get_sha, mock_get_remote_sha,
+                                 mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.is_changed(), True)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    @mock.patch.object(freshen.Repo, 'get_remote_sha', return_value='abc123')
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='abc123')
+    def test_is_changed_same(self, mock_get_sha, mock_get_remote_sha,
+                             mock_expanduser):
+        repo = freshen.Repo('repo', pull='upstream')
+
+        self.assertEqual(repo.is_changed(), False)
+        mock_get_remote_sha.assert_called_once_with('upstream')
+        mock_get_sha.assert_called_once_with('refs/heads/master')
+        self.assertFalse(repo.handle.merge_base.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    @mock.patch.object(freshen.Repo, 'get_remote_sha', return_value='abc123')
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='def456')
+    def test_is_changed_merged(self, mock_get_sha, mock_get_remote_sha,
+                               mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.is_changed(), False)
+        repo.handle.merge_base.assert_called_once_with(
+            '--is-ancestor', 'abc123', 'def456')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'merge_base.side_effect': git.exc.GitCommandError('merge-base', 1),
+    }))
+    @mock.patch.object(freshen.Repo, 'get_remote_sha', return_value='abc123')
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='def456')
+    def test_is_changed_unmerged(self, mock_get_sha, mock_get_remote_sha,
+                                 mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.is_changed(), True)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'checkout.return_value': 'checkout return value',
+    }))
+    def test_git_checkout(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_checkout(output, 'branch')
+
+        output.send.assert_called_once_with('checkout return value')
+        repo.handle.checkout.assert_called_once_with('branch')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    def test_git_fetch(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_fetch(output)
+
+        output.send.assert_has_calls([
+            mock.call("Fetching changes from origin"),
+            mock.call("fetch return value"),
+        ])
+        repo.handle.fetch.assert_called_once_with(
+            'origin', '+refs/heads/master:refs/remotes/origin/master')
+
+    @mock.patch.dict(os.environ, GIT_AUTHOR_NAME='Test',
+                     GIT_AUTHOR_EMAIL='test@example.com',
+                     GIT_COMMITTER_NAME='Test',
+                     GIT_COMMITTER_EMAIL='test@example.com')
+    def test_update_git(self):
+        tempdir = make_tempdir(self)
+        upstream = git.Git(os.path.join(tempdir, 'upstream'))
+        url = 'file://%s' % os.path.join(tempdir, 'upstream')
+        git.Git(tempdir).init('-b', 'master', 'upstream')
+        upstream.commit('--allow-empty', '-m', 'initial')
+        git.Git(tempdir).clone(url, 'checkout')
+        git.Git(os.path.join(tempdir, 'checkout')).checkout('-b', 'other')
+
+        for backend in each_backend():
+            upstream.commit('--allow-empty', '-m', 'change')
+            repo = freshen.Repo('checkout', basedir=tempdir,
+                                single_fetch=True)
+            repo.git_backend = backend
+            output = FakeOutput()
+
+            with repo.streaming(output):
+                repo.update(output)
+
+            self.assertEqual(repo.end_sha, upstream.rev_parse('HEAD'))
+            self.assertEqual(repo.get_current_branch(), 'other')
+
+            # Only the asyncio backend passes on git's messages
+            switched = "Switched to branch 'master'" in output.msgs
+            self.assertEqual(switched, backend is not None)
+
+    @mock.patch.dict(os.environ, GIT_SSH_COMMAND='sleep 10 #')
+    def test_git_fetch_timeout(self):
+        tempdir = make_tempdir(self)
+        git.Git(tempdir).init('repo')
+        git.Git(os.path.join(tempdir, 'repo')).remote(
+            'add', 'origin', 'ssh://example.com/repo.git')
+
+        for backend in each_backend():
+            repo = freshen.Repo('repo', basedir=tempdir, git_timeout='0.5')
+            repo.git_backend = backend
+
+            # The hung ssh is killed along with git
+            start = time.time()
+            with self.assertRaises(git.exc.GitCommandError):
+                repo.git_fetch(FakeOutput())
+
+            self.assertLess(time.time() - start, 5)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    @mock.patch.object(freshen.Repo, 'get_object_bytes',
+                       side_effect=[4096, 10240])
+    def test_git_fetch_measured(self, mock_get_object_bytes,
+                                mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+        repo.measure_fetch = True
+
+        repo.git_fetch(output)
+
+        self.assertEqual(repo.fetched_bytes, 6144)
+        self.assertEqual(mock_get_object_bytes.call_count, 2)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    def test_git_fetch_nopull(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull=None, branch='stable')
+
+        repo.git_fetch(output)
+
+        output.send.assert_has_calls([
+            mock.call("Fetching changes from origin"),
+            mock.call("fetch return value"),
+        ])
+        repo.handle.fetch.assert_called_once_with(
+            'origin', '+refs/heads/stable:refs/remotes/origin/stable')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    def test_git_fetch_options(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull='upstream', fetch_tags='no',
+                            fetch_prune='yes',
+                            fetch_refspec='refs/heads/a:refs/b  refs/tags/c')
+
+        repo.git_fetch(output)
+
+        output.send.assert_has_calls([
+            mock.call("Fetching changes from upstream"),
+            mock.call("fetch return value"),
+        ])
+        repo.handle.fetch.assert_called_once_with(
+            '--prune', '--no-tags', 'upstream',
+            'refs/heads/a:refs/b', 'refs/tags/c')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    def test_git_fetch_remote_refspecs(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', fetch_tags='yes', fetch_refspec='')
+
+        repo.git_fetch(output)
+
+        repo.handle.fetch.assert_called_once_with('--tags', 'origin')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'fetch.return_value': 'fetch return value',
+    }))
+    def test_git_fetch_partial(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', fetch_depth='1', fetch_filter='blob:none')
+
+        repo.git_fetch(output)
+
+        repo.handle.fetch.assert_called_once_with(
+            '--depth=1', '--filter=blob:none', 'origin',
+            '+refs/heads/master:refs/remotes/origin/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'merge.return_value': 'merge return value',
+    }))
+    def test_git_merge_none(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull=None, single_fetch=True)
+
+        repo.git_merge(output)
+
+        self.assertFalse(output.send.called)
+        self.assertFalse(repo.handle.merge.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'merge.return_value': 'merge return value',
+    }))
+    def test_git_merge(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', single_fetch=True)
+
+        repo.git_merge(output)
+
+        output.send.assert_has_calls([
+            mock.call("Merging in changes from origin"),
+            mock.call("merge return value"),
+        ])
+        repo.handle.merge.assert_called_once_with(
+            'refs/remotes/origin/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'merge.return_value': 'merge return value',
+    }))
+    def test_git_merge_refspec(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', single_fetch=True,
+                            fetch_refspec='+refs/heads/master:refs/up/master')
+
+        repo.git_merge(output)
+
+        repo.handle.merge.assert_called_once_with('refs/up/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_fetched_ref_default(self, mock_expanduser):
+        repo = freshen.Repo('repo', pull='upstream')
+
+        self.assertEqual(repo.fetched_ref('upstream'),
+                         'refs/remotes/upstream/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_fetched_ref_refspecs(self, mock_expanduser):
+        repo = freshen.Repo('repo', branch='stable', fetch_refspec=(
+            'refs/tags/*:refs/tags/* ^refs/heads/stable '
+            'refs/heads/st*e:refs/mine/*'))
+
+        self.assertEqual(repo.fetched_ref('origin'), 'refs/mine/abl')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'config.return_value': '+refs/heads/*:refs/remotes/origin/*\n'
+                               '+refs/notes/*:refs/notes/*',
+    }))
+    def test_fetched_ref_remote_refspecs(self, mock_expanduser):
+        repo = freshen.Repo('repo', fetch_refspec='')
+
+        self.assertEqual(repo.fetched_ref('origin'),
+                         'refs/remotes/origin/master')
+        repo.handle.config.assert_called_once_with(
+            '--get-all', 'remote.origin.fetch')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_fetched_ref_unstored(self, mock_expanduser):
+        repo = freshen.Repo('repo', fetch_refspec='master refs/tags/v1:v1')
+
+        with self.assertRaises(ValueError) as cm:
+            repo.fetched_ref('origin')
+
+        self.assertEqual(str(cm.exception), "The fetch refspecs for origin "
+                         "do not store branch master")
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'pull.return_value': 'pull return value',
+    }))
+    def test_git_pull_none(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull=None)
+
+        repo.git_pull(output)
+
+        self.assertFalse(output.send.called)
+        self.assertFalse(repo.handle.pull.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'pull.return_value': 'pull return value',
+    }))
+    def test_git_pull(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_pull(output)
+
+        output.send.assert_has_calls([
+            mock.call("Pulling in changes from origin"),
+            mock.call("pull return value"),
+        ])
+        repo.handle.pull.assert_called_once_with('origin', 'master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    def test_git_reset_none(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull=None, fetch_depth='1')
+
+        repo.git_reset(output)
+
+        self.assertFalse(output.send.called)
+        self.assertFalse(repo.handle.reset.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'reset.return_value': 'reset return value',
+    }))
+    def test_git_reset(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', fetch_depth='1')
+
+        repo.git_reset(output)
+
+        output.send.assert_has_calls([
+            mock.call("Resetting branch master to origin"),
+            mock.call("reset return value"),
+        ])
+        repo.handle.reset.assert_called_once_with(
+            '--keep', 'refs/remotes/origin/master')
+        self.assertIn('git_reset', repo.timings)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'push.return_value': 'push return value',
+    }))
+    def test_git_push_none(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_push(output)
+
+        self.assertFalse(output.send.called)
+        self.assertFalse(repo.handle.push.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'push.return_value': 'push return value',
+    }))
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='new')
+    @mock.patch.object(freshen.Repo, 'get_pushed_sha', return_value='old')
+    def test_git_push(self, mock_get_pushed_sha, mock_get_sha,
+                      mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', push='origin')
+
+        repo.git_push(output)
+
+        output.send.assert_has_calls([
+            mock.call("Pushing out changes to origin"),
+            mock.call("push return value"),
+        ])
+        mock_get_sha.assert_called_once_with('refs/heads/master')
+        repo.handle.push.assert_called_once_with(
+            '--force', 'origin', 'refs/heads/master:refs/heads/master')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='new')
+    @mock.patch.object(freshen.Repo, 'get_pushed_sha', return_value='new')
+    def test_git_push_up_to_date(self, mock_get_pushed_sha, mock_get_sha,
+                                 mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', push='mirror')
+
+        repo.git_push(output)
+
+        output.send.assert_called_once_with(
+            "Branch master is up to date on mirror; skipping push")
+        self.assertFalse(repo.handle.push.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'get_sha', return_value='sha')
+    @mock.patch.object(freshen.Repo, 'get_remote_sha')
+    def test_get_pushed_sha_fetched(self, mock_get_remote_sha, mock_get_sha,
+                                    mock_expanduser):
+        repo = freshen.Repo('repo', pull='upstream', push='upstream')
+
+        self.assertEqual(repo.get_pushed_sha(), 'sha')
+        mock_get_sha.assert_called_once_with(
+            'refs/remotes/upstream/master')
+        self.assertFalse(mock_get_remote_sha.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'get_sha')
+    @mock.patch.object(freshen.Repo, 'get_remote_sha', return_value='sha')
+    def test_get_pushed_sha_remote(self, mock_get_remote_sha, mock_get_sha,
+                                   mock_expanduser):
+        repo = freshen.Repo('repo', push='mirror')
+        other = freshen.Repo('repo', push='origin', fetch_refspec='')
+
+        self.assertEqual(repo.get_pushed_sha(), 'sha')
+        self.assertEqual(other.get_pushed_sha(), 'sha')
+        mock_get_remote_sha.assert_has_calls([
+            mock.call('mirror'),
+            mock.call('origin'),
+        ])
+        self.assertFalse(mock_get_sha.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'get_remote_sha',
+                       side_effect=git.exc.GitCommandError(['git'], 128))
+    def test_get_pushed_sha_failed(self, mock_get_remote_sha,
+                                   mock_expanduser):
+        repo = freshen.Repo('repo', push='mirror')
+
+        self.assertEqual(repo.get_pushed_sha(), None)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    def test_connection_unlimited(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        with repo.connection('origin'):
+            pass
+
+        self.assertFalse(repo.handle.ls_remote.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'ls_remote.return_value': 'git@example.com:repo.git',
+    }))
+    def test_connection(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo.host_limiter = mock.Mock(**{
+            'acquire.return_value': mock.MagicMock(),
+        })
+
+        with repo.connection('origin'):
+            acquired = repo.host_limiter.acquire.return_value
+            acquired.__enter__.assert_called_once_with()
+
+        repo.handle.ls_remote.assert_called_once_with('--get-url', 'origin')
+        repo.host_limiter.acquire.assert_called_once_with('example.com')
+        self.assertEqual(
+            repo.host_limiter.acquire.return_value.__exit__.call_count, 1)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'ls_remote.side_effect': lambda *args: {
+            'origin': 'git@example.com:repo.git',
+            'mirror': '/srv/repo.git',
+        }[args[1]],
+    }))
+    def test_connection_cached(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo.host_limiter = mock.Mock(**{
+            'acquire.return_value': mock.MagicMock(),
+        })
+
+        for remote in ('origin', 'mirror', 'origin', 'mirror'):
+            with repo.connection(remote):
+                pass
+
+        self.assertEqual(repo.handle.ls_remote.call_args_list, [
+            mock.call('--get-url', 'origin'),
+            mock.call('--get-url', 'mirror'),
+        ])
+        self.assertEqual(repo.host_limiter.acquire.call_args_list, [
+            mock.call('example.com'),
+            mock.call(None),
+            mock.call('example.com'),
+            mock.call(None),
+        ])
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', '', 0))
+    def test_install_none(self, mock_Popen, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.install(output)
+
+        self.assertFalse(output.send.called)
+        self.assertFalse(mock_Popen.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', '', 0))
+    def test_install_no_output(self, mock_Popen, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='install')
+
+        repo.install(output)
+
+        output.send.assert_has_calls([
+            mock.call('Installing repository repo with command '
+                      "'sudo python setup.py install'"),
         ])
         self.assertEqual(output.send.call_count, 1)
         mock_Popen.assert_called_once_with(
             ['sudo', 'python', 'setup.py', 'install'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd='/home/test/devel/src/repo')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('output 1\noutput 2\n', 'error 1\n', 0))
+    def test_install_with_output(self, mock_Popen, mock_expanduser):
+        output = FakeOutput()
+        repo = freshen.Repo('repo', install_mode='install')
+
+        repo.install(output)
+
+        self.assertEqual(output.msgs[0],
+                         'Installing repository repo with command '
+                         "'sudo python setup.py install'")
+        self.assertEqual(output.stream('Stdout:'), [
+            'Stdout: output 1\n',
+            'Stdout: output 2\n',
+        ])
+        self.assertEqual(output.stream('Stderr:'), ['Stderr: error 1\n'])
+        self.assertEqual(len(output.msgs), 4)
+        mock_Popen.assert_called_once_with(
+            ['sudo', 'python', 'setup.py', 'install'],
+            bufsize=-1, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd='/home/test/devel/src/repo')
-        mock_Popen.return_value.communicate.assert_called_once_with()
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(subprocess, 'Popen', return_value=mock.Mock(**{
-        'communicate.return_value': ('standard output', 'standard error'),
-    }))
-    def test_install_with_output(self, mock_Popen, mock_expanduser):
-        output = mock.Mock()
-        repo = freshen.Repo('repo', install_mode='install')
-
-        repo.install(output)
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', 'error: failed', 1))
+    def test_install_failed(self, mock_Popen, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='install')
+        repo.state = mock.Mock(**{'get_value.return_value': 'old hash'})
+
+        with mock.patch.object(freshen.Repo, 'get_install_hash',
+                               return_value='new hash'):
+            self.assertRaises(subprocess.CalledProcessError,
+                              repo.install, output)
+
+        output.send.assert_has_calls([
+            mock.call('Installing repository repo with command '
+                      "'sudo python setup.py install'"),
+            mock.call('Stderr: error: failed'),
+        ])
+        self.assertFalse(repo.state.set_value.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', '', 0))
+    @mock.patch.object(freshen.Repo, 'get_install_hash',
+                       return_value='new hash')
+    def test_install_cache_changed(self, mock_get_install_hash, mock_Popen,
+                                   mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='develop')
+        repo.state = mock.Mock(**{'get_value.return_value': 'old hash'})
+
+        repo.install(output)
+
+        self.assertEqual(mock_Popen.call_count, 1)
+        repo.state.get_value.assert_called_once_with(
+            '/home/test/devel/src/repo', 'install_hash')
+        repo.state.set_value.assert_called_once_with(
+            '/home/test/devel/src/repo', 'install_hash', 'new hash')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', '', 0))
+    @mock.patch.object(freshen.Repo, 'get_install_hash',
+                       return_value='new hash')
+    def test_install_directory(self, mock_get_install_hash, mock_Popen,
+                               mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='install')
+        repo.state = mock.Mock(**{'get_value.return_value': 'old hash'})
+
+        repo.install(output, '/wt', 'refs/heads/master')
+
+        mock_get_install_hash.assert_called_once_with('/wt',
+                                                      'refs/heads/master')
+        self.assertEqual(mock_Popen.call_args[1]['cwd'], '/wt')
+        repo.state.set_value.assert_called_once_with(
+            '/home/test/devel/src/repo', 'install_hash', 'new hash')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen')
+    @mock.patch.object(freshen.Repo, 'get_install_hash',
+                       return_value='old hash')
+    def test_install_cache_unchanged(self, mock_get_install_hash, mock_Popen,
+                                     mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='develop')
+        repo.state = mock.Mock(**{'get_value.return_value': 'old hash'})
+
+        repo.install(output)
+
+        output.send.assert_called_once_with(
+            "Repository repo unchanged since last install; skipping install")
+        self.assertFalse(mock_Popen.called)
+        self.assertFalse(repo.state.set_value.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(subprocess, 'Popen', side_effect=lambda *a, **kw:
+                       make_proc('', '', 0))
+    @mock.patch.object(freshen.Repo, 'get_install_hash',
+                       return_value='old hash')
+    def test_install_cache_disabled(self, mock_get_install_hash, mock_Popen,
+                                    mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', install_mode='develop',
+                            install_cache='no')
+        repo.state = mock.Mock(**{'get_value.return_value': 'old hash'})
+
+        repo.install(output)
+
+        self.assertEqual(mock_Popen.call_count, 1)
+        self.assertFalse(mock_get_install_hash.called)
+        self.assertFalse(repo.state.set_value.called)
+
+    def test_get_install_hash(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        tempdir = os.path.join(basedir, 'repo')
+        os.mkdir(tempdir)
+        for name in ('setup.py', 'requirements.txt', 'freshen.py'):
+            with open(os.path.join(tempdir, name), 'w') as f:
+                f.write('%s contents\n' % name)
+        repo = freshen.Repo('repo', basedir=basedir, install_mode='develop')
+
+        with mock.patch.object(freshen.Repo, 'get_sha', return_value='sha1'):
+            develop = repo.get_install_hash()
+
+            # Changes to other files don't matter
+            with open(os.path.join(tempdir, 'freshen.py'), 'w') as f:
+                f.write('new contents\n')
+            self.assertEqual(repo.get_install_hash(), develop)
+
+            # Changes to requirements do
+            with open(os.path.join(tempdir, 'test-requirements.txt'),
+                      'w') as f:
+                f.write('mock\n')
+            self.assertNotEqual(repo.get_install_hash(), develop)
+            develop = repo.get_install_hash()
+
+            repo.install_mode = 'install'
+            install = repo.get_install_hash()
+            self.assertNotEqual(install, develop)
+
+        # The checked out commit only matters for a regular install
+        with mock.patch.object(freshen.Repo, 'get_sha', return_value='sha2'):
+            self.assertNotEqual(repo.get_install_hash(), install)
+            repo.install_mode = 'develop'
+            self.assertEqual(repo.get_install_hash(), develop)
+
+    def test_get_install_hash_directory(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        tempdir = os.path.join(basedir, 'repo')
+        worktree = os.path.join(tempdir, '.git', 'freshen-worktree')
+        os.makedirs(worktree)
+        for directory in (tempdir, worktree):
+            with open(os.path.join(directory, 'setup.py'), 'w') as f:
+                f.write('setup contents\n')
+        repo = freshen.Repo('repo', basedir=basedir, install_mode='develop')
+
+        with mock.patch.object(freshen.Repo, 'get_sha', return_value='sha1'):
+            main = repo.get_install_hash()
+            other = repo.get_install_hash(worktree, 'refs/heads/master')
+
+            # A develop install must be redone from another directory
+            self.assertNotEqual(other, main)
+            self.assertEqual(repo.get_install_hash(tempdir), main)
+
+            # A regular install copies the files, wherever they are
+            repo.install_mode = 'install'
+            self.assertEqual(
+                repo.get_install_hash(worktree, 'refs/heads/master'),
+                repo.get_install_hash())
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'gc.return_value': 'gc return value',
+    }))
+    def test_git_gc(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_gc(output)
+
+        output.send.assert_called_once_with('gc return value')
+        repo.handle.gc.assert_called_once_with()
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'count_objects.return_value': ('count: 12\n'
+                                       'size: 48\n'
+                                       'in-pack: 1000\n'
+                                       'size-pack: 2048\n'
+                                       'garbage: 0\n'),
+    }))
+    def test_count_objects(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.count_objects()
+
+        self.assertEqual(result, {
+            'count': 12, 'size': 48, 'in-pack': 1000, 'size-pack': 2048,
+            'garbage': 0,
+        })
+        self.assertEqual(repo.get_object_bytes(), 2096 * 1024)
+        repo.handle.count_objects.assert_called_with('-v')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'maintenance.return_value': 'maintenance return value',
+    }))
+    @mock.patch.object(freshen.Repo, 'count_objects',
+                       return_value={'packs': 2})
+    def test_git_maintenance(self, mock_count_objects, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_maintenance(output)
+
+        self.assertEqual(repo.handle.maintenance.call_args_list, [
+            mock.call('run', '--task=loose-objects', '--task=commit-graph'),
+            mock.call('run', '--task=incremental-repack'),
+        ])
+        self.assertEqual(output.send.call_count, 2)
+        self.assertIn('git_maintenance', repo.timings)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'maintenance.return_value': 'maintenance return value',
+    }))
+    @mock.patch.object(freshen.Repo, 'count_objects',
+                       return_value={'packs': 0})
+    def test_git_maintenance_nopacks(self, mock_count_objects,
+                                     mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_maintenance(output)
+
+        repo.handle.maintenance.assert_called_once_with(
+            'run', '--task=loose-objects', '--task=commit-graph')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'count_objects', return_value={
+        'count': 100, 'packs': 3,
+    })
+    def test_needs_gc_below(self, mock_count_objects, mock_expanduser):
+        repo = freshen.Repo('repo', gc_loose_threshold='101',
+                            gc_pack_threshold='4')
+
+        result = repo.needs_gc()
+
+        self.assertEqual(result, (False, "100 loose objects (threshold 101), "
+                                  "3 packs (threshold 4)"))
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'count_objects', return_value={
+        'count': 100, 'packs': 3,
+    })
+    def test_needs_gc_loose(self, mock_count_objects, mock_expanduser):
+        repo = freshen.Repo('repo', gc_loose_threshold='100')
+
+        result = repo.needs_gc()
+
+        self.assertEqual(result, (True, "100 loose objects (threshold 100)"))
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'count_objects', return_value={
+        'count': 100, 'packs': 3,
+    })
+    def test_needs_gc_packs(self, mock_count_objects, mock_expanduser):
+        repo = freshen.Repo('repo', gc_pack_threshold='3')
+
+        result = repo.needs_gc()
+
+        self.assertEqual(result, (True, "3 packs (threshold 3)"))
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'count_objects',
+                       side_effect=git.exc.GitCommandError('count', 128))
+    def test_get_object_bytes_error(self, mock_count_objects,
+                                    mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.get_object_bytes(), None)
+
+    def test_get_object_bytes_missing(self):
+        tempdir = make_tempdir(self)
+
+        for backend in each_backend():
+            repo = freshen.Repo('missing', basedir=tempdir)
+            repo.git_backend = backend
+
+            self.assertEqual(repo.get_object_bytes(), None)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'merge_base.side_effect': [None, git.exc.GitCommandError('mb', 1)],
+    }))
+    def test_is_ancestor(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.is_ancestor('a', 'b'), True)
+        self.assertEqual(repo.is_ancestor('b', 'a'), False)
+        repo.handle.merge_base.assert_called_with('--is-ancestor', 'b', 'a')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'is_ancestor', side_effect=[False, True])
+    def test_git_fast_forward(self, mock_is_ancestor, mock_get_sha,
+                              mock_handle, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', pull='upstream')
+
+        repo.git_fast_forward(output)
+
+        mock_get_sha.assert_has_calls([
+            mock.call('refs/heads/master'),
+            mock.call('refs/remotes/upstream/master'),
+        ])
+        mock_is_ancestor.assert_has_calls([
+            mock.call('new', 'old'),
+            mock.call('old', 'new'),
+        ])
+        output.send.assert_called_once_with(
+            "Fast-forwarding branch master to new")
+        mock_handle.update_ref.assert_called_once_with(
+            '-m', 'freshen: fast-forward', 'refs/heads/master', 'new', 'old')
+        self.assertIn('git_fast_forward', repo.timings)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'is_ancestor')
+    def test_git_fast_forward_shallow(self, mock_is_ancestor, mock_get_sha,
+                                      mock_handle, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', fetch_depth='1')
+
+        repo.git_fast_forward(output)
+
+        output.send.assert_called_once_with("Resetting branch master to new")
+        mock_handle.update_ref.assert_called_once_with(
+            '-m', 'freshen: reset', 'refs/heads/master', 'new', 'old')
+        self.assertFalse(mock_is_ancestor.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['new', 'old'])
+    @mock.patch.object(freshen.Repo, 'is_ancestor', return_value=True)
+    def test_git_fast_forward_current(self, mock_is_ancestor, mock_get_sha,
+                                      mock_handle, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+
+        repo.git_fast_forward(output)
+
+        output.send.assert_called_once_with(
+            "Branch master is up to date with origin")
+        self.assertFalse(mock_handle.update_ref.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'is_ancestor', return_value=False)
+    @mock.patch.object(freshen.Repo, 'git_worktree', return_value='/wt')
+    @mock.patch('git.Git')
+    def test_git_fast_forward_merge(self, mock_Git, mock_git_worktree,
+                                    mock_is_ancestor, mock_get_sha,
+                                    mock_handle, mock_expanduser):
+        output = mock.Mock()
+        handle = mock_Git.return_value
+        handle.merge.return_value = 'merge return value'
+        repo = freshen.Repo('repo')
+
+        repo.git_fast_forward(output)
+
+        mock_git_worktree.assert_called_once_with(output, 'master')
+        mock_Git.assert_called_once_with('/wt')
+        self.assertEqual(handle.mock_calls, [
+            mock.call.merge('--no-edit', 'refs/remotes/origin/master'),
+            mock.call.checkout('--detach'),
+        ])
+        output.send.assert_has_calls([
+            mock.call("Merging in changes from origin in /wt"),
+            mock.call('merge return value'),
+        ])
+        self.assertFalse(mock_handle.update_ref.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle')
+    @mock.patch.object(freshen.Repo, 'get_sha', side_effect=['old', 'new'])
+    @mock.patch.object(freshen.Repo, 'is_ancestor', return_value=False)
+    @mock.patch.object(freshen.Repo, 'git_worktree', return_value='/wt')
+    @mock.patch('git.Git')
+    def test_git_fast_forward_conflict(self, mock_Git, mock_git_worktree,
+                                       mock_is_ancestor, mock_get_sha,
+                                       mock_handle, mock_expanduser):
+        output = mock.Mock()
+        handle = mock_Git.return_value
+        handle.merge.side_effect = [git.exc.GitCommandError('merge', 1),
+                                    None]
+        repo = freshen.Repo('repo')
+
+        self.assertRaises(git.exc.GitCommandError, repo.git_fast_forward,
+                          output)
+
+        self.assertEqual(handle.mock_calls, [
+            mock.call.merge('--no-edit', 'refs/remotes/origin/master'),
+            mock.call.merge('--abort', with_exceptions=False),
+            mock.call.checkout('--detach'),
+        ])
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock())
+    @mock.patch.object(freshen.Repo, 'refs',
+                       mock.Mock(gitdir='/src/repo/.git'))
+    @mock.patch('os.path.isdir', return_value=False)
+    @mock.patch('git.Git')
+    def test_git_worktree_create(self, mock_Git, mock_isdir,
+                                 mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', branch='stable')
+
+        result = repo.git_worktree(output)
+
+        self.assertEqual(result, '/src/repo/.git/freshen-worktree')
+        self.assertFalse(repo.handle.rev_parse.called)
+        repo.handle.worktree.assert_has_calls([
+            mock.call('prune'),
+            mock.call('add', '/src/repo/.git/freshen-worktree', '--detach',
+                      'refs/heads/stable'),
+        ])
+        output.send.assert_called_once_with(
+            "Creating worktree /src/repo/.git/freshen-worktree")
+        self.assertFalse(mock_Git.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'rev_parse.return_value': '/src/repo/.git',
+    }))
+    @mock.patch('os.path.isdir', return_value=True)
+    @mock.patch('git.Git')
+    def test_git_worktree_existing(self, mock_Git, mock_isdir,
+                                   mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo', branch='stable')
+
+        # If the git directory cannot be read, git is asked for it
+        refs = mock.Mock()
+        type(refs).gitdir = mock.PropertyMock(
+            side_effect=ValueError('Unrecognized .git file'))
+        with mock.patch.object(freshen.Repo, 'refs', refs):
+            result = repo.git_worktree(output, 'stable')
+
+        self.assertEqual(result, '/src/repo/.git/freshen-worktree')
+        repo.handle.rev_parse.assert_called_once_with('--absolute-git-dir')
+        mock_Git.assert_called_once_with('/src/repo/.git/freshen-worktree')
+        mock_Git.return_value.checkout.assert_called_once_with('stable')
+        self.assertFalse(output.send.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'execute.return_value': 'execute return value',
+    }))
+    def test_git_gc_limited(self, mock_expanduser):
+        output = mock.Mock()
+        repo = freshen.Repo('repo')
+        repo.command_prefix = ['nice', '-n', '10']
+        repo.git_config = {'pack.windowMemory': '64m', 'pack.threads': 2}
+
+        repo.git_gc(output)
+
+        output.send.assert_called_once_with('execute return value')
+        repo.handle.execute.assert_called_once_with([
+            'nice', '-n', '10', 'git', '-c', 'pack.threads=2',
+            '-c', 'pack.windowMemory=64m', 'gc',
+        ])
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
+        'count_objects.return_value': 'count return value',
+    }))
+    def test_run_limited_unlimited(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        result = repo.run_limited('count-objects', '-v')
+
+        self.assertEqual(result, 'count return value')
+        repo.handle.count_objects.assert_called_once_with('-v')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch('git.Git', return_value='computed')
+    def test_handle_cached(self, mock_Git, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo._handle = 'cached'
+
+        self.assertEqual(repo.handle, 'cached')
+        self.assertFalse(mock_Git.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch('git.Git', return_value='computed')
+    def test_handle_computed(self, mock_Git, mock_expanduser):
+        repo = freshen.Repo('repo')
+
+        self.assertEqual(repo.handle, 'computed')
+        mock_Git.assert_called_once_with('/home/test/devel/src/repo')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_timeout(self, mock_expanduser):
+        self.assertEqual(freshen.Repo('repo').timeout, {})
+        self.assertEqual(freshen.Repo('repo', git_timeout='30').timeout,
+                         {'kill_after_timeout': 30.0})
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch('git.Git')
+    def test_make_handle_asyncio(self, mock_Git, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo.git_backend = 'backend'
+
+        handle = repo.make_handle('/worktree')
+
+        self.assertIsInstance(handle, freshen.AsyncGit)
+        self.assertEqual(handle.working_dir, '/worktree')
+        self.assertEqual(handle.backend, 'backend')
+        self.assertEqual(handle.stream, repo.send_progress)
+        self.assertFalse(mock_Git.called)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    @mock.patch.object(freshen.Repo, 'ssh_command', return_value='ssh -o x')
+    def test_make_handle_ssh(self, mock_ssh_command, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo.ssh_options = '-o x'
+
+        handle = repo.make_handle('/worktree')
+
+        self.assertEqual(handle.environment(),
+                         {'GIT_SSH_COMMAND': 'ssh -o x'})
+        mock_ssh_command.assert_called_once_with(handle)
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_ssh_command(self, mock_expanduser):
+        repo = freshen.Repo('repo')
+        repo.ssh_options = '-o x'
+        configured = mock.Mock(**{'config.return_value': 'ssh -i key\n'})
+        unconfigured = mock.Mock(**{'config.return_value': ''})
 
-        output.send.assert_has_calls([
-            mock.call('Installing repository repo with command '
-                      "'sudo python setup.py install'"),
-            mock.call('Stdout:', 'standard output'),
-            mock.call('Stderr:', 'standard error'),
-        ])
-        self.assertEqual(output.send.call_count, 3)
-        mock_Popen.assert_called_once_with(
-            ['sudo', 'python', 'setup.py', 'install'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            cwd='/home/test/devel/src/repo')
-        mock_Popen.return_value.communicate.assert_called_once_with()
+        with mock.patch.dict(os.environ, {'GIT_SSH_COMMAND': 'ssh -i env',
+                                          'GIT_SSH': '/bin/my ssh'}):
+            self.assertEqual(repo.ssh_command(configured),
+                             'ssh -i env -o x')
+        with mock.patch.dict(os.environ, {'GIT_SSH': '/bin/my ssh'},
+                             clear=True):
+            self.assertEqual(repo.ssh_command(configured),
+                             'ssh -i key -o x')
+            self.assertEqual(repo.ssh_command(unconfigured),
+                             "'/bin/my ssh' -o x")
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(repo.ssh_command(unconfigured), 'ssh -o x')
+        configured.config.assert_called_with(
+            '--get', 'core.sshCommand', with_exceptions=False)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch.object(freshen.Repo, 'handle', mock.Mock(**{
-        'gc.return_value': 'gc return value',
-    }))
-    def test_git_gc(self, mock_expanduser):
-        output = mock.Mock()
+    def test_streaming(self, mock_expanduser):
         repo = freshen.Repo('repo')
+        outer = mock.Mock()
+        inner = mock.Mock()
 
-        repo.git_gc(output)
+        repo.send_progress('dropped')
+        with repo.streaming(outer):
+            repo.send_progress('one')
+            with repo.streaming(inner):
+                repo.send_progress('two')
+            repo.send_progress('three')
 
-        output.send.assert_called_once_with('gc return value')
-        repo.handle.gc.assert_called_once_with()
+        self.assertEqual(repo.progress, None)
+        self.assertEqual(outer.send.call_args_list,
+                         [mock.call('one'), mock.call('three')])
+        inner.send.assert_called_once_with('two')
+
+
+class TestStateStore(unittest2.TestCase):
+    def test_init(self):
+        state = freshen.StateStore('state.db', 'freshen')
+
+        self.assertEqual(state.filename, 'state.db')
+        self.assertEqual(state.command, 'freshen')
+        self.assertEqual(state.db, None)
+        self.assertEqual(state.run_id, None)
+
+    @mock.patch('sqlite3.connect')
+    def test_disabled(self, mock_connect):
+        state = freshen.StateStore(None, 'freshen')
+
+        with state:
+            state.record(make_repo('repo'), 'succeeded')
+            self.assertEqual(state.last_result('/src/repo'), None)
+            state.set_value('/src/repo', 'key', 'value')
+            self.assertEqual(state.get_value('/src/repo', 'key'), None)
+
+        self.assertFalse(mock_connect.called)
+
+    def test_record(self):
+        filename = os.path.join(make_tempdir(self), 'state.db')
+        repo1 = make_repo('repo1', start_sha='abc', end_sha='def',
+                          timings={'git_fetch': 1.5, 'install': 3.0})
+        repo2 = make_repo('repo2', start_sha=None, end_sha=None)
+
+        with freshen.StateStore(filename, 'freshen') as state:
+            state.record(repo1, 'succeeded')
+            state.record(repo2, 'failed', Exception('broken'))
+
+        self.assertEqual(state.db, None)
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute(
+            "SELECT id, command, finished IS NOT NULL FROM runs").fetchall(),
+            [(state.run_id, 'freshen', 1)])
+        self.assertEqual(db.execute(
+            "SELECT directory, name, outcome, error, start_sha, end_sha "
+            "FROM results ORDER BY name").fetchall(), [
+            ('/src/repo1', 'repo1', 'succeeded', None, 'abc', 'def'),
+            ('/src/repo2', 'repo2', 'failed', 'broken', None, None),
+        ])
+        self.assertEqual(db.execute(
+            "SELECT directory, stage, duration FROM stages "
+            "ORDER BY stage").fetchall(), [
+            ('/src/repo1', 'git_fetch', 1.5),
+            ('/src/repo1', 'install', 3.0),
+        ])
+
+    def test_last_result(self):
+        filename = os.path.join(make_tempdir(self), 'state.db')
+
+        with mock.patch('time.time', return_value=100.0):
+            with freshen.StateStore(filename, 'freshen') as state:
+                state.record(make_repo(
+                    'repo', start_sha='abc', end_sha='def'), 'succeeded')
+        with mock.patch('time.time', return_value=200.0):
+            with freshen.StateStore(filename, 'freshen') as state:
+                state.record(make_repo('repo', start_sha='def',
+                                       end_sha=None),
+                             'failed', Exception('broken'))
+            with freshen.StateStore(filename, 'compact') as state:
+                state.record(make_repo('repo'), 'succeeded')
+
+        with freshen.StateStore(filename, 'freshen') as state:
+            self.assertEqual(state.last_result('/src/repo'), {
+                'outcome': 'failed',
+                'error': 'broken',
+                'start_sha': 'def',
+                'end_sha': None,
+                'finished': 200.0,
+            })
+            self.assertEqual(state.last_result('/src/other'), None)
+
+    def test_values(self):
+        filename = os.path.join(make_tempdir(self), 'state.db')
+
+        with freshen.StateStore(filename, 'freshen') as state:
+            self.assertEqual(state.get_value('/src/repo', 'key'), None)
+            state.set_value('/src/repo', 'key', 'value1')
+            state.set_value('/src/other', 'key', 'other')
+            state.set_value('/src/repo', 'key', 'value2')
+
+        with freshen.StateStore(filename, 'compact') as state:
+            self.assertEqual(state.get_value('/src/repo', 'key'), 'value2')
+            self.assertEqual(state.get_value('/src/other', 'key'), 'other')
+
+    def test_threads(self):
+        filename = os.path.join(make_tempdir(self), 'state.db')
+        repos = [make_repo('repo%d' % i) for i in range(8)]
+
+        with freshen.StateStore(filename, 'freshen') as state:
+            threads = [threading.Thread(target=state.record,
+                                        args=(repo, 'succeeded'))
+                       for repo in repos]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for repo in repos:
+                self.assertEqual(
+                    state.last_result(repo.directory)['outcome'],
+                    'succeeded')
+
+
+class TestPercentile(unittest2.TestCase):
+    def test_empty(self):
+        self.assertEqual(freshen.percentile([], 50), None)
+
+    def test_nearest_rank(self):
+        values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+
+        self.assertEqual(freshen.percentile(values, 0), 1)
+        self.assertEqual(freshen.percentile(values, 50), 5)
+        self.assertEqual(freshen.percentile(values, 95), 10)
+        self.assertEqual(freshen.percentile(values, 100), 10)
+
+
+class TestRunReport(unittest2.TestCase):
+    def test_disabled(self):
+        report = freshen.RunReport('', 'freshen')
+
+        with report:
+            report.record(make_repo('repo0'), 'succeeded')
+
+        self.assertEqual(report.repos, [])
+
+    @mock.patch('time.time')
+    def test_report(self, mock_time):
+        mock_time.side_effect = [100.0, 110.0]
+        tempdir = make_tempdir(self)
+        filename = os.path.join(tempdir, 'report.json')
+        report = freshen.RunReport(filename, 'freshen')
+
+        with report:
+            report.record(make_repo('repo0', timings={
+                'git_fetch': 1.0, 'install': 4.0,
+            }), 'succeeded')
+            report.record(make_repo('repo1', timings={
+                'git_fetch': 3.0,
+            }), 'failed', Exception('oops'))
+            report.record(make_repo('repo2'), 'skipped')
+
+        with open(filename) as f:
+            result = json.load(f)
+        self.assertEqual(result['command'], 'freshen')
+        self.assertEqual(result['started'], 100.0)
+        self.assertEqual(result['duration'], 10.0)
+        self.assertEqual(result['outcomes'], {
+            'succeeded': 1, 'failed': 1, 'skipped': 1,
+        })
+        self.assertEqual(result['repos'][1], {
+            'name': 'repo1',
+            'directory': '/src/repo1',
+            'outcome': 'failed',
+            'error': 'oops',
+            'start_sha': '1111',
+            'end_sha': '2222',
+            'stages': {'git_fetch': 3.0},
+            'duration': 3.0,
+        })
+        self.assertEqual(result['stages'], {
+            'git_fetch': {
+                'count': 2, 'total': 4.0, 'p50': 1.0, 'p95': 3.0,
+                'max': 3.0,
+            },
+            'install': {
+                'count': 1, 'total': 4.0, 'p50': 4.0, 'p95': 4.0,
+                'max': 4.0,
+            },
+            'total': {
+                'count': 2, 'total': 8.0, 'p50': 3.0, 'p95': 5.0,
+                'max': 5.0,
+            },
+        })
+
+
+class TestMetricsExporter(unittest2.TestCase):
+    def test_disabled(self):
+        metrics = freshen.MetricsExporter(None, 'freshen')
+
+        with metrics:
+            metrics.record(make_repo(), 'succeeded')
+
+        self.assertEqual(metrics.filename, None)
+        self.assertEqual(metrics.results, [])
+
+    @mock.patch('time.time')
+    def test_metrics(self, mock_time):
+        mock_time.side_effect = [100.0, 112.5]
+        tempdir = make_tempdir(self)
+        metrics = freshen.MetricsExporter(tempdir, 'freshen')
+
+        with metrics:
+            metrics.record(make_repo(timings={'git_fetch': 0.2,
+                                              'install': 45.0},
+                                     fetched_bytes=1024), 'succeeded')
+            metrics.record(make_repo(timings={'git_fetch': 0.4},
+                                     end_sha='1111', fetched_bytes=0),
+                           'succeeded')
+            metrics.record(make_repo(timings={'git_fetch': 3.0}),
+                           'failed', Exception('oops'))
+            metrics.record(make_repo(end_sha=None), 'skipped')
+
+        self.assertEqual(os.listdir(tempdir), ['freshen.prom'])
+        with open(os.path.join(tempdir, 'freshen.prom')) as f:
+            lines = f.read().splitlines()
+        for line in [
+                '# TYPE freshen_run_duration_seconds gauge',
+                'freshen_run_duration_seconds{command="freshen"} 12.5',
+                'freshen_run_finished_timestamp_seconds'
+                '{command="freshen"} 112.5',
+                'freshen_repos{command="freshen",outcome="failed"} 1.0',
+                'freshen_repos{command="freshen",outcome="skipped"} 1.0',
+                'freshen_repos{command="freshen",outcome="succeeded"} 2.0',
+                'freshen_repos_updated{command="freshen"} 1.0',
+                'freshen_fetched_bytes{command="freshen"} 1024.0',
+                '# TYPE freshen_stage_duration_seconds histogram',
+                'freshen_stage_duration_seconds_bucket'
+                '{command="freshen",stage="git_fetch",le="0.25"} 1.0',
+                'freshen_stage_duration_seconds_bucket'
+                '{command="freshen",stage="git_fetch",le="0.5"} 2.0',
+                'freshen_stage_duration_seconds_bucket'
+                '{command="freshen",stage="git_fetch",le="+Inf"} 3.0',
+                'freshen_stage_duration_seconds_count'
+                '{command="freshen",stage="git_fetch"} 3.0',
+                'freshen_stage_duration_seconds_bucket'
+                '{command="freshen",stage="install",le="30"} 0.0',
+                'freshen_stage_duration_seconds_bucket'
+                '{command="freshen",stage="install",le="60"} 1.0',
+                'freshen_stage_duration_seconds_sum'
+                '{command="freshen",stage="install"} 45.0']:
+            self.assertIn(line, lines)
+
+
+class TestGetMetrics(unittest2.TestCase):
+    def test_unconfigured(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoOptionError('metrics',
+                                                          'repos'),
+        })
+
+        result = freshen.get_metrics(cfg, None, 'freshen')
+
+        self.assertEqual(result.directory, None)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch('git.Git', return_value='computed')
-    def test_handle_cached(self, mock_Git, mock_expanduser):
-        repo = freshen.Repo('repo')
-        repo._handle = 'cached'
+    def test_configured(self, mock_expanduser):
+        cfg = mock.Mock(**{'get.return_value': '~/textfile'})
 
-        self.assertEqual(repo.handle, 'cached')
-        self.assertFalse(mock_Git.called)
+        result = freshen.get_metrics(cfg, None, 'compact')
+
+        self.assertEqual(result.filename, '/home/test/textfile/compact.prom')
+
+
+class TestRecorders(unittest2.TestCase):
+    def test_fanout(self):
+        parent = mock.MagicMock()
+        recorders = freshen.Recorders(parent.first, parent.second)
+
+        with recorders:
+            recorders.record('repo', 'failed', 'error')
+
+        self.assertEqual(parent.mock_calls, [
+            mock.call.first.__enter__(),
+            mock.call.second.__enter__(),
+            mock.call.first.record('repo', 'failed', 'error'),
+            mock.call.second.record('repo', 'failed', 'error'),
+            mock.call.second.__exit__(None, None, None),
+            mock.call.first.__exit__(None, None, None),
+        ])
+
+    def test_enter_failure(self):
+        parent = mock.MagicMock()
+        parent.third.__enter__.side_effect = OSError('read-only')
+        recorders = freshen.Recorders(parent.first, parent.second,
+                                      parent.third)
+
+        with self.assertRaises(OSError) as cm:
+            with recorders:
+                self.fail('entered')
+
+        exc = cm.exception
+        self.assertEqual(parent.mock_calls, [
+            mock.call.first.__enter__(),
+            mock.call.second.__enter__(),
+            mock.call.third.__enter__(),
+            mock.call.second.__exit__(OSError, exc, mock.ANY),
+            mock.call.first.__exit__(OSError, exc, mock.ANY),
+        ])
+
+    def test_exit_failure(self):
+        parent = mock.MagicMock()
+        parent.second.__exit__.side_effect = IOError('disk full')
+        recorders = freshen.Recorders(parent.first, parent.second,
+                                      parent.third)
+
+        with self.assertRaises(IOError) as cm:
+            with recorders:
+                pass
+
+        exc = cm.exception
+        self.assertEqual(parent.mock_calls, [
+            mock.call.first.__enter__(),
+            mock.call.second.__enter__(),
+            mock.call.third.__enter__(),
+            mock.call.third.__exit__(None, None, None),
+            mock.call.second.__exit__(None, None, None),
+            mock.call.first.__exit__(IOError, exc, mock.ANY),
+        ])
+
+
+class TestJournal(unittest2.TestCase):
+    def test_disabled(self):
+        journal = freshen.Journal(None, 'freshen')
+
+        with journal:
+            journal.record(make_repo('repo'), 'succeeded')
+
+        self.assertEqual(journal.filename, None)
+        self.assertEqual(journal.completed(), set())
+
+    def test_completed_run(self):
+        tempdir = os.path.join(make_tempdir(self), 'journal')
+        journal = freshen.Journal(tempdir, 'compact')
+
+        with journal:
+            journal.record(make_repo('repo'), 'succeeded')
+            self.assertTrue(os.path.exists(journal.filename))
+
+        self.assertEqual(journal.filename,
+                         os.path.join(tempdir, 'compact.journal'))
+        self.assertFalse(os.path.exists(journal.filename))
+
+    def test_filename_repo_conf(self):
+        tempdir = make_tempdir(self)
+        conf = os.path.join(tempdir, 'repos.ini')
+        journal = freshen.Journal(tempdir, 'freshen', conf)
+        other = freshen.Journal(tempdir, 'freshen',
+                                os.path.join(tempdir, 'other.ini'))
+
+        with mock.patch('os.getcwd', return_value=tempdir):
+            relative = freshen.Journal(tempdir, 'freshen', 'repos.ini')
+            self.assertEqual(relative.filename, journal.filename)
+
+        self.assertRegexpMatches(
+            journal.filename,
+            r'^%s/freshen-[0-9a-f]{12}\.journal$' % re.escape(tempdir))
+        self.assertNotEqual(journal.filename, other.filename)
+
+    def test_interrupted_run(self):
+        tempdir = make_tempdir(self)
+        journal = freshen.Journal(tempdir, 'freshen')
+
+        with self.assertRaises(KeyboardInterrupt):
+            with journal:
+                journal.record(make_repo('a'), 'succeeded')
+                journal.record(make_repo('b'), 'failed',
+                               Exception('failed'))
+                journal.record(make_repo('c'), 'skipped')
+                raise KeyboardInterrupt()
+
+        # A line cut short by the interruption is ignored
+        with open(journal.filename, 'a') as f:
+            f.write('{"directory": "/src/d", "outc')
+
+        self.assertEqual(journal.completed(), set(['/src/a', '/src/c']))
+
+        # Resuming after the cut-short line keeps the first new entry
+        resumed = freshen.Journal(tempdir, 'freshen', resume=True)
+        with self.assertRaises(KeyboardInterrupt):
+            with resumed:
+                resumed.record(make_repo('e'), 'succeeded')
+                raise KeyboardInterrupt()
+
+        self.assertEqual(resumed.completed(),
+                         set(['/src/a', '/src/c', '/src/e']))
+
+    def test_resume(self):
+        tempdir = make_tempdir(self)
+        first = freshen.Journal(tempdir, 'freshen')
+        with self.assertRaises(KeyboardInterrupt):
+            with first:
+                first.record(make_repo('a'), 'succeeded')
+                raise KeyboardInterrupt()
+
+        with open(first.filename, 'a') as f:
+            f.write('{"directory": "/src/c", "outc')
+
+        second = freshen.Journal(tempdir, 'freshen', resume=True)
+        with self.assertRaises(KeyboardInterrupt):
+            with second:
+                second.record(make_repo('b'), 'succeeded')
+                raise KeyboardInterrupt()
+        self.assertEqual(second.completed(), set(['/src/a', '/src/b']))
+
+        # The cut-short line is kept apart from the new entry
+        with open(second.filename) as f:
+            self.assertEqual(len(f.read().splitlines()), 3)
+
+        # Without resuming, the journal is started afresh
+        third = freshen.Journal(tempdir, 'freshen')
+        with self.assertRaises(KeyboardInterrupt):
+            with third:
+                raise KeyboardInterrupt()
+
+        self.assertEqual(second.completed(), set())
+        self.assertEqual(
+            freshen.Journal(tempdir, 'compact').completed(), set())
+
+
+class TestProfiler(unittest2.TestCase):
+    def test_profile(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        filename = os.path.join(tempdir, 'profile.out')
+        profiler = freshen.Profiler(filename, 5)
+
+        def child():
+            subprocess.Popen(['sleep', '0.1']).wait()
+
+        profiler.start()
+        thread = threading.Thread(target=child)
+        thread.start()
+        thread.join()
+        stats = profiler.stop()
+
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(len(profiler.thread_profilers), 1)
+        self.assertGreaterEqual(profiler.child_wait(stats), 0.09)
+        self.assertGreaterEqual(profiler.elapsed, 0.09)
+
+        stream = StringIO.StringIO()
+        profiler.report(stats, stream)
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Profile data written to %s' % filename)
+        self.assertTrue(lines[1].startswith('Elapsed time '))
+        self.assertIn('Ordered by: cumulative time', stream.getvalue())
+
+    def test_ignored_threads(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        profiler = freshen.Profiler(os.path.join(tempdir, 'profile.out'))
+        output = freshen.Output(os.path.join(tempdir, 'log'))
+        release = threading.Event()
+        running = threading.Thread(target=release.wait)
+
+        profiler.start()
+        with mock.patch.object(sys, 'stdout', StringIO.StringIO()):
+            with output:
+                output.send('message')
+        running.start()
+        stats = profiler.stop()
+        release.set()
+        running.join()
+
+        # Neither the output writer nor a running thread is included
+        self.assertEqual([thread for thread, thread_profiler
+                          in profiler.thread_profilers], [running])
+        for func in stats.stats:
+            self.assertNotEqual(func[2], '_writer')
+
+    def test_report_idle(self):
+        get = ('/usr/lib/python2.7/Queue.py', 150, 'get')
+        sleep = ('~', 0, '<time.sleep>')
+        other = ('freshen.py', 10, 'get')
+        stats = mock.MagicMock(stats={
+            get: (1, 1, 0.0, 2.0, {}),
+            sleep: (1, 1, 0.0, 3.0, {}),
+            other: (1, 1, 0.0, 1.0, {}),
+        })
+        profiler = freshen.Profiler('profile.out')
+        profiler.elapsed = profiler.children = 0.0
+
+        profiler.report(stats, StringIO.StringIO())
+
+        self.assertEqual(stats.stats.keys(), [other])
+
+    def test_child_wait_nested(self):
+        communicate = ('/usr/lib/python2.7/subprocess.py', 452, 'communicate')
+        wait = ('/usr/lib/python2.7/subprocess.py', 1094, 'wait')
+        other = ('freshen.py', 10, 'wait')
+        stats = mock.Mock(stats={
+            communicate: (1, 1, 0.0, 2.0, {}),
+            wait: (2, 2, 0.0, 3.0, {communicate: (1, 1, 0.0, 1.5)}),
+            other: (1, 1, 0.0, 7.0, {}),
+        })
+        profiler = freshen.Profiler('profile.out')
+
+        self.assertEqual(profiler.child_wait(stats), 3.5)
+
+    def test_child_wait_code(self):
+        stream = freshen.stream_process.__code__
+        stream_label = (stream.co_filename, stream.co_firstlineno,
+                        'stream_process')
+        run = ('freshen.py', 10, 'run')
+        other = ('freshen.py', 20, 'stream_process')
+        stats = mock.Mock(stats={
+            stream_label: (1, 1, 0.0, 2.0, {}),
+            run: (1, 1, 0.0, 3.0, {}),
+            other: (1, 1, 0.0, 5.0, {}),
+        })
+        profiler = freshen.Profiler('profile.out')
+
+        # Only the function itself counts, not others named alike
+        self.assertEqual(profiler.child_wait(stats), 2.0)
+
+    def test_child_wait_stream_process(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        profiler = freshen.Profiler(os.path.join(tempdir, 'profile.out'))
+        output = FakeOutput()
+
+        profiler.start()
+        freshen.stream_process(output, subprocess.Popen(
+            ['sh', '-c', 'sleep 0.3; echo done'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        stats = profiler.stop()
+
+        self.assertGreaterEqual(profiler.child_wait(stats), 0.29)
+        self.assertLessEqual(profiler.child_wait(stats), profiler.elapsed)
+
+    @unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+    def test_child_wait_asyncio(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        profiler = freshen.Profiler(os.path.join(tempdir, 'profile.out'))
+
+        with freshen.AsyncioBackend() as backend:
+            profiler.start()
+            backend.run(['sh', '-c', 'sleep 0.3'])
+            stats = profiler.stop()
+
+        self.assertGreaterEqual(profiler.child_wait(stats), 0.29)
+        self.assertLessEqual(profiler.child_wait(stats), profiler.elapsed)
+
+    @unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+    def test_ignore_threads(self):
+        profiler = freshen.Profiler(os.path.join(make_tempdir(self),
+                                                 'profile.out'))
+
+        profiler.start()
+        with freshen.AsyncioBackend() as backend:
+            backend.run(['true'])
+        stats = profiler.stop()
+
+        # The event loop's thread is left out
+        names = set(name for filename, line, name in stats.stats)
+        self.assertIn('run', names)
+        self.assertNotIn('_communicate', names)
+
+
+class TestProfile(unittest2.TestCase):
+    @mock.patch.object(freshen, 'Profiler')
+    def test_disabled(self, mock_Profiler):
+        args = mock.Mock(profile=None)
+
+        self.assertEqual(list(freshen.profile(args)), [])
+        self.assertFalse(mock_Profiler.called)
 
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
-    @mock.patch('git.Git', return_value='computed')
-    def test_handle_computed(self, mock_Git, mock_expanduser):
-        repo = freshen.Repo('repo')
+    @mock.patch.object(freshen, 'Profiler')
+    def test_enabled(self, mock_Profiler, mock_expanduser):
+        args = mock.Mock(profile='~/profile.out', profile_top=10)
+        profiler = mock_Profiler.return_value
 
-        self.assertEqual(repo.handle, 'computed')
-        mock_Git.assert_called_once_with('/home/test/devel/src/repo')
+        proc = freshen.profile(args)
+        next(proc)
+
+        mock_Profiler.assert_called_once_with('/home/test/profile.out', 10)
+        profiler.start.assert_called_once_with()
+        self.assertFalse(profiler.stop.called)
+
+        self.assertRaises(StopIteration, proc.send, 'result')
+
+        profiler.report.assert_called_once_with(
+            profiler.stop.return_value, sys.stdout)
+
+    @mock.patch.object(freshen, 'Profiler')
+    def test_enabled_failure(self, mock_Profiler):
+        args = mock.Mock(profile='profile.out', profile_top=10)
+        profiler = mock_Profiler.return_value
+
+        proc = freshen.profile(args)
+        next(proc)
+
+        self.assertRaises(ValueError, proc.throw, ValueError('failed'))
+        profiler.report.assert_called_once_with(
+            profiler.stop.return_value, sys.stdout)
+
+
+class TestHostLimiter(unittest2.TestCase):
+    def run_threads(self, limiter, hosts):
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+
+        def run(host):
+            with limiter.acquire(host):
+                with lock:
+                    active[host] = active.get(host, 0) + 1
+                    peak[host] = max(peak.get(host, 0), active[host])
+                time.sleep(0.02)
+                with lock:
+                    active[host] -= 1
+
+        threads = [threading.Thread(target=run, args=(host,))
+                   for host in hosts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return peak
+
+    def test_acquire(self):
+        limiter = freshen.HostLimiter(2)
+
+        peak = self.run_threads(limiter, ['a'] * 6 + ['b'] * 6)
+
+        self.assertEqual(peak, {'a': 2, 'b': 2})
+
+    def test_acquire_local(self):
+        limiter = freshen.HostLimiter(1)
+
+        peak = self.run_threads(limiter, [None] * 4)
+
+        self.assertGreater(peak[None], 1)
+        self.assertEqual(limiter._semaphores, {})
+
+
+class TestSSHMultiplexer(unittest2.TestCase):
+    @mock.patch.object(subprocess, 'call')
+    def test_disabled(self, mock_call):
+        with freshen.SSHMultiplexer(False) as multiplexer:
+            self.assertEqual(multiplexer.directory, None)
+            self.assertEqual(multiplexer.options, None)
+
+        self.assertFalse(mock_call.called)
+
+    @mock.patch.object(subprocess, 'call')
+    def test_enabled(self, mock_call):
+        with freshen.SSHMultiplexer(persist=30) as multiplexer:
+            directory = multiplexer.directory
+            self.assertEqual(
+                multiplexer.options,
+                "-o ControlMaster=auto -o ControlPath=%s/%%C "
+                "-o ControlPersist=30" % directory)
+            open(os.path.join(directory, 'socket'), 'w').close()
+
+        self.assertEqual(multiplexer.options, None)
+        self.assertFalse(os.path.exists(directory))
+        mock_call.assert_called_once_with(
+            ['ssh', '-o', 'ControlPath=%s/socket' % directory, '-O', 'exit',
+             'freshen'], stdin=mock.ANY, stdout=mock.ANY, stderr=mock.ANY)
 
 
 class TestOutput(unittest2.TestCase):
+    def make_logfile(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        return os.path.join(tempdir, 'freshen.log')
+
+    def read_logfile(self, logfile):
+        with open(logfile) as f:
+            return f.read()
+
     def test_init(self):
         out = freshen.Output('logfile')
 
         self.assertEqual(out.logfile, 'logfile')
+        self.assertEqual(out.queue_size, 1024)
+        self.assertEqual(out.flush_interval, 1.0)
         self.assertEqual(out.log, None)
+        self.assertEqual(out.queue, None)
+        self.assertEqual(out.writer, None)
 
-    @mock.patch('__builtin__.open', return_value='open handle')
+    @mock.patch('__builtin__.open', return_value=mock.Mock())
     def test_enter(self, mock_open):
-        out = freshen.Output('logfile')
+        out = freshen.Output('logfile', queue_size=5)
 
         result = out.__enter__()
 
-        self.assertEqual(result, out)
-        mock_open.assert_called_once_with('logfile', 'a', 0)
-        self.assertEqual(out.log, 'open handle')
+        try:
+            self.assertEqual(result, out)
+            mock_open.assert_called_once_with('logfile', 'a')
+            self.assertEqual(out.log, mock_open.return_value)
+            self.assertEqual(out.queue.maxsize, 5)
+            self.assertTrue(out.writer.is_alive())
+        finally:
+            out.__exit__(None, None, None)
 
-    def test_exit(self):
+    @mock.patch('__builtin__.open', return_value=mock.Mock())
+    def test_exit(self, mock_open):
         out = freshen.Output('logfile')
-        log = mock.Mock()
-        out.log = log
+        out.__enter__()
+        log = out.log
+        writer = out.writer
 
         out.__exit__(None, None, None)
 
         log.close.assert_called_once_with()
+        self.assertFalse(writer.is_alive())
         self.assertEqual(out.log, None)
+        self.assertEqual(out.queue, None)
+        self.assertEqual(out.writer, None)
+
+    @mock.patch.object(sys, 'stdout')
+    def test_write_all(self, mock_stdout):
+        logfile = self.make_logfile()
+        msgs = ['message %d' % i for i in range(100)]
+
+        with freshen.Output(logfile, queue_size=2) as out:
+            for msg in msgs:
+                out.send(msg)
+
+        expected = ''.join('%s\n' % msg for msg in msgs)
+        self.assertEqual(self.read_logfile(logfile), expected)
+        self.assertEqual(''.join(c[0][0] for c in
+                                 mock_stdout.write.call_args_list),
+                         expected)
+        self.assertTrue(mock_stdout.flush.called)
+
+    @mock.patch.object(sys, 'stdout')
+    def test_write_exception(self, mock_stdout):
+        logfile = self.make_logfile()
+
+        def fail():
+            with freshen.Output(logfile) as out:
+                out.send('message 1')
+                out.send('message 2')
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, fail)
+        self.assertEqual(self.read_logfile(logfile),
+                         'message 1\nmessage 2\n')
+
+    @mock.patch.object(sys, 'stdout')
+    def test_write_flush(self, mock_stdout):
+        logfile = self.make_logfile()
+
+        with freshen.Output(logfile, flush_interval=0.01) as out:
+            out.send('message 1')
+            for i in range(500):
+                if self.read_logfile(logfile):
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(self.read_logfile(logfile), 'message 1\n')
+
+    @mock.patch.object(sys, 'stdout')
+    def test_write_error(self, mock_stdout):
+        out = freshen.Output('logfile')
+
+        with mock.patch('__builtin__.open', return_value=mock.Mock(**{
+                'write.side_effect': IOError('disk full'),
+        })):
+            out.__enter__()
+        out.send('message 1')
+        out.send('message 2')
+
+        self.assertRaises(IOError, out.__exit__, None, None, None)
+        mock_stdout.write.assert_has_calls([
+            mock.call('message 1\n'),
+            mock.call('message 2\n'),
+        ])
+
+    def run_with_timeout(self, func):
+        # A hung Output must fail the test rather than hang it
+        result = []
+
+        def run():
+            try:
+                func()
+            except Exception as exc:
+                result.append(exc)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        return result
+
+    @mock.patch.object(sys, 'stdout', **{
+        'write.side_effect': IOError(32, 'Broken pipe'),
+    })
+    def test_write_stdout_error(self, mock_stdout):
+        logfile = self.make_logfile()
+        msgs = ['message %d' % i for i in range(50)]
+
+        def run():
+            with freshen.Output(logfile, queue_size=2,
+                                flush_interval=0.01) as out:
+                for msg in msgs:
+                    out.send(msg)
+
+        result = self.run_with_timeout(run)
+
+        self.assertEqual(len(result), 1)
+        self.assertIsInstance(result[0], IOError)
+        self.assertEqual(self.read_logfile(logfile),
+                         ''.join('%s\n' % msg for msg in msgs))
+        self.assertEqual(mock_stdout.write.call_count, 1)
+
+    @mock.patch.object(sys, 'stdout')
+    def test_write_writer_died(self, mock_stdout):
+        logfile = self.make_logfile()
+        real_write = freshen.Output._write
+        failed = []
+
+        def write(out, msgs):
+            if not failed:
+                failed.append(msgs)
+                raise RuntimeError('writer died')
+            real_write(out, msgs)
+
+        def run():
+            with mock.patch.object(freshen.Output, '_write', write):
+                with freshen.Output(logfile, queue_size=1,
+                                    flush_interval=0.01) as out:
+                    for i in range(20):
+                        out.send('message %d' % i)
+
+        result = self.run_with_timeout(run)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(str(result[0]), 'writer died')
+        self.assertEqual(failed, [['message 0\n']])
+        self.assertEqual(self.read_logfile(logfile), ''.join(
+            'message %d\n' % i for i in range(1, 20)))
+
+    @mock.patch.object(sys, 'stdout')
+    def test_send_unicode(self, mock_stdout):
+        logfile = self.make_logfile()
+
+        with freshen.Output(logfile) as out:
+            out.send(u'caf\xe9')
+
+        self.assertEqual(self.read_logfile(logfile), 'caf\xc3\xa9\n')
+        mock_stdout.write.assert_called_once_with('caf\xc3\xa9\n')
 
     @mock.patch.object(sys, 'stdout')
     def test_send_nolog(self, mock_stdout):
@@ -352,22 +3128,127 @@ class TestOutput(unittest2.TestCase):
         self.assertEqual(mock_stdout.write.call_count, 2)
 
     @mock.patch.object(sys, 'stdout')
-    def test_send_withlog(self, mock_stdout):
-        out = freshen.Output('logfile')
-        out.log = mock.Mock()
+    def test_send_withlog(self, mock_stdout):
+        out = freshen.Output('logfile')
+        out.log = mock.Mock()
+
+        out.send(None, '', 'no trailing newline', 'two trailing newlines\n\n')
+
+        out.log.write.assert_has_calls([
+            mock.call('no trailing newline\n'),
+            mock.call('two trailing newlines\n\n'),
+        ])
+        self.assertEqual(out.log.write.call_count, 2)
+        mock_stdout.write.assert_has_calls([
+            mock.call('no trailing newline\n'),
+            mock.call('two trailing newlines\n\n'),
+        ])
+        self.assertEqual(mock_stdout.write.call_count, 2)
+
+    @mock.patch.object(freshen, 'RepoOutput', return_value='repo output')
+    def test_for_repo(self, mock_RepoOutput):
+        out = freshen.Output('logfile')
+
+        result = out.for_repo('repo', 5)
+
+        self.assertEqual(result, 'repo output')
+        mock_RepoOutput.assert_called_once_with(out, 'repo', 5)
+
+
+class TestRepoOutput(unittest2.TestCase):
+    def test_init(self):
+        repo_output = freshen.RepoOutput('output', 'repo')
+
+        self.assertEqual(repo_output.output, 'output')
+        self.assertEqual(repo_output.name, 'repo')
+        self.assertEqual(repo_output.max_lines, 100)
+        self.assertEqual(repo_output.lines, [])
+
+    def test_send(self):
+        output = mock.Mock()
+        repo_output = freshen.RepoOutput(output, 'repo', 4)
+
+        repo_output.send(None, '', 'one', 'two\nthree\n')
+
+        self.assertEqual(repo_output.lines, [
+            '[repo] one\n',
+            '[repo] two\n',
+            '[repo] three\n',
+        ])
+        self.assertFalse(output.send.called)
+
+        repo_output.send('four\n\nfive')
+
+        output.send.assert_called_once_with(
+            '[repo] one\n[repo] two\n[repo] three\n[repo] four\n'
+            '[repo] \n[repo] five\n')
+        self.assertEqual(repo_output.lines, [])
+
+    def test_send_mixed(self):
+        output = mock.Mock()
+        repo_output = freshen.RepoOutput(output, 'repo')
+
+        repo_output.send(u'Switched to branch \u2018master\u2019')
+        repo_output.send('caf\xc3\xa9 installed')
+        repo_output.flush()
+
+        output.send.assert_called_once_with(
+            '[repo] Switched to branch \xe2\x80\x98master\xe2\x80\x99\n'
+            '[repo] caf\xc3\xa9 installed\n')
+        self.assertEqual(repo_output.lines, [])
+
+    def test_flush(self):
+        output = mock.Mock()
+        repo_output = freshen.RepoOutput(output, 'repo')
+
+        repo_output.flush()
+        self.assertFalse(output.send.called)
+
+        repo_output.send('one')
+        repo_output.flush()
+
+        output.send.assert_called_once_with('[repo] one\n')
+        self.assertEqual(repo_output.lines, [])
+
+    def test_context(self):
+        output = mock.Mock()
+
+        def fail():
+            with freshen.RepoOutput(output, 'repo') as repo_output:
+                repo_output.send('one')
+                raise Exception('failed')
+
+        self.assertRaises(Exception, fail)
+        output.send.assert_called_once_with('[repo] one\n')
+
+    @mock.patch.object(sys, 'stdout')
+    def test_interleaving(self, mock_stdout):
+        logfile = os.path.join(tempfile.mkdtemp(), 'freshen.log')
+        self.addCleanup(shutil.rmtree, os.path.dirname(logfile))
 
-        out.send(None, '', 'no trailing newline', 'two trailing newlines\n\n')
+        def worker(out, name):
+            with out.for_repo(name) as repo_output:
+                for i in range(50):
+                    repo_output.send('line %d' % i)
 
-        out.log.write.assert_has_calls([
-            mock.call('no trailing newline\n'),
-            mock.call('two trailing newlines\n\n'),
-        ])
-        self.assertEqual(out.log.write.call_count, 2)
-        mock_stdout.write.assert_has_calls([
-            mock.call('no trailing newline\n'),
-            mock.call('two trailing newlines\n\n'),
-        ])
-        self.assertEqual(mock_stdout.write.call_count, 2)
+        with freshen.Output(logfile) as out:
+            threads = [threading.Thread(target=worker,
+                                        args=(out, 'repo%d' % i))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        with open(logfile) as f:
+            lines = f.read().splitlines()
+
+        # Each repository's lines are contiguous
+        names = [line.split()[0] for line in lines]
+        self.assertEqual(len(lines), 200)
+        for i in range(4):
+            start = names.index('[repo%d]' % i)
+            self.assertEqual(names[start:start + 50], ['[repo%d]' % i] * 50)
 
 
 class TestGetRepos(unittest2.TestCase):
@@ -478,6 +3359,317 @@ class TestGetRepos(unittest2.TestCase):
         ], any_order=True)
 
 
+class TestGetOption(unittest2.TestCase):
+    def test_value(self):
+        cfg = mock.Mock(**{'get.return_value': 'configured'})
+
+        result = freshen.get_option(cfg, 'option', 'value', 'default')
+
+        self.assertEqual(result, 'value')
+        self.assertFalse(cfg.get.called)
+
+    def test_configured(self):
+        cfg = mock.Mock(**{'get.return_value': 'configured'})
+
+        result = freshen.get_option(cfg, 'option', None, 'default')
+
+        self.assertEqual(result, 'configured')
+        cfg.get.assert_called_once_with('repos', 'option')
+
+    def test_nosection(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_option(cfg, 'option', None, 'default')
+
+        self.assertEqual(result, 'default')
+
+    def test_nooption(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoOptionError('option', 'repos'),
+        })
+
+        result = freshen.get_option(cfg, 'option')
+
+        self.assertEqual(result, None)
+
+
+class TestRunJobs(unittest2.TestCase):
+    def make_action(self, fail=()):
+        def action(repo):
+            if repo in fail:
+                raise Exception('failed %s' % repo)
+            acted.append(repo)
+
+        acted = []
+        return acted, action
+
+    def test_serial(self):
+        acted, action = self.make_action(fail=('repo1',))
+        done = mock.Mock()
+
+        freshen.run_jobs(['repo0', 'repo1', 'repo2'], action, done)
+
+        self.assertEqual(acted, ['repo0', 'repo2'])
+        self.assertEqual(done.call_count, 3)
+        self.assertEqual(done.call_args_list[0], mock.call('repo0', None))
+        self.assertEqual(done.call_args_list[1][0][0], 'repo1')
+        self.assertEqual(str(done.call_args_list[1][0][1]), 'failed repo1')
+        self.assertEqual(done.call_args_list[2], mock.call('repo2', None))
+
+    def test_parallel(self):
+        acted, action = self.make_action(fail=('repo1',))
+        threads = set()
+        results = {}
+
+        def done(repo, exc):
+            threads.add(threading.current_thread())
+            results[repo] = exc and str(exc)
+
+        freshen.run_jobs(['repo%d' % i for i in range(10)], action, done, 4)
+
+        self.assertEqual(sorted(acted),
+                         ['repo%d' % i for i in range(10) if i != 1])
+        self.assertEqual(results, dict(
+            ('repo%d' % i, 'failed repo1' if i == 1 else None)
+            for i in range(10)))
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+    def test_parallel_joined(self):
+        workers = set()
+
+        freshen.run_jobs(['repo%d' % i for i in range(10)],
+                         lambda repo: workers.add(threading.current_thread()),
+                         mock.Mock(), 4)
+
+        # Every worker has exited by the time the call returns
+        self.assertEqual([thread for thread in workers if thread.is_alive()],
+                         [])
+
+
+class TestGetState(unittest2.TestCase):
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_default(self, mock_expanduser):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_state(cfg, 'freshen')
+
+        self.assertEqual(result.filename, '/home/test/.freshen.db')
+        self.assertEqual(result.command, 'freshen')
+
+    def test_disabled(self):
+        cfg = mock.Mock(**{'get.return_value': ''})
+
+        result = freshen.get_state(cfg, 'compact')
+
+        self.assertEqual(result.filename, '')
+        self.assertEqual(result.command, 'compact')
+
+
+class TestGetLimits(unittest2.TestCase):
+    def test_unconfigured(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_limits(cfg)
+
+        self.assertEqual(result, ([], {}))
+
+    @mock.patch('multiprocessing.cpu_count', return_value=2)
+    def test_arguments(self, mock_cpu_count):
+        cfg = mock.Mock(**{'get.return_value': 'ignored'})
+
+        result = freshen.get_limits(cfg, 5, 'best-effort', '1g', 4)
+
+        self.assertEqual(result, (
+            ['nice', '-n', '5', 'ionice', '-c', 'best-effort'],
+            {'pack.windowMemory': '1g', 'pack.threads': 1},
+        ))
+
+
+class TestGetJournal(unittest2.TestCase):
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_unconfigured(self, mock_expanduser):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_journal(cfg, 'freshen', '~/repos.ini')
+
+        self.assertEqual(result.directory, '/home/test/.freshen')
+        self.assertEqual(result.command, 'freshen')
+        self.assertEqual(result.repo_conf, '~/repos.ini')
+        self.assertEqual(result.resume, False)
+
+    def test_disabled(self):
+        cfg = mock.Mock(**{'get.return_value': ''})
+
+        result = freshen.get_journal(cfg, 'compact', '~/repos.ini', True)
+
+        self.assertEqual(result.filename, None)
+        self.assertEqual(result.resume, True)
+
+
+class TestGetBackend(unittest2.TestCase):
+    def test_unconfigured(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_backend(cfg, None)
+
+        self.assertIsInstance(result, freshen.AsyncioBackend)
+        self.assertEqual(result.enabled, False)
+
+    @mock.patch.object(freshen, 'asyncio', 'asyncio')
+    def test_configured(self):
+        cfg = mock.Mock(**{'get.return_value': 'asyncio'})
+
+        result = freshen.get_backend(cfg, None)
+
+        self.assertEqual(result.enabled, True)
+
+    @mock.patch.object(freshen, 'asyncio', 'asyncio')
+    def test_override(self):
+        cfg = mock.Mock(**{'get.return_value': 'asyncio'})
+
+        result = freshen.get_backend(cfg, 'gitpython')
+
+        self.assertEqual(result.enabled, False)
+
+    def test_unknown(self):
+        cfg = mock.Mock(**{'get.return_value': 'threads'})
+
+        self.assertRaises(ValueError, freshen.get_backend, cfg, None)
+
+    @mock.patch.object(freshen, 'asyncio', None)
+    def test_unavailable(self):
+        cfg = mock.Mock()
+
+        with self.assertRaises(ValueError) as cm:
+            freshen.get_backend(cfg, 'asyncio')
+
+        self.assertEqual(str(cm.exception),
+                         "The asyncio backend requires trollius")
+
+
+class TestGetReport(unittest2.TestCase):
+    def test_unconfigured(self):
+        cfg = mock.Mock(**{
+            'get.side_effect': ConfigParser.NoSectionError('repos'),
+        })
+
+        result = freshen.get_report(cfg, None, 'freshen')
+
+        self.assertEqual(result.filename, None)
+        self.assertEqual(result.command, 'freshen')
+
+    @mock.patch('os.path.expanduser',
+                side_effect=lambda x: '/home/test%s' % x[1:])
+    def test_configured(self, mock_expanduser):
+        cfg = mock.Mock(**{'get.return_value': '~/report.json'})
+
+        result = freshen.get_report(cfg, None, 'compact')
+
+        self.assertEqual(result.filename, '/home/test/report.json')
+        self.assertEqual(result.command, 'compact')
+
+    def test_argument(self):
+        cfg = mock.Mock(**{'get.return_value': 'conf.json'})
+
+        result = freshen.get_report(cfg, 'arg.json', 'freshen')
+
+        self.assertEqual(result.filename, 'arg.json')
+
+
+class TestRunPipeline(unittest2.TestCase):
+    def test_serial(self):
+        calls = []
+
+        def first(repo):
+            calls.append(('first', repo))
+            if repo == 'repo1':
+                raise Exception('first failed')
+
+        def second(repo):
+            calls.append(('second', repo))
+
+        done = mock.Mock()
+
+        freshen.run_pipeline(['repo0', 'repo1', 'repo2'], first, second,
+                             done)
+
+        self.assertEqual(calls, [
+            ('first', 'repo0'),
+            ('second', 'repo0'),
+            ('first', 'repo1'),
+            ('first', 'repo2'),
+            ('second', 'repo2'),
+        ])
+        self.assertEqual(done.call_count, 3)
+        self.assertEqual(str(done.call_args_list[1][0][1]), 'first failed')
+
+    def test_parallel(self):
+        lock = threading.Lock()
+        active = []
+        overlapped = []
+        seconds = []
+
+        def first(repo):
+            if repo == 'repo1':
+                raise Exception('first failed')
+
+        def second(repo):
+            with lock:
+                active.append(repo)
+                if len(active) > 1:
+                    overlapped.append(repo)
+            seconds.append((repo, threading.current_thread()))
+            try:
+                if repo == 'repo2':
+                    raise Exception('second failed')
+            finally:
+                with lock:
+                    active.remove(repo)
+
+        results = {}
+
+        def done(repo, exc):
+            results[repo] = exc and str(exc)
+
+        freshen.run_pipeline(['repo%d' % i for i in range(10)], first,
+                             second, done, 4)
+
+        self.assertEqual(results, dict(
+            ('repo%d' % i, {1: 'first failed', 2: 'second failed'}.get(i))
+            for i in range(10)))
+        self.assertEqual(overlapped, [])
+        self.assertEqual(sorted(repo for repo, thread in seconds),
+                         ['repo%d' % i for i in range(10) if i != 1])
+        self.assertEqual(len(set(thread for repo, thread in seconds)), 1)
+        self.assertNotEqual(seconds[0][1], threading.current_thread())
+
+    def test_parallel_joined(self):
+        threads = set()
+
+        def stage(repo):
+            threads.add(threading.current_thread())
+
+        freshen.run_pipeline(['repo%d' % i for i in range(10)], stage, stage,
+                             mock.Mock(), 4)
+
+        # Both the workers and the second stage thread have exited
+        self.assertGreater(len(threads), 1)
+        self.assertEqual([thread for thread in threads if thread.is_alive()],
+                         [])
+
+
 class TestPrepare(unittest2.TestCase):
     @mock.patch('os.path.expanduser',
                 side_effect=lambda x: '/home/test%s' % x[1:])
@@ -492,7 +3684,7 @@ class TestPrepare(unittest2.TestCase):
 
         result = freshen.prepare('~/.repos.ini', None, 'restrict')
 
-        self.assertEqual(result, ('repos', 'output'))
+        self.assertEqual(result, ('repos', 'output', cfg))
         cfg.read.assert_called_once_with('/home/test/.repos.ini')
         mock_get_repos.assert_called_once_with(cfg, 'restrict')
         mock_Output.assert_called_once_with('/home/test/freshen.log')
@@ -510,7 +3702,7 @@ class TestPrepare(unittest2.TestCase):
 
         result = freshen.prepare('~/.repos.ini', None, 'restrict')
 
-        self.assertEqual(result, ('repos', 'output'))
+        self.assertEqual(result, ('repos', 'output', cfg))
         cfg.read.assert_called_once_with('/home/test/.repos.ini')
         mock_get_repos.assert_called_once_with(cfg, 'restrict')
         mock_Output.assert_called_once_with('/home/test/freshen.log')
@@ -528,7 +3720,7 @@ class TestPrepare(unittest2.TestCase):
 
         result = freshen.prepare('~/.repos.ini', None, 'restrict')
 
-        self.assertEqual(result, ('repos', 'output'))
+        self.assertEqual(result, ('repos', 'output', cfg))
         cfg.read.assert_called_once_with('/home/test/.repos.ini')
         mock_get_repos.assert_called_once_with(cfg, 'restrict')
         mock_Output.assert_called_once_with('/home/test/my/log/file')
@@ -546,23 +3738,37 @@ class TestPrepare(unittest2.TestCase):
 
         result = freshen.prepare('~/.repos.ini', '~/arg/log', 'restrict')
 
-        self.assertEqual(result, ('repos', 'output'))
+        self.assertEqual(result, ('repos', 'output', cfg))
         cfg.read.assert_called_once_with('/home/test/.repos.ini')
         mock_get_repos.assert_called_once_with(cfg, 'restrict')
         mock_Output.assert_called_once_with('/home/test/arg/log')
 
 
 class TestTools(unittest2.TestCase):
+    def make_prepare(self, count=4, conf={}):
+        conf = dict(conf)
+        conf.setdefault('state_db', '')
+        conf.setdefault('journal', '')
+
+        def get(sect, opt):
+            if opt not in conf:
+                raise ConfigParser.NoOptionError(opt, sect)
+            return conf[opt]
+
+        repos = [mock.Mock() for i in range(count)]
+        for idx, repo in enumerate(repos):
+            repo.name = 'repo%d' % idx
+            repo.streaming.return_value = mock.MagicMock()
+            repo.mirror = None
+        return repos, mock.MagicMock(), mock.Mock(**{'get.side_effect': get})
+
     @mock.patch('datetime.datetime', mock.Mock(**{
         'now.return_value': "yyyy-mm-ddThh:mm:ss",
     }))
-    @mock.patch.object(freshen, 'prepare', return_value=(
-        [mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()],
-        mock.MagicMock()))
+    @mock.patch.object(freshen, 'prepare')
     def test_freshen(self, mock_prepare):
-        repos, output = mock_prepare.return_value
-        for idx, repo in enumerate(repos):
-            repo.name = 'repo%d' % idx
+        mock_prepare.return_value = self.make_prepare()
+        repos, output, cfg = mock_prepare.return_value
 
         result = freshen.freshen('repo_conf', 'logfile', 'restrict')
 
@@ -572,39 +3778,544 @@ class TestTools(unittest2.TestCase):
         output.assert_has_calls([
             mock.call.__enter__(),
             mock.call.send("Freshening repositories at yyyy-mm-ddThh:mm:ss"),
-            mock.call.send("Freshening repository repo0..."),
-            mock.call.send("Freshening repository repo1..."),
-            mock.call.send("Freshening repository repo2..."),
-            mock.call.send("Freshening repository repo3..."),
+            mock.call.for_repo('repo0', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo0..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo0 freshened"),
+            mock.call.for_repo('repo1', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo1..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo1 freshened"),
+            mock.call.for_repo('repo2', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo2..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo2 freshened"),
+            mock.call.for_repo('repo3', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo3..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo3 freshened"),
+            mock.call.send("Freshened 4 repositories: 4 succeeded, 0 failed, "
+                           "0 skipped"),
             mock.call.__exit__(None, None, None),
         ])
+        repo_output = output.for_repo.return_value.__enter__.return_value
         for repo in repos:
-            repo.freshen.assert_called_once_with(output)
+            repo.freshen.assert_called_once_with(repo_output)
+            self.assertEqual(repo.state.filename, '')
+            self.assertEqual(repo.state.command, 'freshen')
 
     @mock.patch('datetime.datetime', mock.Mock(**{
         'now.return_value': "yyyy-mm-ddThh:mm:ss",
     }))
-    @mock.patch.object(freshen, 'prepare', return_value=(
-        [mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()],
-        mock.MagicMock()))
-    def test_compact(self, mock_prepare):
-        repos, output = mock_prepare.return_value
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_failures(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare()
+        repos, output, cfg = mock_prepare.return_value
+        repos[1].freshen.side_effect = Exception('failure 1')
+        repos[2].freshen.side_effect = Exception('failure 2')
+
+        result = freshen.freshen('repo_conf', 'logfile', 'restrict')
+
+        self.assertEqual(result,
+                         "Failed to freshen repositories: repo1, repo2")
+        output.assert_has_calls([
+            mock.call.__enter__(),
+            mock.call.send("Freshening repositories at yyyy-mm-ddThh:mm:ss"),
+            mock.call.for_repo('repo0', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo0..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo0 freshened"),
+            mock.call.for_repo('repo1', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo1..."),
+            mock.call.for_repo().__exit__(Exception, mock.ANY, mock.ANY),
+            mock.call.send("Repository repo1 failed: failure 1"),
+            mock.call.for_repo('repo2', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo2..."),
+            mock.call.for_repo().__exit__(Exception, mock.ANY, mock.ANY),
+            mock.call.send("Repository repo2 failed: failure 2"),
+            mock.call.for_repo('repo3', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo3..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo3 freshened"),
+            mock.call.send("Freshened 4 repositories: 2 succeeded, 2 failed, "
+                           "0 skipped"),
+            mock.call.__exit__(None, None, None),
+        ])
+        repo_output = output.for_repo.return_value.__enter__.return_value
+        for repo in repos:
+            repo.freshen.assert_called_once_with(repo_output)
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    @mock.patch.object(freshen, 'run_pipeline')
+    def test_freshen_jobs(self, mock_run_pipeline, mock_run_jobs,
+                          mock_prepare):
+        mock_prepare.return_value = self.make_prepare(conf={'jobs': '8'})
+        repos, output, cfg = mock_prepare.return_value
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict')
+        freshen.freshen('repo_conf', 'logfile', 'restrict', jobs=2)
+        freshen.freshen('repo_conf', 'logfile', 'restrict', jobs=1)
+
+        mock_run_pipeline.assert_has_calls([
+            mock.call(repos, mock.ANY, mock.ANY, mock.ANY, 8),
+            mock.call(repos, mock.ANY, mock.ANY, mock.ANY, 2),
+        ])
+        mock_run_jobs.assert_called_once_with(repos, mock.ANY, mock.ANY)
+
+    @unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    def test_freshen_host_concurrency(self, mock_run_jobs, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'host_concurrency': '3'})
+        repos, output, cfg = mock_prepare.return_value
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict')
+
+        limiter = repos[0].host_limiter
+        self.assertIsInstance(limiter, freshen.HostLimiter)
+        self.assertEqual(limiter.limit, 3)
+        self.assertIs(repos[1].host_limiter, limiter)
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    def test_freshen_ssh_multiplex(self, mock_run_jobs, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'ssh_multiplex': 'yes'})
+        repos, output, cfg = mock_prepare.return_value
+        options = []
+        mock_run_jobs.side_effect = lambda *args: options.extend(
+            repo.ssh_options for repo in repos)
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict')
+
+        self.assertIn('ControlMaster=auto', options[0])
+        self.assertEqual(options[0], options[1])
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    @mock.patch.object(freshen.Journal, 'completed',
+                       return_value=set(['/src/repo1']))
+    def test_freshen_resume(self, mock_completed, mock_run_jobs,
+                            mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=3)
+        repos, output, cfg = mock_prepare.return_value
+        for repo in repos:
+            repo.directory = '/src/%s' % repo.name
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict', resume=True)
+
+        output.send.assert_any_call(
+            "Resuming interrupted run; 1 repositories already freshened")
+        mock_run_jobs.assert_called_once_with([repos[0], repos[2]],
+                                              mock.ANY, mock.ANY)
+        output.send.assert_called_with(
+            "Freshened 2 repositories: 2 succeeded, 0 failed, 0 skipped")
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    def test_freshen_mirrors(self, mock_run_jobs, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=4)
+        repos, output, cfg = mock_prepare.return_value
+        for repo, mirror in zip(repos, ['/b.git', '/a.git', '/b.git', None]):
+            repo.mirror = mirror
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict', jobs=1)
+
+        mock_run_jobs.assert_has_calls([
+            mock.call([repos[1], repos[0]], mock.ANY, mock.ANY, 1),
+            mock.call(repos, mock.ANY, mock.ANY),
+        ])
+        output.send.assert_any_call("Updating mirrors...")
+
+        # A failure to update a mirror is reported, but is not fatal
+        mirrored = mock_run_jobs.call_args_list[0][0][2]
+        mirrored(repos[0], Exception('unreachable'))
+        output.send.assert_called_with(
+            "Unable to update mirror /b.git: unreachable")
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    def test_freshen_backend(self, mock_run_jobs, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=2)
+        repos, output, cfg = mock_prepare.return_value
+        running = []
+        mock_run_jobs.side_effect = lambda *args: running.extend(
+            repo.git_backend.loop is not None for repo in repos)
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict', backend='asyncio')
+
+        self.assertIsInstance(repos[0].git_backend, freshen.AsyncioBackend)
+        self.assertIs(repos[0].git_backend, repos[1].git_backend)
+        self.assertEqual(running, [True, True])
+        self.assertEqual(repos[0].git_backend.loop, None)
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_bad_backend(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'backend': 'threads'})
+        repos, output, cfg = mock_prepare.return_value
+
+        result = freshen.freshen('repo_conf', 'logfile', 'restrict')
+
+        self.assertEqual(result, "Unknown backend 'threads'")
+        self.assertFalse(output.__enter__.called)
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_pipeline(self, mock_prepare):
+        repos, output, cfg = self.make_prepare(count=8)
+        output = FakeOutput()
+        mock_prepare.return_value = repos, output, cfg
+        repos[3].update.side_effect = Exception('update failed')
+        repos[5].install_branch.side_effect = Exception('install failed')
+
+        result = freshen.freshen('repo_conf', 'logfile', 'restrict', jobs=4)
+
+        self.assertEqual(result, "Failed to freshen repositories: "
+                         "repo3, repo5")
         for idx, repo in enumerate(repos):
-            repo.name = 'repo%d' % idx
+            self.assertFalse(repo.freshen.called)
+            self.assertEqual(repo.update.call_count, 1)
+            repo_output = repo.update.call_args[0][0]
+            self.assertEqual(repo.update.call_args[1], {'keep_branch': True})
+            self.assertEqual(repo_output.name, 'repo%d' % idx)
+            self.assertEqual(repo_output.max_lines, 100)
+            if idx == 3:
+                self.assertFalse(repo.install_branch.called)
+            else:
+                self.assertEqual(repo.install_branch.call_count, 1)
+            self.assertTrue(
+                "[repo%d] Freshening repository repo%d...\n" % (idx, idx)
+                in output.msgs)
+        self.assertTrue("Repository repo3 failed: update failed"
+                        in output.msgs)
+        self.assertTrue("Repository repo5 failed: install failed"
+                        in output.msgs)
+        self.assertEqual(output.msgs[-1], "Freshened 8 repositories: "
+                         "6 succeeded, 2 failed, 0 skipped")
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'now.return_value': "yyyy-mm-ddThh:mm:ss",
+    }))
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_incremental(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare()
+        repos, output, cfg = mock_prepare.return_value
+        repos[0].is_changed.return_value = False
+        repos[1].is_changed.return_value = True
+        repos[2].is_changed.side_effect = Exception('unreachable')
+        repos[3].is_changed.return_value = False
+
+        result = freshen.freshen('repo_conf', 'logfile', 'restrict',
+                                 incremental=True)
+
+        self.assertEqual(result, None)
+        output.assert_has_calls([
+            mock.call.__enter__(),
+            mock.call.send("Freshening repositories at yyyy-mm-ddThh:mm:ss"),
+            mock.call.send("Checking repositories for upstream changes..."),
+            mock.call.send("Unable to check repository repo2: unreachable"),
+            mock.call.send("Repository repo0 unchanged; skipping"),
+            mock.call.send("Repository repo3 unchanged; skipping"),
+            mock.call.for_repo('repo1', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo1..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo1 freshened"),
+            mock.call.for_repo('repo2', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Freshening repository repo2..."),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo2 freshened"),
+            mock.call.send("Freshened 4 repositories: 2 succeeded, 0 failed, "
+                           "2 skipped"),
+            mock.call.__exit__(None, None, None),
+        ])
+        self.assertFalse(repos[0].freshen.called)
+        repo_output = output.for_repo.return_value.__enter__.return_value
+        repos[1].freshen.assert_called_once_with(repo_output)
+        repos[2].freshen.assert_called_once_with(repo_output)
+        self.assertFalse(repos[3].freshen.called)
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_incremental_failed(self, mock_prepare):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        filename = os.path.join(tempdir, 'state.db')
+        mock_prepare.return_value = self.make_prepare(
+            count=3, conf={'state_db': filename})
+        repos, output, cfg = mock_prepare.return_value
+        for repo in repos:
+            repo.directory = '/src/%s' % repo.name
+            repo.start_sha = repo.end_sha = None
+            repo.timings = {}
+            repo.is_changed.return_value = False
+        with freshen.StateStore(filename, 'freshen') as state:
+            state.record(repos[0], 'failed', Exception('install failed'))
+            state.record(repos[1], 'succeeded')
+
+        result = freshen.freshen('repo_conf', 'logfile', 'restrict',
+                                 incremental=True)
+
+        self.assertEqual(result, None)
+        repo_output = output.for_repo.return_value.__enter__.return_value
+        repos[0].freshen.assert_called_once_with(repo_output)
+        self.assertFalse(repos[1].freshen.called)
+        repos[1].is_changed.assert_called_once_with()
+        repos[2].freshen.assert_called_once_with(repo_output)
+        output.send.assert_any_call("Repository repo1 unchanged; skipping")
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_incremental_conf(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            conf={'incremental': 'yes'})
+        repos, output, cfg = mock_prepare.return_value
+        for repo in repos:
+            repo.is_changed.return_value = False
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict')
+
+        for repo in repos:
+            repo.is_changed.assert_called_once_with()
+            self.assertFalse(repo.freshen.called)
+
+    @mock.patch.object(freshen, 'get_report')
+    @mock.patch.object(freshen, 'prepare')
+    def test_freshen_report(self, mock_prepare, mock_get_report):
+        mock_prepare.return_value = self.make_prepare(count=2)
+        repos, output, cfg = mock_prepare.return_value
+        repos[1].freshen.side_effect = Exception('failed')
+        report = mock_get_report.return_value
+
+        freshen.freshen('repo_conf', 'logfile', 'restrict',
+                        report='report.json')
+
+        mock_get_report.assert_called_once_with(
+            cfg, 'report.json', 'freshen')
+        report.assert_has_calls([
+            mock.call.__enter__(),
+            mock.call.record(repos[0], 'succeeded', None),
+            mock.call.record(repos[1], 'failed',
+                             repos[1].freshen.side_effect),
+            mock.call.__exit__(None, None, None),
+        ])
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'now.return_value': "yyyy-mm-ddThh:mm:ss",
+    }))
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare()
+        repos, output, cfg = mock_prepare.return_value
 
         result = freshen.compact('repo_conf', 'logfile', 'restrict')
 
         self.assertEqual(result, None)
         mock_prepare.assert_called_once_with(
             'repo_conf', 'logfile', 'restrict')
+        calls = [
+            mock.call.__enter__(),
+            mock.call.send("Compacting repositories at yyyy-mm-ddThh:mm:ss"),
+        ]
+        for repo in repos:
+            calls.extend([
+                mock.call.for_repo(repo.name, 1),
+                mock.call.for_repo().__enter__(),
+                mock.call.for_repo().__enter__().send(
+                    "Compacting repository %s..." % repo.name),
+                mock.call.for_repo().__exit__(None, None, None),
+                mock.call.send("Repository %s compacted" % repo.name),
+            ])
+        calls.extend([
+            mock.call.send("Compacted 4 repositories: 4 succeeded, "
+                           "0 failed, 0 skipped"),
+            mock.call.__exit__(None, None, None),
+        ])
+        output.assert_has_calls(calls)
+        repo_output = output.for_repo.return_value.__enter__.return_value
+        for repo in repos:
+            repo.git_gc.assert_called_once_with(repo_output)
+            self.assertEqual(repo.command_prefix, [])
+            self.assertEqual(repo.git_config, {})
+            self.assertFalse(repo.get_object_bytes.called)
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'now.return_value': "yyyy-mm-ddThh:mm:ss",
+    }))
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_failures(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=3)
+        repos, output, cfg = mock_prepare.return_value
+        repos[1].git_gc.side_effect = Exception('gc failed')
+
+        result = freshen.compact('repo_conf', 'logfile', 'restrict')
+
+        self.assertEqual(result, "Failed to compact repositories: repo1")
+        output.send.assert_any_call("Repository repo1 failed: gc failed")
+        output.send.assert_any_call("Compacted 3 repositories: 2 succeeded, "
+                                    "1 failed, 0 skipped")
+        for repo in repos:
+            self.assertEqual(repo.git_gc.call_count, 1)
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_jobs_missing(self, mock_prepare):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        mock_prepare.return_value = self.make_prepare(count=2)
+        repos, output, cfg = mock_prepare.return_value
+        repos[1] = freshen.Repo('missing', basedir=tempdir)
+
+        result = freshen.compact('repo_conf', 'logfile', 'restrict', jobs=2)
+
+        self.assertEqual(result, "Failed to compact repositories: missing")
+        self.assertEqual(repos[0].git_gc.call_count, 1)
+        output.send.assert_any_call("Compacted 2 repositories: 1 succeeded, "
+                                    "1 failed, 0 skipped")
+
+    @mock.patch('multiprocessing.cpu_count', return_value=8)
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_jobs(self, mock_prepare, mock_cpu_count):
+        mock_prepare.return_value = self.make_prepare(
+            count=4, conf={'compact_nice': '10', 'compact_ionice': 'idle'})
+        repos, output, cfg = mock_prepare.return_value
+        for repo, size in zip(repos, [100, None, 300, 200]):
+            repo.get_object_bytes.return_value = size
+        order = []
+        for repo in repos:
+            repo.git_gc.side_effect = (
+                lambda output, repo=repo: order.append(repo.name))
+
+        with mock.patch.object(freshen, 'run_jobs') as mock_run_jobs:
+            mock_run_jobs.side_effect = (
+                lambda todo, action, done, jobs: [action(r) for r in todo])
+            result = freshen.compact('repo_conf', 'logfile', 'restrict',
+                                     jobs=2, window_memory='64m')
+
+        self.assertEqual(result, None)
+        self.assertEqual(mock_run_jobs.call_args[0][3], 2)
+        self.assertEqual(order, ['repo2', 'repo3', 'repo0', 'repo1'])
+        for repo in repos:
+            self.assertEqual(repo.command_prefix, [
+                'nice', '-n', '10', 'ionice', '-c', 'idle',
+            ])
+            self.assertEqual(repo.git_config, {
+                'pack.windowMemory': '64m',
+                'pack.threads': 4,
+            })
+        output.for_repo.assert_any_call('repo0', 100)
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'now.return_value': "yyyy-mm-ddThh:mm:ss",
+    }))
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_threshold(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'gc_threshold': 'yes'})
+        repos, output, cfg = mock_prepare.return_value
+        repos[0].needs_gc.return_value = (False, 'too few')
+        repos[1].needs_gc.return_value = (True, 'too many')
+
+        result = freshen.compact('repo_conf', 'logfile', 'restrict')
+
+        self.assertEqual(result, None)
         output.assert_has_calls([
             mock.call.__enter__(),
             mock.call.send("Compacting repositories at yyyy-mm-ddThh:mm:ss"),
-            mock.call.send("Compacting repository repo0..."),
-            mock.call.send("Compacting repository repo1..."),
-            mock.call.send("Compacting repository repo2..."),
-            mock.call.send("Compacting repository repo3..."),
+            mock.call.for_repo('repo0', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Repository repo0 skipped: too few"),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.for_repo('repo1', 1),
+            mock.call.for_repo().__enter__(),
+            mock.call.for_repo().__enter__().send(
+                "Compacting repository repo1: too many"),
+            mock.call.for_repo().__exit__(None, None, None),
+            mock.call.send("Repository repo1 compacted"),
+            mock.call.send("Compacted 2 repositories: 1 succeeded, "
+                           "0 failed, 1 skipped"),
             mock.call.__exit__(None, None, None),
         ])
+        self.assertFalse(repos[0].git_gc.called)
+        self.assertEqual(repos[1].git_gc.call_count, 1)
+
+    @mock.patch('datetime.datetime', mock.Mock(**{
+        'now.return_value': "yyyy-mm-ddThh:mm:ss",
+    }))
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_incremental(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=2)
+        repos, output, cfg = mock_prepare.return_value
+
+        result = freshen.compact('repo_conf', 'logfile', 'restrict',
+                                 strategy='incremental')
+
+        self.assertEqual(result, None)
+        for repo in repos:
+            self.assertEqual(repo.git_maintenance.call_count, 1)
+            self.assertFalse(repo.git_gc.called)
+
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    @mock.patch.object(freshen.Journal, 'completed',
+                       return_value=set(['/src/repo0', '/src/repo2']))
+    def test_compact_resume(self, mock_completed, mock_run_jobs,
+                            mock_prepare):
+        mock_prepare.return_value = self.make_prepare(count=3)
+        repos, output, cfg = mock_prepare.return_value
         for repo in repos:
-            repo.git_gc.assert_called_once_with(output)
+            repo.directory = '/src/%s' % repo.name
+
+        freshen.compact('repo_conf', 'logfile', 'restrict', resume=True)
+
+        output.send.assert_any_call(
+            "Resuming interrupted run; 2 repositories already compacted")
+        mock_run_jobs.assert_called_once_with([repos[1]], mock.ANY, mock.ANY,
+                                              1)
+
+    @unittest2.skipIf(freshen.asyncio is None, "trollius is not available")
+    @mock.patch.object(freshen, 'prepare')
+    @mock.patch.object(freshen, 'run_jobs')
+    def test_compact_backend(self, mock_run_jobs, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'backend': 'asyncio'})
+        repos, output, cfg = mock_prepare.return_value
+        running = []
+        mock_run_jobs.side_effect = lambda *args: running.extend(
+            repo.git_backend.loop is not None for repo in repos)
+
+        freshen.compact('repo_conf', 'logfile', 'restrict')
+
+        self.assertIsInstance(repos[0].git_backend, freshen.AsyncioBackend)
+        self.assertEqual(running, [True, True])
+        self.assertEqual(repos[0].git_backend.loop, None)
+
+    @mock.patch.object(freshen, 'prepare')
+    def test_compact_bad_strategy(self, mock_prepare):
+        mock_prepare.return_value = self.make_prepare(
+            count=2, conf={'compact_strategy': 'partial'})
+        repos, output, cfg = mock_prepare.return_value
+
+        result = freshen.compact('repo_conf', 'logfile', 'restrict')
+
+        self.assertEqual(result, "Unknown compact strategy 'partial'")
+        self.assertFalse(output.__enter__.called)